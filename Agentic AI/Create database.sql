@@ -1 +1,138 @@
-create database EmailStore;
\ No newline at end of file
+create database EmailStore;
+
+-- Everything below runs while connected to EmailStore. The application also creates the
+-- emails, claims, claim_daily_totals, claim_daily_deltas, sync_state, claim_jobs and
+-- adjudication_cache tables on startup if missing, along with the claims partitions and
+-- summary triggers.
+
+CREATE TABLE IF NOT EXISTS policies (
+    policy_id VARCHAR(50) PRIMARY KEY,
+    policy_name VARCHAR(255) NOT NULL,
+    plan_type VARCHAR(50),
+    coverage_details TEXT,
+    covered_services TEXT,
+    exclusions TEXT,
+    annual_limit DECIMAL(12, 2),
+    per_visit_limit DECIMAL(12, 2),
+    deductible DECIMAL(12, 2) DEFAULT 0,
+    co_pay_percentage DECIMAL(5, 2) DEFAULT 0,
+    pre_authorization_required BOOLEAN DEFAULT FALSE,
+    waiting_period_days INTEGER DEFAULT 0,
+    network VARCHAR(100),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS members (
+    member_id VARCHAR(100) PRIMARY KEY,
+    full_name VARCHAR(255) NOT NULL,
+    date_of_birth DATE,
+    policy_id VARCHAR(50) REFERENCES policies (policy_id),
+    status VARCHAR(20) DEFAULT 'ACTIVE',
+    policy_balance DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS members_policy_idx ON members (policy_id);
+
+CREATE TABLE IF NOT EXISTS emails (
+    message_id VARCHAR(255) PRIMARY KEY,
+    sender VARCHAR(255),
+    subject TEXT,
+    date TIMESTAMP,
+    body_snippet TEXT,
+    attachments JSONB,
+    status VARCHAR(20) DEFAULT 'new',
+    content_hash CHAR(64),
+    -- Set when the email's claim commits, cleared once Gmail has marked it read
+    read_pending BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS emails_content_hash_idx ON emails (content_hash);
+CREATE INDEX IF NOT EXISTS emails_read_pending_idx ON emails (message_id) WHERE read_pending;
+
+-- Partitioned by month on created_at. The application creates the monthly partitions
+-- (claims_YYYY_MM) a few months ahead on startup; anything outside them lands in claims_default.
+CREATE TABLE IF NOT EXISTS claims (
+    claim_id SERIAL,
+    member_id VARCHAR(100),
+    diagnosis TEXT,
+    requested_service TEXT,
+    claim_amount DECIMAL(10, 2),
+    adjudication_reasoning TEXT,
+    status VARCHAR(20) DEFAULT 'NEW',
+    content_hash CHAR(64),
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (claim_id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE IF NOT EXISTS claims_default PARTITION OF claims DEFAULT;
+
+CREATE INDEX IF NOT EXISTS claims_member_created_idx ON claims (member_id, created_at, claim_id);
+CREATE INDEX IF NOT EXISTS claims_status_created_idx ON claims (status, created_at, claim_id);
+CREATE INDEX IF NOT EXISTS claims_created_idx ON claims (created_at, claim_id);
+CREATE INDEX IF NOT EXISTS claims_content_hash_idx ON claims (content_hash);
+
+-- Claims and amounts per day, policy and status; policy_id is '' for unknown members.
+-- Statement-level triggers on claims (see claims_store.py) append each change to
+-- claim_daily_deltas, which the application periodically folds into claim_daily_totals.
+CREATE TABLE IF NOT EXISTS claim_daily_totals (
+    day DATE NOT NULL,
+    policy_id VARCHAR(50) NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    claim_count BIGINT NOT NULL DEFAULT 0,
+    total_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, policy_id, status)
+);
+
+CREATE TABLE IF NOT EXISTS claim_daily_deltas (
+    day DATE NOT NULL,
+    policy_id VARCHAR(50) NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    claim_count BIGINT NOT NULL,
+    total_amount DECIMAL(14, 2) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    sync_key VARCHAR(255) PRIMARY KEY,
+    history_id BIGINT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS claim_jobs (
+    job_id BIGSERIAL PRIMARY KEY,
+    message_id VARCHAR(255) UNIQUE NOT NULL,
+    payload JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'NEW',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    lease_token VARCHAR(64),
+    lease_expires_at TIMESTAMP,
+    claim_id INTEGER,
+    last_error TEXT,
+    marked_read BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS claim_jobs_ready_idx ON claim_jobs (available_at, job_id)
+    WHERE status IN ('NEW', 'FAILED');
+CREATE INDEX IF NOT EXISTS claim_jobs_lease_idx ON claim_jobs (lease_expires_at)
+    WHERE status = 'IN_PROGRESS';
+CREATE INDEX IF NOT EXISTS claim_jobs_unread_idx ON claim_jobs (job_id)
+    WHERE status = 'PROCESSED' AND NOT marked_read;
+
+CREATE TABLE IF NOT EXISTS adjudication_cache (
+    cache_key CHAR(64) PRIMARY KEY,
+    policy_id VARCHAR(100),
+    policy_version CHAR(64),
+    decision VARCHAR(20),
+    reasoning TEXT,
+    created_at DOUBLE PRECISION,
+    last_used_at DOUBLE PRECISION,
+    tier VARCHAR(10)
+);
+
+CREATE INDEX IF NOT EXISTS adjudication_cache_policy_idx ON adjudication_cache (policy_id);
+CREATE INDEX IF NOT EXISTS adjudication_cache_last_used_idx ON adjudication_cache (last_used_at);
@@ -0,0 +1,340 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from metrics import metrics
+
+# Only definitive decisions are worth reusing; PENDING means the LLM call failed
+CACHEABLE_DECISIONS = ('APPROVED', 'DENIED')
+
+
+def normalise(text):
+    text = re.sub(r'[^a-z0-9]+', ' ', str(text or '').lower())
+    return ' '.join(text.split())
+
+
+def cache_key(diagnosis, requested_service, policy_id):
+    raw = '|'.join([normalise(diagnosis), normalise(requested_service), str(policy_id)])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def policy_version(policy_context):
+    """Fingerprint of the policy row; any change to the row gives a new version."""
+    if policy_context is None:
+        return None
+    raw = json.dumps(policy_context, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class PostgresCacheBackend:
+    def __init__(self, pool=None):
+        from db_pool import get_pool
+        self.pool = pool or get_pool()
+        self.create_table()
+    
+    def create_table(self):
+        from db_pool import add_missing
+        with self.pool.cursor() as cur:
+            # tier is the model tier that decided; fast-model decisions are not reused for high-value claims
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS adjudication_cache (
+                    cache_key CHAR(64) PRIMARY KEY,
+                    policy_id VARCHAR(100),
+                    policy_version CHAR(64),
+                    decision VARCHAR(20),
+                    reasoning TEXT,
+                    created_at DOUBLE PRECISION,
+                    last_used_at DOUBLE PRECISION,
+                    tier VARCHAR(10)
+                )
+            """)
+        add_missing(self.pool, 'adjudication_cache', columns={
+            # Tables created before decisions recorded their tier
+            'tier': "ALTER TABLE adjudication_cache ADD COLUMN IF NOT EXISTS tier VARCHAR(10)",
+        }, indexes={
+            'adjudication_cache_policy_idx': "CREATE INDEX IF NOT EXISTS adjudication_cache_policy_idx ON adjudication_cache (policy_id)",
+            'adjudication_cache_last_used_idx': "CREATE INDEX IF NOT EXISTS adjudication_cache_last_used_idx ON adjudication_cache (last_used_at)",
+        })
+    
+    def get(self, key):
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                UPDATE adjudication_cache SET last_used_at = %s
+                WHERE cache_key = %s
+                RETURNING policy_version, decision, reasoning, created_at, tier
+            """, (time.time(), key))
+            row = cur.fetchone()
+            if row:
+                return {'policy_version': row[0], 'decision': row[1], 'reasoning': row[2], 'created_at': row[3], 'tier': row[4]}
+            return None
+    
+    def put(self, key, policy_id, entry):
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                INSERT INTO adjudication_cache (cache_key, policy_id, policy_version, decision, reasoning, created_at, last_used_at, tier)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    policy_version = EXCLUDED.policy_version,
+                    decision = EXCLUDED.decision,
+                    reasoning = EXCLUDED.reasoning,
+                    created_at = EXCLUDED.created_at,
+                    last_used_at = EXCLUDED.last_used_at,
+                    tier = EXCLUDED.tier
+            """, (key, str(policy_id), entry['policy_version'], entry['decision'], entry['reasoning'],
+                  entry['created_at'], entry['created_at'], entry.get('tier')))
+    
+    def delete(self, key):
+        with self.pool.cursor() as cur:
+            cur.execute("DELETE FROM adjudication_cache WHERE cache_key = %s", (key,))
+    
+    def invalidate_policy(self, policy_id, current_version=None):
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                DELETE FROM adjudication_cache
+                WHERE policy_id = %s AND policy_version IS DISTINCT FROM %s
+            """, (str(policy_id), current_version))
+            return cur.rowcount
+    
+    def prune(self, max_entries, ttl):
+        """Drop expired entries, then the least recently used ones beyond max_entries."""
+        with self.pool.cursor() as cur:
+            removed = 0
+            if ttl:
+                cur.execute("DELETE FROM adjudication_cache WHERE created_at < %s", (time.time() - ttl,))
+                removed += cur.rowcount
+            if max_entries:
+                cur.execute("""
+                    DELETE FROM adjudication_cache WHERE cache_key IN (
+                        SELECT cache_key FROM adjudication_cache
+                        ORDER BY last_used_at DESC
+                        OFFSET %s
+                    )
+                """, (max_entries,))
+                removed += cur.rowcount
+            return removed
+
+
+class DiskCacheBackend:
+    """Same contract as PostgresCacheBackend, stored in a local SQLite file."""
+    
+    def __init__(self, path='adjudication_cache.sqlite3'):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS adjudication_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    policy_id TEXT,
+                    policy_version TEXT,
+                    decision TEXT,
+                    reasoning TEXT,
+                    created_at REAL,
+                    last_used_at REAL
+                )
+            """)
+            # Files written before model routing have no tier column
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(adjudication_cache)")}
+            if 'tier' not in columns:
+                self.conn.execute("ALTER TABLE adjudication_cache ADD COLUMN tier TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS adjudication_cache_policy_idx ON adjudication_cache (policy_id)")
+    
+    def get(self, key):
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT policy_version, decision, reasoning, created_at, tier FROM adjudication_cache WHERE cache_key = ?",
+                (key,)
+            ).fetchone()
+            if row:
+                self.conn.execute("UPDATE adjudication_cache SET last_used_at = ? WHERE cache_key = ?", (time.time(), key))
+                return {'policy_version': row[0], 'decision': row[1], 'reasoning': row[2], 'created_at': row[3], 'tier': row[4]}
+            return None
+    
+    def put(self, key, policy_id, entry):
+        with self.lock, self.conn:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO adjudication_cache
+                    (cache_key, policy_id, policy_version, decision, reasoning, created_at, last_used_at, tier)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (key, str(policy_id), entry['policy_version'], entry['decision'], entry['reasoning'],
+                  entry['created_at'], entry['created_at'], entry.get('tier')))
+    
+    def delete(self, key):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM adjudication_cache WHERE cache_key = ?", (key,))
+    
+    def invalidate_policy(self, policy_id, current_version=None):
+        with self.lock, self.conn:
+            return self.conn.execute(
+                "DELETE FROM adjudication_cache WHERE policy_id = ? AND policy_version IS NOT ?",
+                (str(policy_id), current_version)
+            ).rowcount
+    
+    def prune(self, max_entries, ttl):
+        with self.lock, self.conn:
+            removed = 0
+            if ttl:
+                removed += self.conn.execute(
+                    "DELETE FROM adjudication_cache WHERE created_at < ?", (time.time() - ttl,)
+                ).rowcount
+            if max_entries:
+                removed += self.conn.execute("""
+                    DELETE FROM adjudication_cache WHERE cache_key IN (
+                        SELECT cache_key FROM adjudication_cache
+                        ORDER BY last_used_at DESC
+                        LIMIT -1 OFFSET ?
+                    )
+                """, (max_entries,)).rowcount
+            return removed
+
+
+class AdjudicationCache:
+    """LRU/TTL cache of clinical decisions in front of a persistent backend.
+
+    Entries remember the version of the policy row they were decided against, so a
+    changed policy turns every older entry for it into a miss and removes them.
+    """
+    
+    def __init__(self, backend, memory_size=1000, max_entries=100000, ttl=7 * 24 * 3600, prune_every=500):
+        self.backend = backend
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prune_every = prune_every
+        
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'invalidated': 0, 'evicted': 0}
+    
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+                self._stats['evicted'] += 1
+    
+    def _forget(self, key):
+        with self._lock:
+            self._memory.pop(key, None)
+    
+    def _count(self, stat, n=1):
+        with self._lock:
+            self._stats[stat] += n
+        if stat in ('hits', 'misses'):
+            metrics.inc('claims_adjudication_cache_lookups_total', n, result='hit' if stat == 'hits' else 'miss')
+    
+    def get(self, diagnosis, requested_service, policy_id, version):
+        key = cache_key(diagnosis, requested_service, policy_id)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        if entry is None:
+            entry = self.backend.get(key)
+        
+        if entry is None:
+            self._count('misses')
+            return None
+        
+        if self.ttl and time.time() - entry['created_at'] > self.ttl:
+            self._forget(key)
+            self.backend.delete(key)
+            self._count('expired')
+            self._count('misses')
+            return None
+        
+        if entry['policy_version'] != version:
+            self._forget(key)
+            removed = self.backend.invalidate_policy(policy_id, version)
+            self._count('invalidated', max(removed or 0, 1))
+            self._count('misses')
+            return None
+        
+        self._remember(key, entry)
+        self._count('hits')
+        adjudication = {'decision': entry['decision'], 'reasoning': entry['reasoning']}
+        if entry.get('tier'):
+            adjudication['tier'] = entry['tier']
+        return adjudication
+    
+    def put(self, diagnosis, requested_service, policy_id, version, adjudication):
+        if adjudication.get('decision') not in CACHEABLE_DECISIONS:
+            return
+        key = cache_key(diagnosis, requested_service, policy_id)
+        entry = {
+            'policy_version': version,
+            'decision': adjudication['decision'],
+            'reasoning': adjudication.get('reasoning', ''),
+            'created_at': time.time(),
+            'tier': adjudication.get('tier')
+        }
+        self.backend.put(key, policy_id, entry)
+        self._remember(key, entry)
+        
+        with self._lock:
+            self._puts += 1
+            prune = self.prune_every and self._puts % self.prune_every == 0
+        if prune:
+            self._count('evicted', self.backend.prune(self.max_entries, self.ttl) or 0)
+    
+    def invalidate_policy(self, policy_id):
+        with self._lock:
+            self._memory.clear()
+        removed = self.backend.invalidate_policy(policy_id)
+        self._count('invalidated', removed or 0)
+    
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
+
+
+class CachedAdjudicator:
+    """Drop-in stand-in for OpenAIEmailAgent.clinical_adjudication that consults the cache first."""
+    
+    def __init__(self, agent, cache):
+        self.agent = agent
+        self.cache = cache
+    
+    def clinical_adjudication(self, diagnosis, requested_service, policy_context=None, claim_amount=None):
+        if not policy_context or policy_context.get('policy_id') is None:
+            return self.agent.clinical_adjudication(diagnosis, requested_service, policy_context, claim_amount)
+        
+        policy_id = policy_context['policy_id']
+        version = policy_version(policy_context)
+        cached = self.cache.get(diagnosis, requested_service, policy_id, version)
+        if cached is not None and not self._needs_large_model(cached, claim_amount):
+            return cached
+        
+        adjudication = self.agent.clinical_adjudication(diagnosis, requested_service, policy_context, claim_amount)
+        self.cache.put(diagnosis, requested_service, policy_id, version, adjudication)
+        return adjudication
+    
+    def _needs_large_model(self, cached, claim_amount):
+        # A fast-model decision is not reused for a claim the router would send to the large model
+        router = getattr(self.agent, 'router', None)
+        return cached.get('tier') == 'fast' and router is not None and router.high_amount(claim_amount)
+
+
+def cache_from_env(pool=None):
+    """Build the cache selected by ADJUDICATION_CACHE (postgres, disk or off)."""
+    kind = os.getenv('ADJUDICATION_CACHE', 'off').lower()
+    if kind == 'postgres':
+        backend = PostgresCacheBackend(pool)
+    elif kind == 'disk':
+        backend = DiskCacheBackend(os.getenv('ADJUDICATION_CACHE_PATH', 'adjudication_cache.sqlite3'))
+    else:
+        return None
+    return AdjudicationCache(
+        backend,
+        memory_size=int(os.getenv('ADJUDICATION_CACHE_MEMORY_SIZE', '1000')),
+        max_entries=int(os.getenv('ADJUDICATION_CACHE_MAX_ENTRIES', '100000')),
+        ttl=float(os.getenv('ADJUDICATION_CACHE_TTL', str(7 * 24 * 3600)))
+    )
@@ -0,0 +1,220 @@
+import base64
+import hashlib
+import html
+import os
+import re
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from metrics import metrics
+
+
+# Base64 characters decoded per step; a multiple of 4 so every chunk decodes on its own
+CHUNK_CHARS = 256 * 1024
+
+# Metadata kept in the emails.attachments column; content stays out of the database
+METADATA_FIELDS = ('filename', 'mime_type', 'size', 'sha256', 'status', 'text_chars')
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def pdf_reader():
+    """pypdf's PdfReader, or None when pypdf is not installed; imported on first use as it is slow to load."""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return None
+    return PdfReader
+
+
+def html_to_text(markup):
+    markup = re.sub(r'(?is)<(script|style)\b.*?</\1>', ' ', markup)
+    markup = re.sub(r'(?i)<br\s*/?>|</p>|</div>|</tr>|</li>', '\n', markup)
+    return html.unescape(re.sub(r'<[^>]+>', ' ', markup))
+
+
+def spool(encoded, max_bytes, spool_bytes):
+    """Decode base64url attachment data into a SpooledTemporaryFile, a chunk at a time.
+
+    Returns (file, size, sha256). Up to ``spool_bytes`` stay in memory, the rest goes
+    to disk; more than ``max_bytes`` raises AttachmentTooLarge.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        for start in range(0, len(encoded), CHUNK_CHARS):
+            piece = encoded[start:start + CHUNK_CHARS]
+            chunk = base64.urlsafe_b64decode(piece + '=' * (-len(piece) % 4))
+            size += len(chunk)
+            if size > max_bytes:
+                raise AttachmentTooLarge(f'over {max_bytes} bytes')
+            digest.update(chunk)
+            out.write(chunk)
+    except Exception:
+        out.close()
+        raise
+    out.seek(0)
+    return out, size, digest.hexdigest()
+
+
+def _is_pdf(mime_type, name):
+    return mime_type == 'application/pdf' or name.endswith('.pdf')
+
+
+def _is_text(mime_type, name):
+    return mime_type.startswith('text/') or name.endswith(('.txt', '.csv', '.htm', '.html'))
+
+
+def supported(mime_type, filename):
+    """Whether extract_text can read this type; PDFs need pypdf installed."""
+    mime_type = (mime_type or '').lower()
+    name = (filename or '').lower()
+    return (_is_pdf(mime_type, name) and pdf_reader() is not None) or _is_text(mime_type, name)
+
+
+def extract_text(file, mime_type, filename, max_chars):
+    """Plain text of an attachment, at most ``max_chars``; None when the type is not supported."""
+    mime_type = (mime_type or '').lower()
+    name = (filename or '').lower()
+    if _is_pdf(mime_type, name):
+        PdfReader = pdf_reader()
+        if PdfReader is None:
+            return None
+        text = []
+        length = 0
+        for page in PdfReader(file).pages:
+            page_text = page.extract_text() or ''
+            text.append(page_text)
+            length += len(page_text)
+            if length >= max_chars:
+                break
+        return '\n'.join(text)[:max_chars]
+    if _is_text(mime_type, name):
+        text = file.read(max_chars * 4).decode('utf-8', errors='replace')
+        if 'html' in mime_type or name.endswith(('.htm', '.html')):
+            text = html_to_text(text)
+        return text[:max_chars]
+    return None
+
+
+def _extract(file, attachment, max_chars):
+    """Runs on the worker pool; always closes the spooled file."""
+    try:
+        with metrics.span('claims_attachment_extract_duration_seconds', mime_type=attachment.get('mime_type') or 'unknown'):
+            return extract_text(file, attachment.get('mime_type'), attachment.get('filename'), max_chars)
+    finally:
+        file.close()
+
+
+def compact(attachment):
+    return {key: attachment[key] for key in METADATA_FIELDS if key in attachment}
+
+
+class AttachmentProcessor:
+    """Downloads attachments into size-capped spooled files and extracts their text on a worker pool.
+
+    Downloads go through the Gmail client one at a time (its HTTP transport is not
+    thread-safe), while PDF and text extraction run on ``workers`` threads with at
+    most ``2 * workers`` files waiting, so memory stays bounded however large a
+    batch is. Gmail returns an attachment as one base64 field, so that string is
+    held while it is decoded, but the decoded bytes go straight to the spooled file
+    and attachments over ``max_bytes`` are skipped from their part size without
+    being downloaded at all. Extracted text is appended to the email body, where
+    the template extractor and the LLM see it. Only compact metadata (name, type,
+    size, SHA-256, status) is kept in ``email['attachments']``.
+    """
+    
+    def __init__(self, gmail, max_bytes=None, spool_bytes=None, max_text_chars=None, workers=None):
+        self.gmail = gmail
+        self.max_bytes = max_bytes or int(os.getenv('ATTACHMENT_MAX_BYTES', str(20 * 1024 * 1024)))
+        self.spool_bytes = spool_bytes or int(os.getenv('ATTACHMENT_SPOOL_BYTES', str(1024 * 1024)))
+        self.max_text_chars = max_text_chars or int(os.getenv('ATTACHMENT_MAX_TEXT_CHARS', '8000'))
+        self.workers = workers or int(os.getenv('ATTACHMENT_WORKERS', '4'))
+        self.enabled = os.getenv('ATTACHMENT_TEXT', 'on').lower() != 'off'
+        self._executor = None
+    
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='attachment')
+        return self._executor
+    
+    def _download(self, email, attachment):
+        """Spooled file with the attachment's bytes, or None with attachment['status'] set."""
+        # Images and other types there is no text extractor for are not downloaded at all
+        if not supported(attachment.get('mime_type'), attachment.get('filename')):
+            attachment.pop('data', None)
+            attachment['status'] = 'unsupported'
+            return None
+        if attachment.get('size', 0) > self.max_bytes:
+            attachment['status'] = 'too_large'
+            return None
+        try:
+            encoded = attachment.pop('data', None)
+            if encoded is None:
+                if not attachment.get('attachment_id'):
+                    attachment['status'] = 'missing'
+                    return None
+                encoded = self.gmail.get_attachment_data(email['message_id'], attachment['attachment_id'])
+            file, attachment['size'], attachment['sha256'] = spool(encoded, self.max_bytes, self.spool_bytes)
+            return file
+        except AttachmentTooLarge:
+            attachment['status'] = 'too_large'
+        except Exception as e:
+            print(f"Failed to download attachment {attachment.get('filename')} of {email['message_id']}: {e}")
+            attachment['status'] = 'failed'
+        return None
+    
+    def _collect(self, email, attachment, future, texts):
+        try:
+            text = future.result()
+            if text is None:
+                attachment['status'] = 'unsupported'
+            elif not text.strip():
+                attachment['status'] = 'empty'
+            else:
+                attachment['status'] = 'extracted'
+                attachment['text_chars'] = len(text)
+                texts[email['message_id']].append(f"Attachment {attachment.get('filename')}:\n{text.strip()}")
+        except Exception as e:
+            print(f"Failed to read attachment {attachment.get('filename')} of {email['message_id']}: {e}")
+            attachment['status'] = 'failed'
+        metrics.inc('claims_attachments_total', status=attachment['status'])
+    
+    def process(self, emails):
+        """Fill in attachment text and compact metadata for a batch of parsed emails, in place."""
+        if not self.enabled:
+            for email in emails:
+                email['attachments'] = [compact(attachment) for attachment in email.get('attachments', [])]
+            return emails
+        
+        texts = {email['message_id']: [] for email in emails}
+        pending = deque()
+        for email in emails:
+            for attachment in email.get('attachments', []):
+                file = self._download(email, attachment)
+                if file is None:
+                    metrics.inc('claims_attachments_total', status=attachment['status'])
+                    continue
+                pending.append((email, attachment, self.executor.submit(_extract, file, attachment, self.max_text_chars)))
+                # Bound how many downloaded files wait for a worker at once
+                while len(pending) > 2 * self.workers:
+                    self._collect(*pending.popleft(), texts)
+        while pending:
+            self._collect(*pending.popleft(), texts)
+        
+        for email in emails:
+            if texts[email['message_id']]:
+                email['body'] = '\n\n'.join([email.get('body') or ''] + texts[email['message_id']])
+            email['attachments'] = [compact(attachment) for attachment in email.get('attachments', [])]
+        return emails
+    
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
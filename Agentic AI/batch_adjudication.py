@@ -0,0 +1,297 @@
+import json
+import os
+import time
+import uuid
+from adjudication_cache import policy_version
+from batch_writer import BatchWriter
+from dedupe import content_hash
+from gmail_reader import chunks
+from label_updates import LabelUpdateBuffer
+from metrics import metrics
+
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+def _response_dict(response):
+    if isinstance(response, dict):
+        return response
+    if hasattr(response, 'model_dump'):
+        return response.model_dump()
+    message = response.choices[0].message
+    return {'choices': [{'message': {'content': message.content, 'refusal': getattr(message, 'refusal', None)}}]}
+
+
+def _message(record):
+    """(content, refusal) of a batch output record, or (None, None) when the request failed."""
+    response = record.get('response')
+    if record.get('error') or not response or response.get('status_code') != 200:
+        return None, None
+    message = response['body']['choices'][0]['message']
+    return message.get('content'), message.get('refusal')
+
+
+class OpenAIBatchExecutor:
+    """Submits batch input files to the OpenAI Batch API."""
+    
+    def __init__(self, client=None):
+        if client is None:
+            import openai
+            client = openai
+        self.client = client
+    
+    def submit(self, input_path):
+        with open(input_path, 'rb') as f:
+            batch_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h'
+        )
+        return batch.id
+    
+    def status(self, job_id):
+        return self.client.batches.retrieve(job_id).status
+    
+    def results(self, job_id):
+        batch = self.client.batches.retrieve(job_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    yield json.loads(line)
+
+
+class LocalBatchExecutor:
+    """In-process stand-in for the Batch API, for tests and offline runs.
+
+    Each request line is sent through ``create`` (any chat.completions.create
+    compatible callable) and the output file uses the Batch API record format.
+    """
+    
+    def __init__(self, create, workdir='batches'):
+        self.create = create
+        self.workdir = workdir
+        self._outputs = {}
+    
+    def submit(self, input_path):
+        job_id = f"local_{uuid.uuid4().hex[:12]}"
+        output_path = os.path.join(self.workdir, f"{job_id}_output.jsonl")
+        with open(input_path) as src, open(output_path, 'w') as out:
+            for line in src:
+                request = json.loads(line)
+                try:
+                    body = _response_dict(self.create(**request['body']))
+                    record = {'custom_id': request['custom_id'], 'response': {'status_code': 200, 'body': body}, 'error': None}
+                except Exception as e:
+                    record = {'custom_id': request['custom_id'], 'response': None, 'error': {'message': str(e)}}
+                out.write(json.dumps(record, default=str) + '\n')
+        self._outputs[job_id] = output_path
+        return job_id
+    
+    def status(self, job_id):
+        return 'completed'
+    
+    def results(self, job_id):
+        with open(self._outputs[job_id]) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+class BatchAdjudicator:
+    """Backlog mode: extraction and adjudication go out as batch jobs instead of one call per email.
+
+    Phase one batches extraction (or combined extract-and-adjudicate) requests,
+    phase two batches adjudication for the claims that still need it, and the
+    decisions are then written with a single BatchWriter flush.
+    """
+    
+    def __init__(self, processor, executor, email_db, gmail=None, workdir=None, poll_interval=None):
+        self.processor = processor
+        self.executor = executor
+        self.email_db = email_db
+        self.gmail = gmail
+        self.workdir = workdir or os.getenv('BATCH_WORKDIR', 'batches')
+        self.poll_interval = poll_interval or float(os.getenv('BATCH_POLL_INTERVAL', '30'))
+        os.makedirs(self.workdir, exist_ok=True)
+    
+    def _write_requests(self, name, requests):
+        path = os.path.join(self.workdir, f"{name}_{int(time.time())}_{uuid.uuid4().hex[:6]}.jsonl")
+        with open(path, 'w') as f:
+            for custom_id, body in requests:
+                f.write(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': body}) + '\n')
+        return path
+    
+    def run_batch(self, name, requests):
+        """Submit requests as one job, wait for it, and return {custom_id: (content, refusal)}."""
+        if not requests:
+            return {}
+        job_id = self.executor.submit(self._write_requests(name, requests))
+        print(f"Submitted {name} batch {job_id} with {len(requests)} requests")
+        
+        status = self.executor.status(job_id)
+        while status not in TERMINAL_STATUSES:
+            time.sleep(self.poll_interval)
+            status = self.executor.status(job_id)
+        if status != 'completed':
+            print(f"Batch {job_id} finished with status {status}; collecting partial results")
+        
+        results = {}
+        for record in self.executor.results(job_id):
+            body = (record.get('response') or {}).get('body') or {}
+            metrics.record_usage(body.get('usage'), operation=f'batch_{name}', model=body.get('model', 'unknown'))
+            results[record['custom_id']] = _message(record)
+        return results
+    
+    def _extraction_phase(self, emails):
+        processor = self.processor
+        agent = processor.agent
+        claims = {}
+        requests = []
+        if processor.combined_llm_call:
+            processor.prefetch_members_for(emails)
+        for email in emails:
+            message_id = email['message_id']
+            claim_data = processor.extractor.extract_claim_data(email['subject'], email['body'])
+            if claim_data and claim_data['confidence'] >= processor.template_min_confidence:
+                claims[message_id] = claim_data
+                continue
+            
+            if processor.combined_llm_call:
+                member_id = processor.extractor.find_member_id(email['subject'], email['body'])
+                member = processor.members.get_member(member_id) if member_id else None
+                if member:
+                    policy_context = processor.policies.get_policy(member['policy_id'])
+                    body = agent.extract_and_adjudicate_request(email['subject'], email['body'], policy_context)
+                    requests.append((f"combined:{message_id}:{member['policy_id']}", body))
+                    continue
+            requests.append((f"extract:{message_id}", agent.extraction_request(email['subject'], email['body'])))
+        
+        results = self.run_batch('extract', requests)
+        for custom_id, (content, refusal) in results.items():
+            kind, message_id = custom_id.split(':', 2)[:2]
+            if kind == 'combined':
+                result = agent.parse_extract_and_adjudicate(content, refusal)
+                if not result:
+                    continue
+                claim_data, adjudication = result
+                claim_data['adjudication'] = adjudication
+                claim_data['policy_id'] = custom_id.split(':', 2)[2]
+            else:
+                claim_data = agent.parse_extraction(content)
+            claims[message_id] = claim_data
+        
+        claims = {message_id: claim for message_id, claim in
+                  ((message_id, processor.normalise(claim)) for message_id, claim in claims.items()) if claim}
+        # Answered without a usable claim; requests that failed or got no result are retried by a later run
+        answered = {custom_id.split(':', 2)[1] for custom_id, message in results.items() if message != (None, None)}
+        return claims, answered - set(claims)
+    
+    def _adjudication_phase(self, claims):
+        processor = self.processor
+        cache = processor.adjudication_cache
+        members = {}
+        adjudications = {}
+        requests = []
+        policies = {}
+        processor.prefetch_members(claim_data['member_id'] for claim_data in claims.values())
+        for message_id, claim_data in claims.items():
+            member, denial = processor.validate(claim_data)
+            members[message_id] = member
+            if denial:
+                adjudications[message_id] = {'decision': 'DENIED', 'reasoning': denial, 'final': True}
+                continue
+            
+            if claim_data.get('adjudication') and str(claim_data.get('policy_id')) == str(member['policy_id']):
+                adjudications[message_id] = claim_data['adjudication']
+                continue
+            
+            policy_context = processor.policies.get_policy(member['policy_id'])
+            policies[message_id] = policy_context
+            if cache and policy_context:
+                cached = cache.get(claim_data['diagnosis'], claim_data['requested_service'],
+                                   member['policy_id'], policy_version(policy_context))
+                if cached:
+                    adjudications[message_id] = cached
+                    continue
+            body = processor.agent.adjudication_request(claim_data['diagnosis'], claim_data['requested_service'], policy_context)
+            requests.append((f"adjudicate:{message_id}", body))
+        
+        for custom_id, (content, _) in self.run_batch('adjudicate', requests).items():
+            message_id = custom_id.split(':', 1)[1]
+            adjudication = processor.agent.parse_adjudication(content)
+            adjudications[message_id] = adjudication
+            claim_data, policy_context = claims[message_id], policies.get(message_id)
+            if cache and policy_context:
+                cache.put(claim_data['diagnosis'], claim_data['requested_service'],
+                          members[message_id]['policy_id'], policy_version(policy_context), adjudication)
+        
+        return members, adjudications
+    
+    def run(self, emails):
+        resubmitted = self.processor.find_duplicates(emails)
+        new_message_ids = self.email_db.insert_emails(emails)
+        # Emails from a window whose batch job failed or expired are stored but have no claim; take them again
+        resumed = self.email_db.unfinished_ids([
+            email['message_id'] for email in emails if email['message_id'] not in new_message_ids
+        ])
+        new_message_ids |= resumed
+        duplicates = [email['message_id'] for email in emails
+                      if email['message_id'] in new_message_ids and email['message_id'] in resubmitted]
+        emails = [email for email in emails
+                  if email['message_id'] in new_message_ids and email['message_id'] not in resubmitted]
+        print(f"Backlog: {len(emails)} new emails ({len(resumed)} from an earlier, unfinished run), "
+              f"{len(duplicates)} resubmissions of earlier claims")
+        
+        claims, unextractable = self._extraction_phase(emails)
+        self.email_db.mark_unextractable(unextractable)
+        members, adjudications = self._adjudication_phase(claims)
+        
+        # Apply balances in email order so earlier approvals count against later claims
+        writer = BatchWriter(self.processor.pool, member_cache=self.processor.member_cache, email_db=self.email_db)
+        counts = {}
+        decided = []
+        for email in emails:
+            message_id = email['message_id']
+            if message_id not in claims or message_id not in adjudications:
+                continue
+            claim_data, member, adjudication = claims[message_id], members[message_id], adjudications[message_id]
+            claim_data['content_hash'] = email.get('content_hash') or content_hash(email)
+            if adjudication.get('final'):
+                decision, reasoning = adjudication['decision'], adjudication['reasoning']
+            else:
+                member, denial = self.processor.validate_against(member, claim_data, writer.pending_deduction(member['member_id']))
+                if denial:
+                    decision, reasoning = 'DENIED', denial
+                else:
+                    decision, reasoning = self.processor.decide(member, adjudication)
+            writer.add_claim(claim_data, decision, reasoning)
+            decided.append(message_id)
+            counts[decision] = counts.get(decision, 0) + 1
+        
+        for message_id in decided:
+            writer.mark_read(message_id)
+        _, claim_ids = writer.flush()
+        print(f"Stored {len(claim_ids)} claims: " + ', '.join(f"{n} {status}" for status, n in sorted(counts.items())))
+        
+        if duplicates:
+            counts['DUPLICATE'] = len(duplicates)
+        if self.gmail is not None:
+            labels = LabelUpdateBuffer(self.gmail, self.email_db)
+            labels.add(decided + duplicates + sorted(unextractable))
+            labels.flush()
+        return counts
+
+
+def run_backlog(emails, gmail, email_db, processor):
+    """Run the backlog BATCH_WINDOW emails at a time, so a deep backlog never sits in memory at once."""
+    if os.getenv('BATCH_EXECUTOR', 'openai').lower() == 'local':
+        executor = LocalBatchExecutor(processor.agent.client.chat.completions.create, os.getenv('BATCH_WORKDIR', 'batches'))
+    else:
+        executor = OpenAIBatchExecutor()
+    adjudicator = BatchAdjudicator(processor, executor, email_db, gmail)
+    counts = {}
+    for window in chunks(emails, int(os.getenv('BATCH_WINDOW', '10000'))):
+        for decision, n in adjudicator.run(window).items():
+            counts[decision] = counts.get(decision, 0) + n
+    return counts
@@ -0,0 +1,100 @@
+from collections import defaultdict
+from db_pool import get_pool
+from db_manager import EmailDB
+from claims_db import ClaimsDB
+from members_db import MembersDB
+from metrics import metrics
+
+class BatchWriter:
+    """Collects the emails and decided claims of one fetch window and writes them together.
+
+    ``flush`` stores everything in a single transaction: one multi-row INSERT for
+    emails, one for claims and one UPDATE for all balance deductions. Windows with
+    at least ``copy_threshold`` rows use COPY instead, which is faster for backfills
+    but does not report claim_ids. Messages passed to ``mark_read`` are marked
+    processed and flagged read_pending in the same transaction.
+    """
+    
+    def __init__(self, pool=None, copy_threshold=5000, member_cache=None, email_db=None):
+        self.pool = pool or get_pool()
+        # Told about every deduction once it is committed
+        self.member_cache = member_cache
+        # Passing the caller's EmailDB skips re-running its schema setup for every window
+        self.email_db = email_db or EmailDB(self.pool)
+        self.claims_db = ClaimsDB(self.pool)
+        self.members_db = MembersDB(self.pool)
+        self.copy_threshold = copy_threshold
+        self._emails = []
+        self._claims = []
+        self._deductions = defaultdict(float)
+        self._read = []
+    
+    def add_email(self, email):
+        self._emails.append(email)
+    
+    def add_claim(self, claim_data, decision, reasoning):
+        self._claims.append((
+            claim_data['member_id'],
+            claim_data['diagnosis'],
+            claim_data['requested_service'],
+            claim_data['claim_amount'],
+            decision,
+            reasoning,
+            claim_data.get('content_hash')
+        ))
+        if decision == 'APPROVED':
+            self._deductions[claim_data['member_id']] += claim_data['claim_amount']
+    
+    def mark_read(self, message_id):
+        """Flag a message for marking read in Gmail in the same transaction as the window's claims."""
+        self._read.append(message_id)
+    
+    def pending_deduction(self, member_id):
+        """Amount already approved for this member in the window but not yet written."""
+        return self._deductions.get(member_id, 0.0)
+    
+    def __len__(self):
+        return len(self._emails) + len(self._claims)
+    
+    def flush(self):
+        """Write the window; returns (new message_ids, claim_ids)."""
+        use_copy = len(self._emails) >= self.copy_threshold or len(self._claims) >= self.copy_threshold
+        claim_ids = [None] * len(self._claims)
+        statuses = [claim[4] for claim in self._claims]
+        with metrics.span('claims_stage_duration_seconds', stage='flush'), self.pool.transaction():
+            if use_copy:
+                inserted = self.email_db.copy_emails(self._emails)
+            else:
+                inserted = self.email_db.insert_emails(self._emails)
+            
+            # Balances may have moved since validation; members that can no longer cover the
+            # window's total fall back to per-claim conditional commits below
+            debited = self.members_db.deduct_many(dict(self._deductions))
+            recheck = [i for i, claim in enumerate(self._claims) if claim[4] == 'APPROVED' and claim[0] not in debited]
+            skip = set(recheck)
+            bulk = [i for i in range(len(self._claims)) if i not in skip]
+            
+            if use_copy:
+                self.claims_db.copy_claims([self._claims[i] for i in bulk])
+            else:
+                for i, claim_id in zip(bulk, self.claims_db.insert_claims([self._claims[i] for i in bulk])):
+                    claim_ids[i] = claim_id
+            for i in recheck:
+                claim_ids[i], statuses[i], _ = self.claims_db.commit_claim(*self._claims[i])
+            self.email_db.mark_processed(self._read)
+        
+        for status in statuses:
+            metrics.inc('claims_processed_total', status=status)
+        
+        if self.member_cache:
+            for member_id in debited:
+                self.member_cache.deduct(member_id, self._deductions[member_id])
+            for i in recheck:
+                if statuses[i] == 'APPROVED':
+                    self.member_cache.deduct(self._claims[i][0], self._claims[i][3])
+        
+        self._emails = []
+        self._claims = []
+        self._deductions = defaultdict(float)
+        self._read = []
+        return inserted, [claim_id for claim_id in claim_ids if claim_id is not None]
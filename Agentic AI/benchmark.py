@@ -0,0 +1,305 @@
+"""End-to-end throughput benchmark for the main.py flow.
+
+Creates the schema from "Create database.sql" in a throwaway Postgres schema, fills
+it with synthetic policies, members and claim emails, then runs main.main() against
+the in-process fakes in fakes.py and reports claims per second, per-claim latency
+and database round trips per claim.
+
+    python benchmark.py --emails 2000 --llm-latency 0.3 --mode pipeline
+
+The database connection comes from the usual DB_* variables. Only the schema
+named by --schema (default claims_benchmark) is touched, and it is dropped and
+recreated on every run.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+
+from db_pool import ConnectionPool
+from fakes import FakeGmailService, FakeOpenAIClient
+from metrics import metrics
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Create database.sql')
+
+POLICIES = [
+    ('POL-BASIC', 'Basic Care', 'outpatient',
+     'General consultation; Laboratory tests; Chest X-ray; Physiotherapy',
+     'Cosmetic surgery; IVF; Dental implants', 200000, 0, False),
+    ('POL-SILVER', 'Silver Plus', 'comprehensive',
+     'General consultation; Laboratory tests; Chest X-ray; MRI scan; Physiotherapy; Appendectomy',
+     'Cosmetic surgery; IVF', 500000, 5000, False),
+    ('POL-GOLD', 'Gold Complete', 'comprehensive',
+     'General consultation; Laboratory tests; Chest X-ray; MRI scan; CT scan; Physiotherapy; Appendectomy; Knee arthroscopy',
+     'Cosmetic surgery', 1500000, 0, True),
+    ('POL-MATERNITY', 'Family Maternity', 'maternity',
+     'Antenatal care; Obstetric ultrasound; Caesarean section; General consultation',
+     'IVF; Cosmetic surgery', 800000, 10000, True),
+]
+
+CLAIM_TYPES = [
+    ('Acute bronchitis', 'Chest X-ray'),
+    ('Type 2 diabetes', 'Laboratory tests'),
+    ('Lower back pain', 'Physiotherapy'),
+    ('Suspected meniscus tear', 'MRI scan'),
+    ('Acute appendicitis', 'Appendectomy'),
+    ('Migraine', 'General consultation'),
+    ('Pregnancy, 20 weeks', 'Obstetric ultrasound'),
+    ('Nasal deformity', 'Cosmetic surgery'),
+]
+
+_round_trips = 0
+_round_trips_lock = threading.Lock()
+
+
+def _count_round_trip():
+    global _round_trips
+    with _round_trips_lock:
+        _round_trips += 1
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Counts every statement sent to the server."""
+    
+    def execute(self, query, vars=None):
+        _count_round_trip()
+        return super().execute(query, vars)
+    
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        for _ in vars_list:
+            _count_round_trip()
+        return super().executemany(query, vars_list)
+    
+    def copy_expert(self, sql, file, size=8192):
+        _count_round_trip()
+        return super().copy_expert(sql, file, size)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = CountingCursor
+    
+    def commit(self):
+        if self.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            _count_round_trip()
+        return super().commit()
+    
+    def rollback(self):
+        if self.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            _count_round_trip()
+        return super().rollback()
+
+
+def connection_kwargs(schema):
+    return {
+        'host': os.getenv('DB_HOST'),
+        'port': os.getenv('DB_PORT'),
+        'database': os.getenv('DB_NAME'),
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD'),
+        'options': f'-c search_path={schema}'
+    }
+
+
+def schema_statements():
+    with open(SCHEMA_FILE) as f:
+        sql = re.sub(r'--[^\n]*', '', f.read())
+    return [
+        statement.strip() for statement in sql.split(';')
+        if statement.strip() and not statement.strip().lower().startswith('create database')
+    ]
+
+
+def create_schema(conn, schema):
+    with conn.cursor() as cur:
+        cur.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        cur.execute(f'CREATE SCHEMA {schema}')
+        cur.execute(f'SET search_path TO {schema}')
+        for statement in schema_statements():
+            cur.execute(statement)
+    conn.commit()
+
+
+def seed_members(conn, members, rng):
+    with conn.cursor() as cur:
+        execute_values(cur, """
+            INSERT INTO policies (policy_id, policy_name, plan_type, covered_services, exclusions,
+                                  annual_limit, deductible, pre_authorization_required)
+            VALUES %s
+        """, POLICIES)
+        rows = [
+            (f'MBR{i:06d}', f'Member {i}', f'19{rng.randint(50, 99)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}',
+             rng.choice(POLICIES)[0], 'ACTIVE', rng.randint(20, 400) * 1000)
+            for i in range(members)
+        ]
+        execute_values(cur, """
+            INSERT INTO members (member_id, full_name, date_of_birth, policy_id, status, policy_balance)
+            VALUES %s
+        """, rows, page_size=1000)
+    conn.commit()
+
+
+def claim_email(i, members, template_ratio, rng):
+    """(subject, body) of a synthetic claim: labelled fields or a free-text note."""
+    # A few claims name members that do not exist
+    member_id = f'MBR{rng.randrange(members):06d}' if rng.random() > 0.03 else f'MBR9{i:05d}'
+    diagnosis, service = rng.choice(CLAIM_TYPES)
+    amount = rng.randint(5, 600) * 100
+    subject = f'Pre-authorization request #{i}'
+    if rng.random() < template_ratio:
+        body = (f"Member ID: {member_id}\nDiagnosis: {diagnosis}\n"
+                f"Requested Service: {service}\nClaim Amount: KES {amount:,}\n")
+    else:
+        body = (f"Dear claims team,\n\nOur patient, member {member_id}, was diagnosed with {diagnosis} "
+                f"and needs {service}. The estimated cost is KES {amount:,}.\n\nRegards,\nNairobi Clinic")
+    return subject, body
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def run(args):
+    global _round_trips
+    rng = random.Random(args.seed)
+    kwargs = connection_kwargs(args.schema)
+    
+    setup = psycopg2.connect(**kwargs)
+    create_schema(setup, args.schema)
+    seed_members(setup, args.members, rng)
+    setup.close()
+    
+    gmail_service = FakeGmailService(latency=args.gmail_latency)
+    for i in range(args.emails):
+        subject, body = claim_email(i, args.members, args.template_ratio, rng)
+        gmail_service.add_message(f'msg{i:07d}', subject, body)
+    # With MODEL_ROUTING=on the fast model answers in --fast-llm-latency seconds
+    fast_latency = args.llm_latency if args.fast_llm_latency is None else args.fast_llm_latency
+    llm = FakeOpenAIClient(latency=args.llm_latency, model_latency={os.getenv('OPENAI_FAST_MODEL', 'gpt-4o-mini'): fast_latency})
+    
+    os.environ['RUN_MODE'] = args.mode
+    os.environ['STEP_THROUGH'] = 'off'
+    os.environ.setdefault('BATCH_EXECUTOR', 'local')
+    os.environ.setdefault('BATCH_POLL_INTERVAL', '0.1')
+    os.environ.setdefault('BATCH_WORKDIR', tempfile.mkdtemp(prefix='claims_benchmark_'))
+    os.environ.pop('MAX_EMAILS', None)
+    # The fakes have no quota, so the limiters only get in the way unless set explicitly
+    os.environ.setdefault('OPENAI_RATE', '100000')
+    os.environ.setdefault('OPENAI_TOKENS_PER_MINUTE', '1000000000')
+    os.environ.setdefault('OPENAI_MAX_IN_FLIGHT', '256')
+    os.environ.setdefault('GMAIL_RATE', '1000000')
+    
+    from gmail_reader import GmailReader
+    from openai_agent import OpenAIEmailAgent
+    import main as claims_main
+    
+    pool = ConnectionPool(
+        min_size=1,
+        max_size=int(os.getenv('DB_POOL_MAX', '10')),
+        connection_factory=CountingConnection,
+        **kwargs
+    )
+    metrics.reset()
+    _round_trips = 0
+    
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    started = time.perf_counter()
+    with quiet:
+        claims_main.main(gmail=GmailReader(service=gmail_service), agent=OpenAIEmailAgent(client=llm), pool=pool)
+    wall_time = time.perf_counter() - started
+    round_trips = _round_trips
+    
+    with psycopg2.connect(**kwargs) as conn, conn.cursor() as cur:
+        cur.execute("SELECT status, COUNT(*) FROM claims GROUP BY status ORDER BY status")
+        statuses = dict(cur.fetchall())
+    pool.close()
+    
+    claims = sum(statuses.values())
+    summary = metrics.summary()
+    latencies = [
+        gmail_service.read_at[message_id] - gmail_service.delivered_at[message_id]
+        for message_id in gmail_service.read_at if message_id in gmail_service.delivered_at
+    ]
+    return {
+        'mode': args.mode,
+        'emails': args.emails,
+        'claims': claims,
+        'statuses': statuses,
+        'wall_time_s': round(wall_time, 3),
+        'claims_per_second': round(claims / wall_time, 2) if wall_time else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.5) * 1000, 1),
+            'p95': round(percentile(latencies, 0.95) * 1000, 1),
+            'p99': round(percentile(latencies, 0.99) * 1000, 1),
+        },
+        'db_round_trips': round_trips,
+        'db_round_trips_per_claim': round(round_trips / claims, 2) if claims else None,
+        'llm_calls': llm.calls,
+        'llm_calls_per_claim': round(llm.calls / claims, 2) if claims else None,
+        'llm_calls_by_model': llm.calls_by_model,
+        'llm_cost_usd': round(sum(
+            counter['value'] for counter in summary['counters'] if counter['name'] == 'claims_llm_cost_usd_total'
+        ), 6),
+        'gmail_calls': gmail_service.calls,
+        'settings': {
+            'members': args.members,
+            'template_ratio': args.template_ratio,
+            'llm_latency': args.llm_latency,
+            'fast_llm_latency': fast_latency,
+            'model_routing': os.getenv('MODEL_ROUTING', 'off'),
+            'gmail_latency': args.gmail_latency,
+            'seed': args.seed,
+        },
+        'metrics': summary,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--emails', type=int, default=2000)
+    parser.add_argument('--members', type=int, default=500)
+    parser.add_argument('--template-ratio', type=float, default=0.6, help='share of emails with labelled fields')
+    parser.add_argument('--llm-latency', type=float, default=0.2, help='seconds per fake OpenAI call')
+    parser.add_argument('--fast-llm-latency', type=float, help='seconds per call to the fast model (default: --llm-latency)')
+    parser.add_argument('--gmail-latency', type=float, default=0.05, help='seconds per fake Gmail HTTP call')
+    parser.add_argument('--mode', choices=('sequential', 'pipeline', 'backlog'), default='sequential')
+    parser.add_argument('--schema', default='claims_benchmark')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='also write the full results to this file')
+    parser.add_argument('--verbose', action='store_true', help="show main.py's own output")
+    args = parser.parse_args()
+    
+    from dotenv import load_dotenv
+    load_dotenv()
+    result = run(args)
+    
+    print(f"Mode: {result['mode']}, {result['emails']} emails -> {result['claims']} claims {result['statuses']}")
+    print(f"Throughput: {result['claims_per_second']} claims/s ({result['wall_time_s']}s)")
+    latency = result['latency_ms']
+    print(f"Per-claim latency: p50 {latency['p50']}ms, p95 {latency['p95']}ms, p99 {latency['p99']}ms")
+    print(f"DB round trips: {result['db_round_trips']} ({result['db_round_trips_per_claim']} per claim)")
+    print(f"LLM calls: {result['llm_calls']} ({result['llm_calls_per_claim']} per claim), Gmail calls: {result['gmail_calls']}")
+    print(f"LLM calls by model: {result['llm_calls_by_model']}, estimated cost ${result['llm_cost_usd']}")
+    
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
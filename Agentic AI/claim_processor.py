@@ -0,0 +1,215 @@
+from db_pool import get_pool
+from openai_agent import OpenAIEmailAgent
+from claims_db import ClaimsDB
+from members_db import MembersDB, MemberCache
+from policies_db import PoliciesDB, PolicyCache
+from adjudication_cache import CachedAdjudicator, cache_from_env
+from email_extractor import EmailExtractor
+from dedupe import Deduplicator, content_hash
+from metrics import metrics
+import os
+
+class ClaimProcessor:
+    """The individual steps of processing one claim email.
+
+    main.py runs them back to back for each email; pipeline.py runs each step as
+    its own stage so many claims can be in flight at once.
+    """
+    
+    def __init__(self, pool=None, agent=None, claims_db=None, members_db=None, policies_db=None, adjudication_cache=None):
+        self.pool = pool or get_pool()
+        self.agent = agent or OpenAIEmailAgent()
+        self.claims_db = claims_db or ClaimsDB(self.pool)
+        self.members_db = members_db or MembersDB(self.pool)
+        self.policies_db = policies_db or PoliciesDB(self.pool)
+        
+        # Member rows are reused for a short while, with balances kept current by our own deductions
+        if os.getenv('MEMBER_CACHE', 'on').lower() == 'off':
+            self.member_cache = None
+        else:
+            self.member_cache = MemberCache(self.members_db, ttl=float(os.getenv('MEMBER_CACHE_TTL', '30')))
+        self.members = self.member_cache or self.members_db
+        
+        # Resubmitted content is matched to the original claim before any LLM work, unless DEDUPE=off
+        self.deduplicator = None if os.getenv('DEDUPE', 'on').lower() == 'off' else Deduplicator(self.claims_db)
+        
+        # Structured submissions are parsed by templates; the LLM only sees what they cannot handle
+        self.extractor = EmailExtractor()
+        self.template_min_confidence = float(os.getenv('TEMPLATE_MIN_CONFIDENCE', '0.9'))
+        
+        # Policies change rarely, so lookups go to a warm in-process copy unless POLICY_CACHE=off
+        if os.getenv('POLICY_CACHE', 'on').lower() == 'off':
+            self.policies = self.policies_db
+        else:
+            self.policies = PolicyCache(self.policies_db, max_age=float(os.getenv('POLICY_CACHE_MAX_AGE', '300')))
+        
+        # One schema-enforced request does extraction and adjudication when the member can be found up front
+        self.combined_llm_call = os.getenv('COMBINED_LLM_CALL', 'off').lower() == 'on'
+        
+        # Repeat (diagnosis, service, policy) combinations skip the LLM when a cache is configured
+        self.adjudication_cache = adjudication_cache or cache_from_env(self.pool)
+        if self.adjudication_cache:
+            self.adjudicator = CachedAdjudicator(self.agent, self.adjudication_cache)
+        else:
+            self.adjudicator = self.agent
+    
+    def extract(self, email):
+        with metrics.span('claims_stage_duration_seconds', stage='extract'):
+            source = 'template'
+            claim_data = self.extractor.extract_claim_data(email['subject'], email['body'])
+            if not claim_data or claim_data['confidence'] < self.template_min_confidence:
+                claim_data = None
+                if self.combined_llm_call:
+                    source = 'combined'
+                    claim_data = self._extract_and_adjudicate(email)
+                if not claim_data:
+                    source = 'llm'
+                    claim_data = self.agent.extract_claim_data(email['subject'], email['body'])
+            claim_data = self.normalise(claim_data)
+            if claim_data:
+                claim_data['content_hash'] = email.get('content_hash') or content_hash(email)
+        metrics.inc('claims_extractions_total', source=source if claim_data else 'failed')
+        return claim_data
+    
+    def find_duplicates(self, emails):
+        """{message_id: original} for emails whose content was already received; see Deduplicator.check."""
+        if not self.deduplicator:
+            return {}
+        duplicates = self.deduplicator.check(emails)
+        if duplicates:
+            metrics.inc('claims_duplicates_total', len(duplicates))
+        return duplicates
+    
+    def normalise(self, claim_data):
+        """Reject extractions without a member or a numeric amount; amounts become floats."""
+        if not isinstance(claim_data, dict) or not claim_data.get('member_id'):
+            return None
+        try:
+            claim_data['claim_amount'] = float(claim_data.get('claim_amount'))
+        except (TypeError, ValueError):
+            return None
+        return claim_data
+    
+    def _extract_and_adjudicate(self, email):
+        """Combined LLM call made with the policy of the member the email names.
+        
+        The adjudication rides along in claim_data and adjudicate() uses it instead of a second request.
+        """
+        member_id = self.extractor.find_member_id(email['subject'], email['body'])
+        member = self.members.get_member(member_id) if member_id else None
+        if not member:
+            return None
+        
+        policy_context = self.policies.get_policy(member['policy_id'])
+        result = self.agent.extract_and_adjudicate(email['subject'], email['body'], policy_context)
+        if not result:
+            return None
+        
+        claim_data, adjudication = result
+        # The decision only holds for the policy it was made against
+        if claim_data.get('member_id') == member['member_id']:
+            claim_data['adjudication'] = adjudication
+            claim_data['policy_id'] = member['policy_id']
+        return claim_data
+    
+    def validate(self, claim_data, reserved=0.0):
+        """Return (member, denial_reason). ``reserved`` is balance already promised to in-flight claims."""
+        with metrics.span('claims_stage_duration_seconds', stage='validate'):
+            member = self.members.get_member(claim_data['member_id'])
+            return self.validate_against(member, claim_data, reserved)
+    
+    def prefetch_members(self, member_ids):
+        """Load the members a batch is about to validate with one query."""
+        if self.member_cache:
+            self.member_cache.prefetch(member_ids)
+    
+    def prefetch_members_for(self, emails):
+        """prefetch_members for the member ids the emails name, before anything is extracted."""
+        self.prefetch_members(self.extractor.find_member_id(email['subject'], email['body']) for email in emails)
+    
+    def validate_against(self, member, claim_data, reserved=0.0):
+        """validate() for a member row that has already been looked up."""
+        if not member:
+            return None, 'Member not found in system'
+        
+        available = member['policy_balance'] - reserved
+        if available < claim_data['claim_amount']:
+            return member, f'Insufficient policy balance: ${available} available, ${claim_data["claim_amount"]} required'
+        return member, None
+    
+    def adjudicate(self, claim_data, member):
+        """Return (decision, reasoning) from clinical review against the member's policy."""
+        with metrics.span('claims_stage_duration_seconds', stage='adjudicate'):
+            adjudication = claim_data.get('adjudication')
+            if not adjudication or claim_data.get('policy_id') != member['policy_id']:
+                policy_context = self.policies.get_policy(member['policy_id'])
+                adjudication = self.adjudicator.clinical_adjudication(
+                    claim_data['diagnosis'],
+                    claim_data['requested_service'],
+                    policy_context,
+                    claim_data['claim_amount']
+                )
+            return self.decide(member, adjudication)
+    
+    def decide(self, member, adjudication):
+        """Final decision and the reasoning stored with the claim."""
+        reasoning = f"Policy balance: ${member['policy_balance']}. Clinical: {adjudication['reasoning']}"
+        return adjudication['decision'], reasoning
+    
+    def commit(self, claim_data, decision, reasoning, message_id=None):
+        """Store the claim with its decision and deduct approved amounts in one round trip.
+        
+        Returns (claim_id, status); status is DENIED if the balance no longer covers an approval.
+        With ``message_id`` the source email is flagged to be marked read, in the same statement.
+        """
+        with metrics.span('claims_stage_duration_seconds', stage='commit'):
+            claim_id, status, _ = self.claims_db.commit_claim(
+                claim_data['member_id'],
+                claim_data['diagnosis'],
+                claim_data['requested_service'],
+                claim_data['claim_amount'],
+                decision,
+                reasoning,
+                claim_data.get('content_hash'),
+                message_id
+            )
+        metrics.inc('claims_processed_total', status=status)
+        if status == 'APPROVED' and self.member_cache:
+            # Inside a caller's transaction (a worker completing its job) the deduction is only real once it commits
+            self.pool.after_commit(lambda: self.member_cache.deduct(claim_data['member_id'], claim_data['claim_amount']))
+        return claim_id, status
+    
+    def process(self, email):
+        """Run every step for one email and return the outcome, or None when nothing could be extracted."""
+        claim_data = self.extract(email)
+        if not claim_data:
+            return None
+        
+        member, denial = self.validate(claim_data)
+        if denial:
+            decision, reasoning = 'DENIED', denial
+        else:
+            decision, reasoning = self.adjudicate(claim_data, member)
+        
+        claim_id, decision = self.commit(claim_data, decision, reasoning)
+        return {
+            'claim_id': claim_id,
+            'claim_data': claim_data,
+            'member': member,
+            'decision': decision,
+            'reasoning': reasoning
+        }
+    
+    def close(self):
+        self.policies.close()
+    
+    def report(self):
+        """Cache effectiveness and model routing for the end-of-run output, or None when there is nothing to say."""
+        lines = []
+        if self.adjudication_cache:
+            stats = self.adjudication_cache.stats()
+            lines.append(f"Adjudication cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
+        router = getattr(self.agent, 'router', None)
+        if router and router.report():
+            lines.append(router.report())
+        return '\n'.join(lines) or None
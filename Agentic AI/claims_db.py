@@ -1,28 +1,35 @@
-import psycopg2
-import os
+from psycopg2.extras import execute_values
+from db_pool import get_pool
+import csv
+import io
+
+# claim_jobs states in which a queued original will still produce a claim
+PENDING_JOB_STATUSES = ('NEW', 'IN_PROGRESS', 'FAILED')
+
+# Whether claim_jobs exists, per pool; it only appears once worker.py has run
+_job_queue_by_pool = {}
+
+
+def job_queue_created(pool):
+    """Called by WorkQueue after creating claim_jobs, so a cached 'missing' answer is dropped."""
+    _job_queue_by_pool.pop(pool, None)
+
 
 class ClaimsDB:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            port=os.getenv('DB_PORT'),
-            database=os.getenv('DB_NAME'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASSWORD')
-        )
+    def __init__(self, pool=None):
+        self.pool = pool or get_pool()
     
     def insert_claim(self, member_id, diagnosis, requested_service, claim_amount):
-        with self.conn.cursor() as cur:
+        with self.pool.cursor() as cur:
             cur.execute("""
                 INSERT INTO claims (member_id, diagnosis, requested_service, claim_amount, status)
                 VALUES (%s, %s, %s, %s, %s)
                 RETURNING claim_id
             """, (member_id, diagnosis, requested_service, claim_amount, 'PENDING'))
-            self.conn.commit()
             return cur.fetchone()[0]
     
     def update_claim_status(self, claim_id, status, reasoning=None):
-        with self.conn.cursor() as cur:
+        with self.pool.cursor() as cur:
             if reasoning:
                 cur.execute("""
                     UPDATE claims 
@@ -35,7 +42,119 @@ class ClaimsDB:
                     SET status = %s
                     WHERE claim_id = %s
                 """, (status, claim_id))
-            self.conn.commit()
+    
+    def commit_claim(self, member_id, diagnosis, requested_service, claim_amount, decision, reasoning, content_hash=None, message_id=None):
+        """Insert a decided claim and, if approved, deduct it from the member's balance in one statement.
+        
+        The deduction only happens while the balance still covers the amount, so concurrent
+        workers cannot overdraw a member; an approval that no longer fits is stored as DENIED.
+        ``message_id`` names the source email, which is marked processed and flagged read_pending by the same statement.
+        Returns (claim_id, status, new_balance), where new_balance is None unless deducted.
+        """
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                WITH debit AS (
+                    UPDATE members
+                    SET policy_balance = policy_balance - %(amount)s
+                    WHERE member_id = %(member_id)s
+                      AND %(decision)s = 'APPROVED'
+                      AND policy_balance >= %(amount)s
+                    RETURNING policy_balance
+                ), source AS (
+                    UPDATE emails SET read_pending = TRUE, status = 'processed'
+                    WHERE message_id = %(message_id)s
+                ), claim AS (
+                    INSERT INTO claims (member_id, diagnosis, requested_service, claim_amount, status, adjudication_reasoning, content_hash)
+                    SELECT %(member_id)s, %(diagnosis)s, %(requested_service)s, %(amount)s,
+                        CASE WHEN %(decision)s <> 'APPROVED' OR EXISTS (SELECT 1 FROM debit)
+                            THEN %(decision)s ELSE 'DENIED' END,
+                        CASE WHEN %(decision)s <> 'APPROVED' OR EXISTS (SELECT 1 FROM debit)
+                            THEN %(reasoning)s ELSE 'Insufficient policy balance at commit. ' || %(reasoning)s END,
+                        %(content_hash)s
+                    RETURNING claim_id, status
+                )
+                SELECT claim.claim_id, claim.status, (SELECT policy_balance FROM debit) FROM claim
+            """, {
+                'member_id': member_id,
+                'diagnosis': diagnosis,
+                'requested_service': requested_service,
+                'amount': claim_amount,
+                'decision': decision,
+                'reasoning': reasoning,
+                'content_hash': content_hash,
+                'message_id': message_id
+            })
+            claim_id, status, new_balance = cur.fetchone()
+            return claim_id, status, float(new_balance) if new_balance is not None else None
+    
+    def insert_claims(self, claims):
+        """Insert decided claims in one statement and return their claim_ids in order.
+        
+        Each claim is a (member_id, diagnosis, requested_service, claim_amount, status, reasoning, content_hash) tuple.
+        """
+        if not claims:
+            return []
+        with self.pool.cursor() as cur:
+            rows = execute_values(cur, """
+                INSERT INTO claims (member_id, diagnosis, requested_service, claim_amount, status, adjudication_reasoning, content_hash)
+                VALUES %s
+                RETURNING claim_id
+            """, claims, page_size=1000, fetch=True)
+            return [row[0] for row in rows]
+    
+    def copy_claims(self, claims):
+        """COPY-based variant of insert_claims for large backfills; claim_ids are not returned."""
+        if not claims:
+            return 0
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(claims)
+        buffer.seek(0)
+        with self.pool.cursor() as cur:
+            cur.copy_expert("""
+                COPY claims (member_id, diagnosis, requested_service, claim_amount, status, adjudication_reasoning, content_hash)
+                FROM STDIN WITH (FORMAT csv)
+            """, buffer)
+            return cur.rowcount
+    
+    def _job_queue_exists(self, cur):
+        if self.pool not in _job_queue_by_pool:
+            cur.execute("SELECT to_regclass('claim_jobs') IS NOT NULL")
+            _job_queue_by_pool[self.pool] = cur.fetchone()[0]
+        return _job_queue_by_pool[self.pool]
+    
+    def find_by_content_hashes(self, content_hashes, exclude_message_ids=()):
+        """Earlier emails with these content hashes that have a claim, or a queued job that will make one.
+        
+        An earlier email that never produced a claim (after a failed extraction, say)
+        does not count, so its resend is processed instead of being dropped.
+        Returns {content_hash: {'message_id', 'claim_id', 'status'}}; ``exclude_message_ids``
+        keeps a message from matching itself when it is seen again.
+        """
+        if not content_hashes:
+            return {}
+        with self.pool.cursor() as cur:
+            pending_job = "FALSE"
+            if self._job_queue_exists(cur):
+                pending_job = "e.message_id IN (SELECT message_id FROM claim_jobs WHERE status = ANY(%(job_statuses)s))"
+            cur.execute(f"""
+                SELECT DISTINCT ON (e.content_hash) e.content_hash, e.message_id, c.claim_id, c.status
+                FROM emails e
+                LEFT JOIN claims c ON c.content_hash = e.content_hash
+                WHERE e.content_hash = ANY(%(hashes)s)
+                  AND e.message_id <> ALL(%(exclude)s)
+                  AND e.status <> 'duplicate'
+                  AND (c.claim_id IS NOT NULL OR {pending_job})
+                ORDER BY e.content_hash, c.claim_id NULLS LAST, e.created_at
+            """, {
+                'hashes': list(content_hashes),
+                'exclude': list(exclude_message_ids),
+                'job_statuses': list(PENDING_JOB_STATUSES)
+            })
+            return {
+                row[0]: {'message_id': row[1], 'claim_id': row[2], 'status': row[3]}
+                for row in cur.fetchall()
+            }
     
     def close(self):
-        self.conn.close()
+        # Connections belong to the shared pool; see db_pool.close_pool()
+        pass
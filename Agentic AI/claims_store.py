@@ -0,0 +1,399 @@
+from datetime import date, datetime
+from db_pool import get_pool, add_missing
+import os
+
+# Columns returned by the reporting queries
+CLAIM_COLUMNS = (
+    'claim_id', 'member_id', 'diagnosis', 'requested_service', 'claim_amount',
+    'adjudication_reasoning', 'status', 'content_hash', 'created_at'
+)
+
+# Composite indexes for the reporting filters; each ends in the keyset order
+CLAIM_INDEXES = {
+    'claims_member_created_idx': '(member_id, created_at, claim_id)',
+    'claims_status_created_idx': '(status, created_at, claim_id)',
+    'claims_created_idx': '(created_at, claim_id)',
+    'claims_content_hash_idx': '(content_hash)',
+}
+
+# Records each claims statement's net change per (day, policy_id, status) in claim_daily_deltas.
+# The deltas table is append-only, so concurrent writers never wait on one another's summary rows;
+# rollup_summary folds the deltas into claim_daily_totals.
+SUMMARY_FUNCTION = """
+    CREATE OR REPLACE FUNCTION claim_daily_deltas_record() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO claim_daily_deltas (day, policy_id, status, claim_count, total_amount)
+            SELECT c.created_at::date, COALESCE(m.policy_id, ''), COALESCE(c.status, ''),
+                COUNT(*), COALESCE(SUM(c.claim_amount), 0)
+            FROM new_claims c LEFT JOIN members m ON m.member_id = c.member_id
+            GROUP BY 1, 2, 3;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO claim_daily_deltas (day, policy_id, status, claim_count, total_amount)
+            SELECT day, policy_id, status, SUM(n), SUM(amount)
+            FROM (
+                SELECT c.created_at::date AS day, COALESCE(m.policy_id, '') AS policy_id,
+                    COALESCE(c.status, '') AS status, 1 AS n, COALESCE(c.claim_amount, 0) AS amount
+                FROM new_claims c LEFT JOIN members m ON m.member_id = c.member_id
+                UNION ALL
+                SELECT c.created_at::date, COALESCE(m.policy_id, ''), COALESCE(c.status, ''),
+                    -1, -COALESCE(c.claim_amount, 0)
+                FROM old_claims c LEFT JOIN members m ON m.member_id = c.member_id
+            ) delta
+            GROUP BY 1, 2, 3
+            HAVING SUM(n) <> 0 OR SUM(amount) <> 0;
+        ELSE
+            INSERT INTO claim_daily_deltas (day, policy_id, status, claim_count, total_amount)
+            SELECT c.created_at::date, COALESCE(m.policy_id, ''), COALESCE(c.status, ''),
+                -COUNT(*), -COALESCE(SUM(c.claim_amount), 0)
+            FROM old_claims c LEFT JOIN members m ON m.member_id = c.member_id
+            GROUP BY 1, 2, 3;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+# Moves every committed delta into claim_daily_totals. Rows another rollup has already
+# deleted are skipped, and groups are upserted in key order so two rollups lock them alike.
+SUMMARY_ROLLUP = """
+    WITH moved AS (
+        DELETE FROM claim_daily_deltas RETURNING day, policy_id, status, claim_count, total_amount
+    )
+    INSERT INTO claim_daily_totals AS t (day, policy_id, status, claim_count, total_amount)
+    SELECT day, policy_id, status, SUM(claim_count), SUM(total_amount)
+    FROM moved
+    GROUP BY 1, 2, 3
+    ORDER BY 1, 2, 3
+    ON CONFLICT (day, policy_id, status) DO UPDATE SET
+        claim_count = t.claim_count + EXCLUDED.claim_count,
+        total_amount = t.total_amount + EXCLUDED.total_amount
+"""
+
+SUMMARY_REBUILD = """
+    INSERT INTO claim_daily_totals (day, policy_id, status, claim_count, total_amount)
+    SELECT c.created_at::date, COALESCE(m.policy_id, ''), COALESCE(c.status, ''),
+        COUNT(*), COALESCE(SUM(c.claim_amount), 0)
+    FROM claims c LEFT JOIN members m ON m.member_id = c.member_id
+    GROUP BY 1, 2, 3
+"""
+
+# Transition tables allow only one event per trigger
+SUMMARY_TRIGGERS = {
+    'claims_summary_insert': 'AFTER INSERT ON claims REFERENCING NEW TABLE AS new_claims',
+    'claims_summary_update': 'AFTER UPDATE ON claims REFERENCING OLD TABLE AS old_claims NEW TABLE AS new_claims',
+    'claims_summary_delete': 'AFTER DELETE ON claims REFERENCING OLD TABLE AS old_claims',
+}
+
+# Held while creating or attaching schema objects, so processes starting together do not race
+SCHEMA_LOCK = "SELECT pg_advisory_xact_lock(hashtext('claims_store_schema'))"
+
+
+def _month_start(day, months=0):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def encode_cursor(created_at, claim_id):
+    return f"{created_at.isoformat()}_{claim_id}"
+
+
+def decode_cursor(cursor):
+    created_at, claim_id = cursor.rsplit('_', 1)
+    return datetime.fromisoformat(created_at), int(claim_id)
+
+
+class ClaimsStore:
+    """Schema and reporting queries for the claims table.
+
+    ``claims`` is range-partitioned by month on created_at, with a default
+    partition so an insert never fails when maintenance falls behind. Composite
+    indexes cover lookups by member, by status and by date, each in (created_at,
+    claim_id) order so ``list_claims`` pages with a keyset cursor instead of OFFSET.
+    Statement-level triggers append each statement's net change to
+    ``claim_daily_deltas``; ``rollup_summary`` folds those into
+    ``claim_daily_totals`` (claims and amounts per day, policy and status) and
+    ``daily_totals`` reads both, so its results are current between rollups.
+    """
+    
+    def __init__(self, pool=None, months_ahead=None):
+        self.pool = pool or get_pool()
+        self.months_ahead = months_ahead if months_ahead is not None else int(os.getenv('CLAIMS_PARTITION_MONTHS_AHEAD', '3'))
+    
+    def is_partitioned(self):
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('claims')")
+            row = cur.fetchone()
+            return row is not None and row[0] == 'p'
+    
+    def _create_partitioned_table(self, cur):
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS claims (
+                claim_id SERIAL,
+                member_id VARCHAR(100),
+                diagnosis TEXT,
+                requested_service TEXT,
+                claim_amount DECIMAL(10, 2),
+                adjudication_reasoning TEXT,
+                status VARCHAR(20) DEFAULT 'NEW',
+                content_hash CHAR(64),
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (claim_id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        """)
+        cur.execute("CREATE TABLE IF NOT EXISTS claims_default PARTITION OF claims DEFAULT")
+    
+    def create_tables(self):
+        """Create claims (partitioned, on a new database), its indexes, the summary table and its triggers."""
+        with self.pool.transaction():
+            with self.pool.cursor() as cur:
+                cur.execute(SCHEMA_LOCK)
+                cur.execute("SELECT to_regclass('claims') IS NOT NULL")
+                if not cur.fetchone()[0]:
+                    self._create_partitioned_table(cur)
+                add_missing(self.pool, 'claims', columns={
+                    # Tables created before resubmission detection lack the content hash column
+                    'content_hash': "ALTER TABLE claims ADD COLUMN IF NOT EXISTS content_hash CHAR(64)",
+                }, indexes={
+                    name: f"CREATE INDEX IF NOT EXISTS {name} ON claims {columns}" for name, columns in CLAIM_INDEXES.items()
+                })
+                self._create_summary(cur)
+        if self.is_partitioned():
+            self.ensure_partitions()
+        else:
+            print("claims is not partitioned; run 'python claims_store.py migrate' to convert it")
+    
+    def _create_summary(self, cur):
+        cur.execute("SELECT to_regclass('claim_daily_totals') IS NULL")
+        backfill = cur.fetchone()[0]
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS claim_daily_totals (
+                day DATE NOT NULL,
+                policy_id VARCHAR(50) NOT NULL,
+                status VARCHAR(20) NOT NULL,
+                claim_count BIGINT NOT NULL DEFAULT 0,
+                total_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, policy_id, status)
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS claim_daily_deltas (
+                day DATE NOT NULL,
+                policy_id VARCHAR(50) NOT NULL,
+                status VARCHAR(20) NOT NULL,
+                claim_count BIGINT NOT NULL,
+                total_amount DECIMAL(14, 2) NOT NULL
+            )
+        """)
+        # Replacing the function on every start would take locks on claims for nothing
+        cur.execute("SELECT to_regprocedure('claim_daily_deltas_record()') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            cur.execute(SUMMARY_FUNCTION)
+        cur.execute("""
+            SELECT tgname, tgfoid = to_regprocedure('claim_daily_deltas_record()')
+            FROM pg_trigger WHERE tgrelid = to_regclass('claims')
+        """)
+        existing = dict(cur.fetchall())
+        for name, timing in SUMMARY_TRIGGERS.items():
+            if existing.get(name):
+                continue
+            # Triggers from before the deltas table upserted claim_daily_totals directly
+            if name in existing:
+                cur.execute(f"DROP TRIGGER {name} ON claims")
+            cur.execute(f"CREATE TRIGGER {name} {timing} FOR EACH STATEMENT EXECUTE FUNCTION claim_daily_deltas_record()")
+        cur.execute("SELECT to_regprocedure('claim_daily_totals_apply()') IS NOT NULL")
+        if cur.fetchone()[0]:
+            cur.execute("DROP FUNCTION claim_daily_totals_apply()")
+        if backfill:
+            # Claims that predate the summary; the new triggers hold off writers until this commits
+            cur.execute(SUMMARY_REBUILD)
+    
+    def ensure_partitions(self, start=None, months_ahead=None):
+        """Create the monthly partitions from ``start`` (default: this month) to ``months_ahead`` months on.
+
+        Rows that landed in the default partition for a new month are moved into it.
+        Returns the names of the partitions created.
+        """
+        first = _month_start(start or date.today())
+        last = _month_start(date.today(), self.months_ahead if months_ahead is None else months_ahead)
+        created = []
+        month = first
+        while month <= last:
+            name = f"claims_{month:%Y_%m}"
+            upper = _month_start(month, 1)
+            with self.pool.transaction():
+                with self.pool.cursor() as cur:
+                    # Another process may be creating the same month; whoever waits here then sees it
+                    cur.execute(SCHEMA_LOCK)
+                    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+                    if not cur.fetchone()[0]:
+                        # Attach a filled table rather than CREATE ... PARTITION OF, which fails
+                        # while the default partition holds rows for the month
+                        cur.execute(f"CREATE TABLE {name} (LIKE claims INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+                        cur.execute(f"""
+                            WITH moved AS (
+                                DELETE FROM claims_default WHERE created_at >= %s AND created_at < %s RETURNING *
+                            )
+                            INSERT INTO {name} SELECT * FROM moved
+                        """, (month, upper))
+                        cur.execute(f"ALTER TABLE claims ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (month, upper))
+                        created.append(name)
+            month = upper
+        return created
+    
+    def migrate(self):
+        """Convert an unpartitioned claims table into the partitioned layout, keeping claim_ids.
+
+        Runs in one transaction and rewrites every row, so it belongs in a maintenance window.
+        """
+        if self.is_partitioned():
+            return False
+        with self.pool.transaction():
+            with self.pool.cursor() as cur:
+                cur.execute("SELECT MIN(created_at) FROM claims")
+                oldest = cur.fetchone()[0]
+                cur.execute("ALTER TABLE claims RENAME TO claims_unpartitioned")
+                for name in list(CLAIM_INDEXES) + ['claims_pkey']:
+                    cur.execute(f"ALTER INDEX IF EXISTS {name} RENAME TO {name}_unpartitioned")
+                for name in SUMMARY_TRIGGERS:
+                    cur.execute(f"DROP TRIGGER IF EXISTS {name} ON claims_unpartitioned")
+                cur.execute("SELECT pg_get_serial_sequence('claims_unpartitioned', 'claim_id')")
+                sequence = cur.fetchone()[0]
+                self._create_partitioned_table(cur)
+                # Keep issuing claim_ids from the old sequence
+                cur.execute("SELECT pg_get_serial_sequence('claims', 'claim_id')")
+                new_sequence = cur.fetchone()[0]
+                cur.execute(f"ALTER TABLE claims ALTER COLUMN claim_id SET DEFAULT nextval('{sequence}')")
+                cur.execute(f"DROP SEQUENCE {new_sequence}")
+                cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY claims.claim_id")
+        self.ensure_partitions(start=oldest.date() if oldest else None)
+        with self.pool.transaction():
+            with self.pool.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO claims (claim_id, member_id, diagnosis, requested_service, claim_amount,
+                        adjudication_reasoning, status, content_hash, created_at)
+                    SELECT claim_id, member_id, diagnosis, requested_service, claim_amount,
+                        adjudication_reasoning, status, content_hash, COALESCE(created_at, CURRENT_TIMESTAMP)
+                    FROM claims_unpartitioned
+                """)
+                cur.execute("DROP TABLE claims_unpartitioned")
+        self.create_tables()
+        self.rebuild_summary()
+        return True
+    
+    def rebuild_summary(self):
+        """Recompute claim_daily_totals from the claims table, e.g. after bulk fixes done with triggers off."""
+        with self.pool.transaction():
+            with self.pool.cursor() as cur:
+                cur.execute("LOCK TABLE claim_daily_totals, claim_daily_deltas IN EXCLUSIVE MODE")
+                cur.execute("DELETE FROM claim_daily_deltas")
+                cur.execute("DELETE FROM claim_daily_totals")
+                cur.execute(SUMMARY_REBUILD)
+                return cur.rowcount
+    
+    def rollup_summary(self):
+        """Fold claim_daily_deltas into claim_daily_totals; returns the number of groups updated."""
+        with self.pool.transaction():
+            with self.pool.cursor() as cur:
+                cur.execute(SUMMARY_ROLLUP)
+                return cur.rowcount
+    
+    def list_claims(self, member_id=None, status=None, start=None, end=None, limit=100, cursor=None):
+        """One page of claims, newest first, filtered by member, status and a created_at range.
+
+        ``start`` is inclusive and ``end`` exclusive. Returns {'claims': [...], 'next_cursor': ...};
+        pass next_cursor back to get the following page, None means there are no more.
+        """
+        conditions = []
+        params = []
+        if member_id is not None:
+            conditions.append("member_id = %s")
+            params.append(member_id)
+        if status is not None:
+            conditions.append("status = %s")
+            params.append(status)
+        if start is not None:
+            conditions.append("created_at >= %s")
+            params.append(start)
+        if end is not None:
+            conditions.append("created_at < %s")
+            params.append(end)
+        if cursor:
+            conditions.append("(created_at, claim_id) < (%s, %s)")
+            params.extend(decode_cursor(cursor))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        with self.pool.cursor() as cur:
+            cur.execute(f"""
+                SELECT {', '.join(CLAIM_COLUMNS)}
+                FROM claims
+                {where}
+                ORDER BY created_at DESC, claim_id DESC
+                LIMIT %s
+            """, params + [limit + 1])
+            rows = cur.fetchall()
+        
+        claims = [dict(zip(CLAIM_COLUMNS, row)) for row in rows[:limit]]
+        for claim in claims:
+            if claim['claim_amount'] is not None:
+                claim['claim_amount'] = float(claim['claim_amount'])
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = encode_cursor(claims[-1]['created_at'], claims[-1]['claim_id'])
+        return {'claims': claims, 'next_cursor': next_cursor}
+    
+    def daily_totals(self, start=None, end=None, policy_id=None, status='APPROVED'):
+        """Totals per day, policy and status for a day range (end exclusive); status=None returns every status.
+
+        Deltas not yet rolled up are added in, so the totals include every committed claim.
+        """
+        conditions = []
+        params = []
+        for condition, value in (("day >= %s", start), ("day < %s", end), ("policy_id = %s", policy_id), ("status = %s", status)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.pool.cursor() as cur:
+            cur.execute(f"""
+                SELECT day, policy_id, status, SUM(claim_count)::BIGINT, SUM(total_amount)
+                FROM (
+                    SELECT day, policy_id, status, claim_count, total_amount FROM claim_daily_totals
+                    UNION ALL
+                    SELECT day, policy_id, status, claim_count, total_amount FROM claim_daily_deltas
+                ) totals
+                {where}
+                GROUP BY day, policy_id, status
+                ORDER BY day, policy_id, status
+            """, params)
+            return [
+                {
+                    'day': day,
+                    'policy_id': policy_id or None,
+                    'status': status,
+                    'claim_count': claim_count,
+                    'total_amount': float(total_amount)
+                }
+                for day, policy_id, status, claim_count, total_amount in cur.fetchall()
+            ]
+
+
+if __name__ == '__main__':
+    import argparse
+    from dotenv import load_dotenv
+    
+    parser = argparse.ArgumentParser(description='Claims table maintenance.')
+    parser.add_argument('command', choices=['partitions', 'migrate', 'rollup-summary', 'rebuild-summary'])
+    args = parser.parse_args()
+    
+    load_dotenv()
+    store = ClaimsStore()
+    if args.command == 'partitions':
+        store.create_tables()
+        print(f"Created partitions: {store.ensure_partitions() or 'none'}")
+    elif args.command == 'migrate':
+        print("Migrated claims to partitions" if store.migrate() else "claims is already partitioned")
+    elif args.command == 'rollup-summary':
+        print(f"Rolled up {store.rollup_summary()} summary rows")
+    else:
+        print(f"Rebuilt {store.rebuild_summary()} summary rows")
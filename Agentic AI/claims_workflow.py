@@ -22,8 +22,10 @@ def process_claims_workflow():
         email_content = extractor.extract_full_content(msg['id'])
         print(f"📧 {email_content['subject'][:60]}")
         
-        # Step 1: Extract claim data
-        claim_data = agent.extract_claim_data(email_content['subject'], email_content['body'])
+        # Step 1: Extract claim data, falling back to the LLM when no template matches confidently
+        claim_data = extractor.extract_claim_data(email_content['subject'], email_content['body'])
+        if not claim_data or claim_data['confidence'] < 0.9:
+            claim_data = agent.extract_claim_data(email_content['subject'], email_content['body'])
         
         if not claim_data:
             print("   ⊘ No claim data found\n")
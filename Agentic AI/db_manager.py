@@ -1,20 +1,24 @@
-import psycopg2
 from psycopg2.extras import execute_values, Json
-import os
+from db_pool import get_pool, add_missing
+from claims_store import ClaimsStore
+from dedupe import DUPLICATE_STATUS
+import csv
+import io
+import json
+
+NEW_STATUS = 'new'
+# Set in the transaction that commits the email's claim
+PROCESSED_STATUS = 'processed'
+# Terminal: the email held no claim the extractors could read, so it is not sent to the LLM again
+UNEXTRACTABLE_STATUS = 'unextractable'
 
 class EmailDB:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            port=os.getenv('DB_PORT'),
-            database=os.getenv('DB_NAME'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASSWORD')
-        )
+    def __init__(self, pool=None):
+        self.pool = pool or get_pool()
         self.create_table()
     
     def create_table(self):
-        with self.conn.cursor() as cur:
+        with self.pool.cursor() as cur:
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS emails (
                     message_id VARCHAR(255) PRIMARY KEY,
@@ -28,53 +32,182 @@ class EmailDB:
                 )
             """)
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS claims (
-                    claim_id SERIAL PRIMARY KEY,
-                    member_id VARCHAR(100),
-                    diagnosis TEXT,
-                    requested_service TEXT,
-                    claim_amount DECIMAL(10, 2),
-                    adjudication_reasoning TEXT,
-                    status VARCHAR(20) DEFAULT 'NEW',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    sync_key VARCHAR(255) PRIMARY KEY,
+                    history_id BIGINT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
-            self.conn.commit()
+        add_missing(self.pool, 'emails', columns={
+            # Tables created before resubmission detection lack the content hash column
+            'content_hash': "ALTER TABLE emails ADD COLUMN IF NOT EXISTS content_hash CHAR(64)",
+            # Set when a message's claim commits and cleared once Gmail has marked it read
+            'read_pending': "ALTER TABLE emails ADD COLUMN IF NOT EXISTS read_pending BOOLEAN NOT NULL DEFAULT FALSE",
+        }, indexes={
+            'emails_content_hash_idx': "CREATE INDEX IF NOT EXISTS emails_content_hash_idx ON emails (content_hash)",
+            'emails_read_pending_idx': "CREATE INDEX IF NOT EXISTS emails_read_pending_idx ON emails (message_id) WHERE read_pending",
+            # Finding unfinished emails at start-up reads only the few rows still waiting for a claim
+            'emails_unfinished_idx': "CREATE INDEX IF NOT EXISTS emails_unfinished_idx ON emails (message_id) WHERE status = 'new' AND NOT read_pending",
+        })
+        # claims, its partitions and the daily summary table
+        ClaimsStore(self.pool).create_tables()
+    
+    def get_history_id(self, sync_key):
+        """Last Gmail historyId stored for ``sync_key``, or None before the first sync."""
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT history_id FROM sync_state WHERE sync_key = %s", (sync_key,))
+            row = cur.fetchone()
+            return str(row[0]) if row and row[0] is not None else None
+    
+    def save_history_id(self, sync_key, history_id):
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                INSERT INTO sync_state (sync_key, history_id, updated_at)
+                VALUES (%s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (sync_key) DO UPDATE SET
+                    history_id = EXCLUDED.history_id,
+                    updated_at = EXCLUDED.updated_at
+            """, (sync_key, int(history_id)))
     
     def email_exists(self, message_id):
-        with self.conn.cursor() as cur:
+        with self.pool.cursor() as cur:
             cur.execute("SELECT 1 FROM emails WHERE message_id = %s", (message_id,))
             return cur.fetchone() is not None
     
+    def _email_row(self, email_data):
+        return (
+            email_data['message_id'],
+            email_data['sender'],
+            email_data['subject'],
+            email_data['date'],
+            email_data['body_snippet'],
+            Json(email_data.get('attachments', [])),
+            email_data.get('status', NEW_STATUS),
+            email_data.get('content_hash'),
+            # Resubmissions need no claim, so they can be marked read as soon as they are stored
+            email_data.get('status') == DUPLICATE_STATUS
+        )
+    
     def insert_email(self, email_data):
-        if self.email_exists(email_data['message_id']):
-            return False
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                INSERT INTO emails (message_id, sender, subject, date, body_snippet, attachments, status, content_hash, read_pending)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (message_id) DO NOTHING
+            """, self._email_row(email_data))
+            return cur.rowcount == 1
+    
+    def insert_emails(self, emails):
+        """Insert a whole fetch window in one statement; returns the message_ids that were new."""
+        if not emails:
+            return set()
+        with self.pool.cursor() as cur:
+            inserted = execute_values(cur, """
+                INSERT INTO emails (message_id, sender, subject, date, body_snippet, attachments, status, content_hash, read_pending)
+                VALUES %s
+                ON CONFLICT (message_id) DO NOTHING
+                RETURNING message_id
+            """, [self._email_row(email) for email in emails], page_size=1000, fetch=True)
+            return {row[0] for row in inserted}
+    
+    def copy_emails(self, emails):
+        """COPY-based variant of insert_emails for large backfills."""
+        if not emails:
+            return set()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for email in emails:
+            writer.writerow([
+                email['message_id'],
+                email['sender'],
+                email['subject'],
+                email['date'].isoformat() if email.get('date') else None,
+                email['body_snippet'],
+                json.dumps(email.get('attachments', [])),
+                email.get('status', NEW_STATUS),
+                email.get('content_hash'),
+                email.get('status') == DUPLICATE_STATUS
+            ])
+        buffer.seek(0)
         
-        with self.conn.cursor() as cur:
+        with self.pool.cursor() as cur:
+            cur.execute("CREATE TEMP TABLE emails_staging (LIKE emails INCLUDING DEFAULTS) ON COMMIT DROP")
+            cur.copy_expert("""
+                COPY emails_staging (message_id, sender, subject, date, body_snippet, attachments, status, content_hash, read_pending)
+                FROM STDIN WITH (FORMAT csv)
+            """, buffer)
             cur.execute("""
-                INSERT INTO emails (message_id, sender, subject, date, body_snippet, attachments, status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """, (
-                email_data['message_id'],
-                email_data['sender'],
-                email_data['subject'],
-                email_data['date'],
-                email_data['body_snippet'],
-                Json(email_data.get('attachments', [])),
-                email_data.get('status', 'new')
-            ))
-            self.conn.commit()
-            return True
+                INSERT INTO emails (message_id, sender, subject, date, body_snippet, attachments, status, content_hash, read_pending)
+                SELECT DISTINCT ON (message_id) message_id, sender, subject, date, body_snippet, attachments, status, content_hash, read_pending
+                FROM emails_staging
+                ON CONFLICT (message_id) DO NOTHING
+                RETURNING message_id
+            """)
+            return {row[0] for row in cur.fetchall()}
     
     def update_status(self, message_id, status):
-        with self.conn.cursor() as cur:
+        with self.pool.cursor() as cur:
             cur.execute("UPDATE emails SET status = %s WHERE message_id = %s", (status, message_id))
-            self.conn.commit()
+    
+    def mark_processed(self, message_ids):
+        """Record that messages are done and flag them to be marked read in Gmail.
+        
+        Call inside the transaction that commits their claims, so an email is never
+        processed without its claim or left with a claim but still looking unprocessed.
+        """
+        if not message_ids:
+            return
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                UPDATE emails
+                SET read_pending = TRUE,
+                    status = CASE WHEN status = %s THEN status ELSE %s END
+                WHERE message_id = ANY(%s)
+            """, (DUPLICATE_STATUS, PROCESSED_STATUS, list(message_ids)))
+    
+    def mark_unextractable(self, message_ids):
+        """Record that no claim could be extracted, and flag the messages to be marked read in Gmail."""
+        if not message_ids:
+            return
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                UPDATE emails SET status = %s, read_pending = TRUE
+                WHERE message_id = ANY(%s) AND status = %s
+            """, (UNEXTRACTABLE_STATUS, list(message_ids), NEW_STATUS))
+    
+    def unfinished_ids(self, message_ids=None):
+        """Stored messages whose claim was never committed after an LLM or database failure; they need processing again.
+        
+        Checks ``message_ids``, or every stored message when it is None. Rows stored before emails
+        were marked processed count as done once a claim with their content hash exists.
+        """
+        if message_ids is not None and not message_ids:
+            return set()
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                SELECT e.message_id FROM emails e
+                WHERE (%(ids)s IS NULL OR e.message_id = ANY(%(ids)s))
+                  AND e.status = %(status)s
+                  AND NOT e.read_pending
+                  AND NOT EXISTS (SELECT 1 FROM claims c WHERE c.content_hash = e.content_hash)
+            """, {'ids': list(message_ids) if message_ids is not None else None, 'status': NEW_STATUS})
+            return {row[0] for row in cur.fetchall()}
+    
+    def read_pending_ids(self, limit=10000):
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT message_id FROM emails WHERE read_pending ORDER BY message_id LIMIT %s", (limit,))
+            return [row[0] for row in cur.fetchall()]
+    
+    def clear_read_pending(self, message_ids):
+        if not message_ids:
+            return
+        with self.pool.cursor() as cur:
+            cur.execute("UPDATE emails SET read_pending = FALSE WHERE message_id = ANY(%s)", (list(message_ids),))
     
     def insert_claim(self, claim_data):
-        with self.conn.cursor() as cur:
+        with self.pool.cursor() as cur:
             cur.execute("""
-                INSERT INTO claims (claim_id, member_id, diagnosis, requested_service, claim_amount, status)
+                INSERT INTO claims (member_id, diagnosis, requested_service, claim_amount, status)
                 VALUES (%s, %s, %s, %s, %s)
                 RETURNING claim_id
             """, (
@@ -84,16 +217,14 @@ class EmailDB:
                 claim_data.get('claim_amount'),
                 'NEW'
             ))
-            self.conn.commit()
             return cur.fetchone()[0]
     
     def update_claim_status(self, claim_id, status):
-        with self.conn.cursor() as cur:
+        with self.pool.cursor() as cur:
             cur.execute("UPDATE claims SET status = %s WHERE claim_id = %s", (status, claim_id))
-            self.conn.commit()
     
     def get_claim(self, claim_id):
-        with self.conn.cursor() as cur:
+        with self.pool.cursor() as cur:
             cur.execute("SELECT member_id, diagnosis, requested_service, claim_amount, status FROM claims WHERE claim_id = %s", (claim_id,))
             row = cur.fetchone()
             if row:
@@ -107,4 +238,5 @@ class EmailDB:
             return None
     
     def close(self):
-        self.conn.close()
+        # Connections belong to the shared pool; see db_pool.close_pool()
+        pass
@@ -0,0 +1,249 @@
+import psycopg2
+import psycopg2.extensions
+import os
+import threading
+import time
+from contextlib import contextmanager
+from metrics import metrics
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Thread-safe, size-limited pool of psycopg2 connections shared by all DB classes.
+
+    Connections are health-checked on checkout and transparently replaced when the
+    server has dropped them. ``transaction()`` opens a unit of work: every DB call
+    made on the same thread inside the block shares one connection and one commit.
+    ``after_commit`` defers in-memory bookkeeping until that commit has happened.
+    """
+    
+    def __init__(self, min_size=1, max_size=5, timeout=30, healthcheck_interval=30, max_lifetime=3600, **conn_kwargs):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.max_lifetime = max_lifetime
+        self.conn_kwargs = conn_kwargs
+        
+        self._idle = []  # (conn, created_at, last_used)
+        self._created = {}  # id(conn) -> created_at
+        self._lock = threading.Condition()
+        self._local = threading.local()
+        self._closed = False
+        
+        for _ in range(self.min_size):
+            conn = self._connect()
+            self._created[id(conn)] = time.monotonic()
+            self._idle.append((conn, self._created[id(conn)], time.monotonic()))
+    
+    @classmethod
+    def from_env(cls):
+        return cls(
+            min_size=int(os.getenv('DB_POOL_MIN', '1')),
+            max_size=int(os.getenv('DB_POOL_MAX', '5')),
+            timeout=float(os.getenv('DB_POOL_TIMEOUT', '30')),
+            host=os.getenv('DB_HOST'),
+            port=os.getenv('DB_PORT'),
+            database=os.getenv('DB_NAME'),
+            user=os.getenv('DB_USER'),
+            password=os.getenv('DB_PASSWORD')
+        )
+    
+    def _connect(self):
+        return psycopg2.connect(**self.conn_kwargs)
+    
+    def _discard(self, conn):
+        self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+    
+    def _is_healthy(self, conn, created_at, last_used):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if self.max_lifetime and time.monotonic() - created_at > self.max_lifetime:
+            return False
+        if time.monotonic() - last_used > self.healthcheck_interval:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+    
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise psycopg2.InterfaceError("connection pool is closed")
+                while self._idle:
+                    conn, created_at, last_used = self._idle.pop()
+                    if self._is_healthy(conn, created_at, last_used):
+                        return conn
+                    self._discard(conn)
+                if len(self._created) < self.max_size:
+                    # Reserve the slot before connecting so other threads see it
+                    placeholder = object()
+                    self._created[id(placeholder)] = time.monotonic()
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"no database connection available after {self.timeout}s")
+                self._lock.wait(remaining)
+        
+        try:
+            conn = self._connect()
+        except BaseException:
+            with self._lock:
+                self._created.pop(id(placeholder), None)
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._created.pop(id(placeholder), None)
+            self._created[id(conn)] = time.monotonic()
+        return conn
+    
+    def putconn(self, conn, discard=False):
+        with self._lock:
+            if id(conn) not in self._created:
+                return
+            if discard or self._closed or conn.closed:
+                self._discard(conn)
+            else:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        self._discard(conn)
+                        self._lock.notify()
+                        return
+                self._idle.append((conn, self._created[id(conn)], time.monotonic()))
+            self._lock.notify()
+    
+    @contextmanager
+    def transaction(self):
+        """Unit of work: nested calls on this thread reuse one connection and commit once."""
+        current = getattr(self._local, 'conn', None)
+        if current is not None:
+            yield current
+            return
+        
+        conn = self.getconn()
+        self._local.conn = conn
+        self._local.after_commit = []
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            raise
+        finally:
+            callbacks = self._local.after_commit
+            self._local.conn = None
+            self._local.after_commit = []
+            self.putconn(conn, discard=discard)
+        # Only reached once the commit succeeded; a rollback drops the callbacks
+        for callback in callbacks:
+            callback()
+    
+    @contextmanager
+    def cursor(self):
+        with self.transaction() as conn:
+            with metrics.span('claims_db_duration_seconds'), conn.cursor() as cur:
+                yield cur
+    
+    def dedicated_connection(self):
+        """A connection outside the pool's size limit, for long-lived sessions such as LISTEN."""
+        return self._connect()
+    
+    def after_commit(self, callback):
+        """Run ``callback`` once this thread's unit of work commits, or right away outside one."""
+        if self.in_transaction():
+            self._local.after_commit.append(callback)
+        else:
+            callback()
+    
+    def in_transaction(self):
+        return getattr(self._local, 'conn', None) is not None
+    
+    def stats(self):
+        with self._lock:
+            return {'open': len(self._created), 'idle': len(self._idle), 'max_size': self.max_size}
+    
+    def close(self):
+        with self._lock:
+            self._closed = True
+            while self._idle:
+                conn, _, _ = self._idle.pop()
+                self._discard(conn)
+            self._lock.notify_all()
+
+
+def add_missing(pool, table, columns=None, indexes=None):
+    """Create the columns and indexes of ``table`` that the catalog does not list yet.
+
+    ``columns`` and ``indexes`` map names to the statement creating them. ALTER TABLE and
+    CREATE INDEX lock the table even when IF NOT EXISTS turns them into no-ops, so nothing
+    runs when the schema is current. Returns the names that were created.
+    """
+    statements = dict(columns or {}, **(indexes or {}))
+    
+    def missing(cur):
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s
+            UNION ALL
+            SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s
+        """, (table, table))
+        present = {row[0] for row in cur.fetchall()}
+        return [name for name in statements if name not in present]
+    
+    with pool.cursor() as cur:
+        if not missing(cur):
+            return []
+    with pool.transaction():
+        with pool.cursor() as cur:
+            # Processes starting together apply the change once; the others find it done after waiting
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f'schema:{table}',))
+            names = missing(cur)
+            for name in names:
+                cur.execute(statements[name])
+            return names
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Process-wide pool built from the DB_* environment variables."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool._closed:
+            _pool = ConnectionPool.from_env()
+        return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
@@ -0,0 +1,91 @@
+import hashlib
+import re
+
+# Lines that start a forwarded or quoted copy of another email
+FORWARD_MARKER = re.compile(
+    r'^\s*(-{2,}\s*forwarded message\s*-{2,}|begin forwarded message:|-{2,}\s*original message\s*-{2,})\s*$',
+    re.I | re.M
+)
+
+# Header block that mail clients put under a forward marker
+FORWARD_HEADER = re.compile(r'^\s*(from|sent|date|to|cc|subject)\s*:', re.I)
+
+DUPLICATE_STATUS = 'duplicate'
+
+
+def normalise_body(body):
+    """Reduce a body to the claim text itself, so forwards and resends hash alike.
+
+    Only the text after the last forward marker is kept (the original submission),
+    without the From/Date/Subject header block that follows the marker. Quote
+    prefixes, case and whitespace differences are dropped.
+    """
+    body = body or ''
+    markers = list(FORWARD_MARKER.finditer(body))
+    if markers:
+        lines = body[markers[-1].end():].splitlines()
+        while lines and (not lines[0].strip() or FORWARD_HEADER.match(lines[0])):
+            lines.pop(0)
+        body = '\n'.join(lines)
+    body = re.sub(r'^[ \t]*(>[ \t]?)+', '', body, flags=re.M)
+    return ' '.join(body.lower().split())
+
+
+def attachment_fingerprint(attachment):
+    # Gmail attachment ids differ per message, so use the content hash when it is known
+    if attachment.get('sha256'):
+        return attachment['sha256']
+    filename = ' '.join(str(attachment.get('filename') or '').lower().split())
+    return f"{filename}|{attachment.get('mime_type')}|{attachment.get('size')}"
+
+
+def content_hash(email):
+    """SHA-256 of the normalised body and the sorted attachment fingerprints."""
+    parts = [normalise_body(email.get('body') or email.get('body_snippet'))]
+    parts.extend(sorted(attachment_fingerprint(attachment) for attachment in email.get('attachments') or []))
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+class Deduplicator:
+    """Spots resubmitted claims before any extraction or adjudication work.
+
+    ``check`` hashes a window of emails and, with one query, finds the ones whose
+    content was already received under another message_id and claimed, or queued
+    as a claim job. Copies within the same window are caught too. Each duplicate maps to the original message and, once
+    it has been decided, the original claim.
+    """
+    
+    def __init__(self, claims_db):
+        self.claims_db = claims_db
+    
+    def check(self, emails):
+        """Return {message_id: {'message_id', 'claim_id', 'status'}} for emails that repeat earlier content.
+
+        Every email gets its ``content_hash``; duplicates also get status 'duplicate',
+        which is what the emails table records for them.
+        """
+        for email in emails:
+            email['content_hash'] = content_hash(email)
+        known = self.claims_db.find_by_content_hashes(
+            {email['content_hash'] for email in emails},
+            [email['message_id'] for email in emails]
+        )
+        
+        duplicates = {}
+        first_seen = {}
+        for email in emails:
+            original = known.get(email['content_hash'])
+            if original is None and email['content_hash'] in first_seen:
+                original = {'message_id': first_seen[email['content_hash']], 'claim_id': None, 'status': None}
+            if original is None:
+                first_seen[email['content_hash']] = email['message_id']
+                continue
+            email['status'] = DUPLICATE_STATUS
+            duplicates[email['message_id']] = original
+        return duplicates
+
+
+def describe(original):
+    if original['claim_id'] is not None:
+        return f"resubmission of claim {original['claim_id']} ({original['status']})"
+    return f"resubmission of message {original['message_id']}"
@@ -0,0 +1,139 @@
+import re
+
+# Label spellings providers use in structured submissions. Longer labels come first
+# so "Claim Amount" wins over "Amount" and "Requested Service" over "Service".
+FIELD_LABELS = {
+    'member_id': [
+        r'member(?:ship)?\s*(?:id|no\.?|number|#)',
+        r'policy\s*holder\s*(?:id|no\.?|number)',
+        r'patient\s*(?:member\s*)?id',
+    ],
+    'diagnosis': [
+        r'primary\s*diagnosis',
+        r'diagnosis',
+        r'dx',
+    ],
+    'requested_service': [
+        r'requested\s*services?',
+        r'services?\s*requested',
+        r'procedure',
+        r'treatment',
+        r'services?',
+    ],
+    'claim_amount': [
+        r'(?:total\s*)?claim\s*amount',
+        r'amount\s*claimed',
+        r'total\s*amount',
+        r'amount',
+        r'total\s*cost',
+        r'cost',
+    ],
+}
+
+REQUIRED_FIELDS = ('member_id', 'diagnosis', 'requested_service', 'claim_amount')
+
+MEMBER_ID_PATTERN = re.compile(r'[A-Za-z0-9][A-Za-z0-9\-/]{2,}')
+AMOUNT_PATTERN = re.compile(r'^(?:ksh\.?|kes|usd|us\$|\$)?\s*([0-9][0-9,]*(?:\.[0-9]+)?)\s*(?:ksh|kes|usd|/=|/-)?\.?$', re.I)
+
+_LABEL_TO_FIELD = []
+for _field, _labels in FIELD_LABELS.items():
+    for _label in _labels:
+        _LABEL_TO_FIELD.append((re.compile(_label + r'$', re.I), _field))
+
+LABEL_PATTERN = re.compile(
+    r'(?<![A-Za-z])(' + '|'.join(label for labels in FIELD_LABELS.values() for label in labels) + r')\s*[:=#]\s*',
+    re.I
+)
+
+
+def _field_for(label):
+    for pattern, field in _LABEL_TO_FIELD:
+        if pattern.match(label.strip()):
+            return field
+    return None
+
+
+def parse_amount(value):
+    match = AMOUNT_PATTERN.match(value.strip())
+    if not match:
+        return None
+    try:
+        return float(match.group(1).replace(',', ''))
+    except ValueError:
+        return None
+
+
+def find_labelled_values(text):
+    """Return {field: [values]} for every "Label: value" pair, inline or one per line."""
+    values = {}
+    matches = list(LABEL_PATTERN.finditer(text))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        value = text[match.end():end].split('\n', 1)[0]
+        value = value.strip().strip(',;|*').strip()
+        field = _field_for(match.group(1))
+        if field and value:
+            values.setdefault(field, []).append(value)
+    return values
+
+
+class EmailExtractor:
+    """Rule and template based claim extraction, used as a fast path ahead of the LLM.
+
+    ``extract_claim_data`` returns the same dict shape as
+    OpenAIEmailAgent.extract_claim_data plus a ``confidence`` between 0 and 1, or
+    None when the email does not follow a known layout.
+    """
+    
+    def __init__(self, gmail_service=None):
+        self.service = gmail_service
+    
+    def extract_full_content(self, msg_id):
+        from gmail_reader import parse_message
+        msg = self.service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+        return parse_message(msg)
+    
+    def find_member_id(self, subject, body):
+        values = find_labelled_values(f"{subject}\n{body}").get('member_id', [])
+        for value in values:
+            match = MEMBER_ID_PATTERN.match(value)
+            if match:
+                return match.group(0)
+        return None
+    
+    def extract_claim_data(self, subject, body):
+        values = find_labelled_values(f"{subject}\n{body}")
+        if not values:
+            return None
+        
+        claim_data = {}
+        scores = {}
+        for field in REQUIRED_FIELDS:
+            candidates = values.get(field, [])
+            if not candidates:
+                claim_data[field] = None
+                scores[field] = 0.0
+                continue
+            
+            value = candidates[0]
+            # The same label with a different value elsewhere means we cannot tell which one is meant
+            score = 1.0 if len(set(v.lower() for v in candidates)) == 1 else 0.5
+            
+            if field == 'member_id':
+                match = MEMBER_ID_PATTERN.match(value)
+                value = match.group(0) if match else None
+                if match and match.end() < len(candidates[0].strip()):
+                    score = min(score, 0.75)
+            elif field == 'claim_amount':
+                value = parse_amount(value)
+                if value is not None and value <= 0:
+                    value = None
+            elif len(value) > 200:
+                score = min(score, 0.5)
+            
+            claim_data[field] = value
+            scores[field] = score if value is not None else 0.0
+        
+        claim_data['confidence'] = round(sum(scores.values()) / len(REQUIRED_FIELDS), 3)
+        claim_data['source'] = 'template'
+        return claim_data
@@ -0,0 +1,282 @@
+"""In-process stand-ins for the Gmail service and the OpenAI client, used by benchmark.py."""
+import base64
+import json
+import random
+import re
+import threading
+import time
+import types
+
+from email.utils import format_datetime
+from datetime import datetime, timezone
+
+
+def _sleep(latency):
+    if latency:
+        # +/-50% jitter so concurrent callers do not move in lockstep
+        time.sleep(latency * random.uniform(0.5, 1.5))
+
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+class _Request:
+    def __init__(self, service, run):
+        self.service = service
+        self.run = run
+    
+    def execute(self):
+        self.service._round_trip()
+        return self.run()
+
+
+class _Batch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+    
+    def add(self, request, request_id=None):
+        self.requests.append((request, request_id))
+    
+    def execute(self):
+        # The whole batch is one HTTP round trip
+        self.service._round_trip()
+        for request, request_id in self.requests:
+            try:
+                response = request.run()
+            except KeyError as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+
+class FakeGmailService:
+    """Enough of googleapiclient's Gmail v1 resource for GmailReader.
+
+    Each execute() (or batch execute) sleeps ``latency`` seconds and counts as one
+    call. ``delivered_at`` and ``read_at`` record when each message was fetched and
+    marked read, which benchmark.py turns into per-claim latency.
+    """
+    
+    def __init__(self, latency=0.0, label_name='Agentic_AI'):
+        self.latency = latency
+        self.label_id = 'Label_1'
+        self.label_name = label_name
+        self.messages_by_id = {}
+        self.history_records = []
+        self.history_id = 1000
+        self.calls = 0
+        self.delivered_at = {}
+        self.read_at = {}
+        self.attachment_data = {}
+        self._lock = threading.Lock()
+    
+    def _round_trip(self):
+        with self._lock:
+            self.calls += 1
+        _sleep(self.latency)
+    
+    def add_message(self, message_id, subject, body, sender='provider@example.com', attachments=None):
+        parts = [{'mimeType': 'text/plain', 'filename': '', 'body': {'data': _encode(body), 'size': len(body)}}]
+        for filename, mime_type, data in attachments or []:
+            attachment_id = f"att_{message_id}_{len(parts)}"
+            self.attachment_data[attachment_id] = data
+            parts.append({'mimeType': mime_type, 'filename': filename,
+                          'body': {'attachmentId': attachment_id, 'size': len(data)}})
+        with self._lock:
+            self.history_id += 1
+            self.messages_by_id[message_id] = {
+                'id': message_id,
+                'threadId': message_id,
+                'labelIds': [self.label_id, 'UNREAD', 'INBOX'],
+                'snippet': body[:100],
+                'historyId': str(self.history_id),
+                'payload': {
+                    'mimeType': 'multipart/mixed',
+                    'headers': [
+                        {'name': 'Subject', 'value': subject},
+                        {'name': 'From', 'value': sender},
+                        {'name': 'Date', 'value': format_datetime(datetime.now(timezone.utc))},
+                    ],
+                    'parts': parts
+                }
+            }
+            self.history_records.append({
+                'id': str(self.history_id),
+                'messagesAdded': [{'message': {'id': message_id, 'labelIds': [self.label_id, 'UNREAD']}}]
+            })
+    
+    # googleapiclient resource chain
+    def users(self):
+        return self
+    
+    def messages(self):
+        return self
+    
+    def labels(self):
+        return types.SimpleNamespace(list=lambda userId: _Request(self, lambda: {
+            'labels': [{'id': self.label_id, 'name': self.label_name}]
+        }))
+    
+    def history(self):
+        return _FakeHistory(self)
+    
+    def attachments(self):
+        return _FakeAttachments(self)
+    
+    def getProfile(self, userId):
+        return _Request(self, lambda: {'historyId': str(self.history_id)})
+    
+    def new_batch_http_request(self, callback=None):
+        return _Batch(self, callback)
+    
+    def _matches(self, message, q):
+        if 'is:unread' in (q or '') and 'UNREAD' not in message['labelIds']:
+            return False
+        label = re.search(r'label:(\S+)', q or '')
+        return not label or label.group(1) == self.label_name
+    
+    def list(self, userId, q=None, maxResults=100, pageToken=None, **kwargs):
+        def run():
+            # The page token is a position in the mailbox, so marking messages read mid-scan skips nothing
+            ids = list(self.messages_by_id)
+            position = int(pageToken or 0)
+            page = []
+            while position < len(ids) and len(page) < int(maxResults or 100):
+                if self._matches(self.messages_by_id[ids[position]], q):
+                    page.append(ids[position])
+                position += 1
+            response = {'messages': [{'id': message_id} for message_id in page]}
+            if position < len(ids):
+                response['nextPageToken'] = str(position)
+            return response
+        return _Request(self, run)
+    
+    def get(self, userId, id, format='full', **kwargs):
+        def run():
+            message = self.messages_by_id[id]
+            self.delivered_at.setdefault(id, time.perf_counter())
+            return json.loads(json.dumps(message))
+        return _Request(self, run)
+    
+    def _remove_labels(self, ids, label_ids):
+        now = time.perf_counter()
+        with self._lock:
+            for message_id in ids:
+                message = self.messages_by_id[message_id]
+                message['labelIds'] = [label for label in message['labelIds'] if label not in label_ids]
+                if 'UNREAD' in label_ids:
+                    self.read_at.setdefault(message_id, now)
+    
+    def modify(self, userId, id, body):
+        return _Request(self, lambda: self._remove_labels([id], body.get('removeLabelIds', [])) or {})
+    
+    def batchModify(self, userId, body):
+        return _Request(self, lambda: self._remove_labels(body['ids'], body.get('removeLabelIds', [])))
+
+
+class _FakeHistory:
+    def __init__(self, service):
+        self.service = service
+    
+    def list(self, userId, startHistoryId, historyTypes=None, labelId=None, maxResults=100, pageToken=None):
+        def run():
+            records = [record for record in self.service.history_records if int(record['id']) > int(startHistoryId)]
+            start = int(pageToken or 0)
+            page = records[start:start + int(maxResults)]
+            response = {'history': page, 'historyId': str(self.service.history_id)}
+            if start + len(page) < len(records):
+                response['nextPageToken'] = str(start + len(page))
+            return response
+        return _Request(self.service, run)
+
+
+class _FakeAttachments:
+    def __init__(self, service):
+        self.service = service
+    
+    def get(self, userId, messageId, id):
+        return _Request(self.service, lambda: {
+            'data': base64.urlsafe_b64encode(self.service.attachment_data[id]).decode('ascii'),
+            'size': len(self.service.attachment_data[id])
+        })
+
+
+
+# Free-text claims written by benchmark.py follow this sentence shape
+FREE_TEXT_PATTERN = re.compile(
+    r'member (?P<member_id>\S+?)[,.]? .*?diagnosed with (?P<diagnosis>.+?) and needs (?P<requested_service>.+?)\. '
+    r'.*?(?:cost|amount) (?:is|of) (?:KES )?(?P<claim_amount>[0-9,.]+)',
+    re.S | re.I
+)
+LABELLED_FIELD = re.compile(r'^(Member ID|Diagnosis|Requested Service|Claim Amount):\s*(.+)$', re.M)
+
+
+class FakeOpenAIClient:
+    """chat.completions.create stand-in that answers from the prompt text.
+
+    Extraction reads the fields back out of the email, adjudication denies services
+    that appear among the policy's exclusions and approves the rest. Each call sleeps
+    ``latency`` seconds, or ``model_latency[model]`` for the models listed there,
+    reports a confidence when the prompt asks for one and token usage like the real API.
+    """
+    
+    def __init__(self, latency=0.0, failure_rate=0.0, model_latency=None):
+        self.latency = latency
+        self.model_latency = model_latency or {}
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self.calls_by_model = {}
+        self._lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+    
+    def _extract(self, prompt):
+        email = prompt.split('Email Subject:', 1)[-1]
+        labelled = {label.lower(): value.strip() for label, value in LABELLED_FIELD.findall(email)}
+        if labelled:
+            amount = re.sub(r'[^0-9.]', '', labelled.get('claim amount', ''))
+            return {
+                'member_id': labelled.get('member id'),
+                'diagnosis': labelled.get('diagnosis'),
+                'requested_service': labelled.get('requested service'),
+                'claim_amount': float(amount) if amount else None
+            }
+        match = FREE_TEXT_PATTERN.search(email)
+        if not match:
+            return {'member_id': None, 'diagnosis': None, 'requested_service': None, 'claim_amount': None}
+        claim = match.groupdict()
+        claim['claim_amount'] = float(claim['claim_amount'].replace(',', '').rstrip('.'))
+        return claim
+    
+    def _adjudicate(self, prompt):
+        service = re.search(r'Requested Service: (.+)', prompt)
+        context = prompt.split('Policy Context:', 1)[-1].split('\n\n', 2)[1] if 'Policy Context:' in prompt else ''
+        excluded = service and service.group(1).strip().lower() in context.lower() and 'exclu' in context.lower()
+        if excluded:
+            return {'decision': 'DENIED', 'reasoning': 'Service is excluded under the policy.'}
+        return {'decision': 'APPROVED', 'reasoning': 'Medically necessary for the diagnosis and covered by the policy.'}
+    
+    def create(self, model=None, messages=None, response_format=None, max_tokens=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.calls_by_model[model] = self.calls_by_model.get(model, 0) + 1
+        _sleep(self.model_latency.get(model, self.latency))
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError('simulated OpenAI failure')
+        
+        prompt = messages[-1]['content']
+        confidence = {'confidence': 0.9} if '- confidence' in prompt or '"confidence"' in prompt else {}
+        if response_format:
+            claim = self._extract(prompt)
+            adjudication = self._adjudicate(prompt + f"\nRequested Service: {claim['requested_service']}")
+            content = json.dumps(dict({'claim': claim, 'adjudication': adjudication}, **confidence))
+        elif prompt.startswith('Extract claim information'):
+            content = json.dumps(dict(self._extract(prompt), **confidence))
+        else:
+            content = json.dumps(dict(self._adjudicate(prompt), **confidence))
+        
+        usage = types.SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(content) // 4)
+        message = types.SimpleNamespace(content=content, refusal=None)
+        return types.SimpleNamespace(model=model, choices=[types.SimpleNamespace(message=message)], usage=usage)
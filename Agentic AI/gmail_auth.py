@@ -0,0 +1,120 @@
+"""Gmail credentials and service construction, kept cheap for short-lived processes.
+
+The Google client libraries are imported only when a real service is built, so
+runs against a passed-in service (and every module that merely imports
+gmail_reader) skip them. Credentials live in token.json, shared by every process
+on the host: a process only refreshes the token under a file lock and after
+re-reading it, so a fleet of workers starting together refreshes it once.
+
+    python gmail_auth.py                        # authorise once and write token.json
+    python gmail_auth.py --save-discovery PATH  # write the Gmail discovery document for GMAIL_DISCOVERY_DOCUMENT
+"""
+import os
+import pickle
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+
+# Written by releases that stored credentials with pickle; read once and converted to token.json
+LEGACY_TOKEN_PATH = 'token.pickle'
+
+
+@contextmanager
+def _locked(path):
+    """Exclusive lock on ``path``.lock, so only one process at a time refreshes or writes the token."""
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read(token_path):
+    if os.path.exists(token_path):
+        from google.oauth2.credentials import Credentials
+        return Credentials.from_authorized_user_file(token_path, SCOPES)
+    if os.path.exists(LEGACY_TOKEN_PATH):
+        with open(LEGACY_TOKEN_PATH, 'rb') as token:
+            return pickle.load(token)
+    return None
+
+
+def _write(token_path, creds):
+    # Write then rename so another process never reads a half-written token
+    temp_path = f"{token_path}.{os.getpid()}.tmp"
+    with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as token:
+        token.write(creds.to_json())
+    os.replace(temp_path, token_path)
+
+
+def get_credentials(token_path=None):
+    """Valid Gmail credentials, refreshing or authorising only when no process has done it already."""
+    token_path = token_path or os.getenv('GMAIL_TOKEN_PATH', 'token.json')
+    creds = _read(token_path)
+    if creds and creds.valid and os.path.exists(token_path):
+        return creds
+    
+    with _locked(token_path):
+        # Another process may have refreshed the token while this one waited for the lock
+        creds = _read(token_path)
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                from google.auth.transport.requests import Request
+                creds.refresh(Request())
+            else:
+                from google_auth_oauthlib.flow import InstalledAppFlow
+                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+                creds = flow.run_local_server(port=0)
+        _write(token_path, creds)
+    return creds
+
+
+def build_service(creds=None):
+    """Gmail API client built from a local discovery document, without any network call."""
+    import httplib2
+    import google_auth_httplib2
+    from googleapiclient.discovery import build, build_from_document
+    
+    # Without a timeout a stalled connection hangs the run forever
+    http = google_auth_httplib2.AuthorizedHttp(
+        creds or get_credentials(), http=httplib2.Http(timeout=float(os.getenv('GMAIL_TIMEOUT', '30')))
+    )
+    document_path = os.getenv('GMAIL_DISCOVERY_DOCUMENT')
+    if document_path:
+        with open(document_path) as document:
+            return build_from_document(document.read(), http=http)
+    # The document bundled with google-api-python-client; never fetched or cached at runtime
+    return build('gmail', 'v1', http=http, static_discovery=True, cache_discovery=False)
+
+
+def save_discovery_document(path):
+    from googleapiclient.discovery_cache import get_static_doc
+    document = get_static_doc('gmail', 'v1')
+    if document is None:
+        raise RuntimeError('this google-api-python-client has no bundled Gmail discovery document')
+    with open(path, 'w') as f:
+        f.write(document)
+
+
+if __name__ == '__main__':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Authorise Gmail access or save its discovery document.')
+    parser.add_argument('--save-discovery', metavar='PATH', help='write the Gmail v1 discovery document to PATH')
+    args = parser.parse_args()
+    
+    if args.save_discovery:
+        save_discovery_document(args.save_discovery)
+        print(f"Saved the Gmail discovery document to {args.save_discovery}")
+    else:
+        get_credentials()
+        print(f"Credentials stored in {os.getenv('GMAIL_TOKEN_PATH', 'token.json')}")
@@ -1,37 +1,169 @@
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-import os
-import pickle
-from datetime import datetime
+import base64
+import itertools
 from email.utils import parsedate_to_datetime
+from metrics import metrics
+from attachments import AttachmentProcessor, html_to_text
+from rate_limiter import get_limiter, is_retryable, status_of
+from gmail_auth import build_service
+
+# Gmail rejects batches larger than 100 calls and starts rate limiting well before
+# that, so 50 is the documented sweet spot.
+BATCH_SIZE = 50
+
+# messages.list returns at most 500 ids per page
+PAGE_SIZE = 500
+
+# messages.batchModify accepts at most 1000 message ids per call
+BATCH_MODIFY_LIMIT = 1000
+
+# Per-user quota units charged by Gmail for each method
+QUOTA_UNITS = {'list': 5, 'get': 5, 'attachment': 5, 'modify': 5, 'batch_modify': 50, 'history': 2, 'profile': 1, 'labels': 1}
+
+
+def parse_limit(value):
+    """Turn a limit such as the MAX_EMAILS setting into a positive int, or None for no limit."""
+    if value is None or (isinstance(value, str) and value.strip().lower() in ('', 'none', 'all')):
+        return None
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Email limit must be a whole number, got {value!r}")
+    if limit <= 0:
+        raise ValueError(f"Email limit must be positive, got {limit}")
+    return limit
+
+
+def chunks(iterable, size):
+    """Split a stream into lists of at most ``size`` items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _decode(data):
+    return base64.urlsafe_b64decode(data).decode('utf-8', errors='replace')
+
+
+def _walk_parts(part):
+    yield part
+    for child in part.get('parts', []) or []:
+        yield from _walk_parts(child)
+
+
+def extract_body(payload, snippet=''):
+    """Decode the plain-text body of a message payload, falling back to the snippet."""
+    if payload.get('body', {}).get('data') and not payload.get('parts'):
+        return _decode(payload['body']['data'])
+    
+    for part in _walk_parts(payload):
+        if part.get('mimeType') == 'text/plain' and not part.get('filename') and part.get('body', {}).get('data'):
+            return _decode(part['body']['data'])
+    
+    # HTML-only messages
+    for part in _walk_parts(payload):
+        if part.get('mimeType') == 'text/html' and not part.get('filename') and part.get('body', {}).get('data'):
+            return html_to_text(_decode(part['body']['data']))
+    
+    return snippet
+
+
+def extract_attachments(payload):
+    attachments = []
+    for part in _walk_parts(payload):
+        if not part.get('filename'):
+            continue
+        body = part.get('body', {})
+        attachment = {
+            'filename': part['filename'],
+            'mime_type': part.get('mimeType'),
+            'size': body.get('size', 0),
+            'attachment_id': body.get('attachmentId')
+        }
+        # Gmail inlines the content of small attachments instead of giving an id
+        if body.get('data'):
+            attachment['data'] = body['data']
+        attachments.append(attachment)
+    return attachments
+
+
+def parse_message(msg):
+    """Turn a format='full' Gmail message into the email record used across the pipeline."""
+    payload = msg.get('payload', {})
+    headers = payload.get('headers', [])
+    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
+    sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown')
+    date_str = next((h['value'] for h in headers if h['name'] == 'Date'), None)
+    
+    date = parsedate_to_datetime(date_str) if date_str else None
+    
+    return {
+        'message_id': msg['id'],
+        'thread_id': msg.get('threadId'),
+        'label_ids': msg.get('labelIds', []),
+        'sender': sender,
+        'subject': subject,
+        'date': date,
+        'headers': {h['name']: h['value'] for h in headers},
+        'body_snippet': msg.get('snippet', ''),
+        'body': extract_body(payload, msg.get('snippet', '')),
+        'attachments': extract_attachments(payload)
+    }
 
-SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
 class GmailReader:
-    def __init__(self):
-        self.service = self._authenticate()
+    def __init__(self, service=None):
+        # Passing a service skips OAuth entirely, which is how tests drive a fake Gmail
+        self.service = service or self._authenticate()
+        self._label_ids = {}
+        self.limiter = get_limiter('gmail')
+        self.attachments = AttachmentProcessor(self)
     
     def _authenticate(self):
-        creds = None
-        if os.path.exists('token.pickle'):
-            with open('token.pickle', 'rb') as token:
-                creds = pickle.load(token)
-        
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-                creds = flow.run_local_server(port=0)
+        # The Google client libraries are imported here, not at module load
+        return build_service()
+    
+    def _execute(self, operation, request, cost=None):
+        """Run one API request within the shared Gmail quota, retrying throttled and transient failures."""
+        def send():
+            with metrics.span('claims_gmail_request_duration_seconds', operation=operation):
+                return request.execute()
+        return self.limiter.call(send, cost=cost or QUOTA_UNITS.get(operation, 5))
+    
+    def list_message_ids(self, query, limit=None):
+        """Yield message ids matching ``query`` page by page, stopping after ``limit`` ids."""
+        remaining = limit
+        page_token = None
+        while remaining is None or remaining > 0:
+            request = {'userId': 'me', 'q': query, 'maxResults': PAGE_SIZE if remaining is None else min(PAGE_SIZE, remaining)}
+            if page_token:
+                request['pageToken'] = page_token
+            results = self._execute('list', self.service.users().messages().list(**request))
             
-            with open('token.pickle', 'wb') as token:
-                pickle.dump(creds, token)
+            for msg in results.get('messages', []):
+                yield msg['id']
+                if remaining is not None:
+                    remaining -= 1
+                    if remaining == 0:
+                        return
+            
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return
+    
+    def iter_emails(self, max_results=None, label_name=None, unread_only=False):
+        """Stream matching emails, fetching BATCH_SIZE at a time, across every results page.
         
-        return build('gmail', 'v1', credentials=creds)
+        ``max_results`` caps the number of emails (None for no cap); strings such as the
+        MAX_EMAILS setting are accepted and validated.
+        """
+        query = self._query(label_name, unread_only)
+        for msg_ids in chunks(self.list_message_ids(query, parse_limit(max_results)), BATCH_SIZE):
+            yield from self.get_messages(msg_ids)
     
-    def fetch_emails(self, max_results=10, label_name=None, unread_only=False):
+    def _query(self, label_name=None, unread_only=False):
         query_parts = []
         if label_name:
             query_parts.append(f'label:{label_name}')
@@ -41,39 +173,159 @@ class GmailReader:
         if unread_only:
             query_parts.append('is:unread')
         
-        query = ' '.join(query_parts)
-        results = self.service.users().messages().list(userId='me', q=query, maxResults=max_results).execute()
-        messages = results.get('messages', [])
+        return ' '.join(query_parts)
+    
+    def fetch_emails(self, max_results=10, label_name=None, unread_only=False):
+        return list(self.iter_emails(max_results=max_results, label_name=label_name, unread_only=unread_only))
+    
+    def get_label_id(self, label_name):
+        """The history API filters by label id, not by the name used in search queries."""
+        if label_name not in self._label_ids:
+            labels = self._execute('labels', self.service.users().labels().list(userId='me')).get('labels', [])
+            self._label_ids.update({label['name']: label['id'] for label in labels})
+        return self._label_ids.get(label_name, label_name)
+    
+    def get_history_id(self):
+        return self._execute('profile', self.service.users().getProfile(userId='me'))['historyId']
+    
+    def _history_message_ids(self, start_history_id, label_id, limit=None):
+        """Ids of messages added to (or labelled into) ``label_id`` since ``start_history_id``.
         
-        emails = []
-        for msg in messages:
-            email_data = self._get_email_details(msg['id'])
-            if email_data:
-                emails.append(email_data)
+        Returns (msg_ids, latest_history_id); raises an HttpError with status 404 once the history has expired.
+        Once ``limit`` ids are collected it stops at a history record boundary and returns that record's id,
+        so the next sync picks up where this one stopped.
+        """
+        msg_ids = []
+        seen = set()
+        latest_history_id = start_history_id
+        page_token = None
+        while True:
+            request = {
+                'userId': 'me',
+                'startHistoryId': start_history_id,
+                'historyTypes': ['messageAdded', 'labelAdded'],
+                'maxResults': 500
+            }
+            if label_id:
+                request['labelId'] = label_id
+            if page_token:
+                request['pageToken'] = page_token
+            response = self._execute('history', self.service.users().history().list(**request))
+            
+            for record in response.get('history', []):
+                if limit is not None and len(msg_ids) >= limit:
+                    return msg_ids, latest_history_id
+                added = record.get('messagesAdded', []) + [
+                    change for change in record.get('labelsAdded', [])
+                    if not label_id or label_id in change.get('labelIds', [])
+                ]
+                for change in added:
+                    msg_id = change['message']['id']
+                    if msg_id not in seen:
+                        seen.add(msg_id)
+                        msg_ids.append(msg_id)
+                latest_history_id = record['id']
+            
+            latest_history_id = response.get('historyId', latest_history_id)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return msg_ids, latest_history_id
+    
+    def sync_emails(self, history_id=None, max_results=None, label_name=None, unread_only=False):
+        """Incremental fetch: only messages added since ``history_id``.
         
-        return emails
+        Returns (emails, new_history_id), where emails is a stream like iter_emails. Without a history_id, or when Gmail no longer
+        has history that old, this falls back to a full fetch_emails query. ``max_results`` caps both; when it cuts a full
+        query short, new_history_id is None so the position is not advanced past mail that was never fetched.
+        """
+        limit = parse_limit(max_results)
+        if history_id:
+            try:
+                msg_ids, new_history_id = self._history_message_ids(
+                    history_id, self.get_label_id(label_name) if label_name else None, limit
+                )
+                emails = self.iter_messages(msg_ids)
+                if unread_only:
+                    emails = (email for email in emails if 'UNREAD' in email['label_ids'])
+                return emails, new_history_id
+            except Exception as e:
+                if status_of(e) != 404:
+                    raise
+                print(f"Gmail history {history_id} has expired; running a full resync")
+        
+        # Read the mailbox position first so nothing that arrives during the query is skipped
+        new_history_id = self.get_history_id()
+        # One id past the limit tells whether the query was cut short
+        msg_ids = list(self.list_message_ids(self._query(label_name, unread_only), None if limit is None else limit + 1))
+        if limit is not None and len(msg_ids) > limit:
+            msg_ids = msg_ids[:limit]
+            new_history_id = None
+        return self.iter_messages(msg_ids), new_history_id
     
-    def _get_email_details(self, msg_id):
-        msg = self.service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+    def iter_messages(self, msg_ids):
+        """get_messages for a long id list, yielding each batch as soon as it arrives."""
+        for start in range(0, len(msg_ids), BATCH_SIZE):
+            yield from self.get_messages(msg_ids[start:start + BATCH_SIZE])
+    
+    def get_messages(self, msg_ids):
+        """Fetch full messages with one batched HTTP call per BATCH_SIZE ids, keeping input order.
         
-        headers = msg['payload']['headers']
-        subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-        sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown')
-        date_str = next((h['value'] for h in headers if h['name'] == 'Date'), None)
+        Messages whose part of a batch was throttled (or failed transiently) are fetched
+        again in a later batch after a backoff, up to the limiter's retry budget.
+        """
+        fetched = {}
+        errors = {}
         
-        date = parsedate_to_datetime(date_str) if date_str else None
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+            else:
+                errors.pop(request_id, None)
+                fetched[request_id] = parse_message(response)
         
-        return {
-            'message_id': msg['id'],
-            'sender': sender,
-            'subject': subject,
-            'date': date,
-            'body_snippet': msg.get('snippet', '')
-        }
+        pending = list(msg_ids)
+        for attempt in range(self.limiter.max_retries + 1):
+            for start in range(0, len(pending), BATCH_SIZE):
+                window = pending[start:start + BATCH_SIZE]
+                batch = self.service.new_batch_http_request(callback=on_response)
+                for msg_id in window:
+                    batch.add(
+                        self.service.users().messages().get(userId='me', id=msg_id, format='full'),
+                        request_id=msg_id
+                    )
+                self._execute('batch_get', batch, cost=QUOTA_UNITS['get'] * len(window))
+            
+            pending = [msg_id for msg_id, exception in errors.items() if is_retryable(exception)]
+            if not pending or attempt == self.limiter.max_retries:
+                break
+            self.limiter.backoff(attempt, errors[pending[0]])
+        
+        for msg_id, exception in errors.items():
+            print(f"Failed to fetch message {msg_id}: {exception}")
+        
+        return self.attachments.process([fetched[msg_id] for msg_id in msg_ids if msg_id in fetched])
+    
+    def get_attachment_data(self, msg_id, attachment_id):
+        """Base64url content of one attachment."""
+        return self._execute('attachment', self.service.users().messages().attachments().get(
+            userId='me', messageId=msg_id, id=attachment_id
+        ))['data']
+    
+    def _get_email_details(self, msg_id):
+        msg = self._execute('get', self.service.users().messages().get(userId='me', id=msg_id, format='full'))
+        return parse_message(msg)
     
     def mark_as_read(self, msg_id):
-        self.service.users().messages().modify(
+        self._execute('modify', self.service.users().messages().modify(
             userId='me',
             id=msg_id,
             body={'removeLabelIds': ['UNREAD']}
-        ).execute()
+        ))
+    
+    def mark_messages_read(self, msg_ids):
+        """Remove UNREAD from many messages with one batchModify call per 1000 ids."""
+        for window in chunks(msg_ids, BATCH_MODIFY_LIMIT):
+            self._execute('batch_modify', self.service.users().messages().batchModify(
+                userId='me',
+                body={'ids': window, 'removeLabelIds': ['UNREAD']}
+            ))
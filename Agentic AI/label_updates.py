@@ -0,0 +1,57 @@
+import os
+from gmail_reader import BATCH_MODIFY_LIMIT
+from metrics import metrics
+
+
+class LabelUpdateBuffer:
+    """Collects messages to mark read and sends them to Gmail in batchModify calls.
+
+    Callers add a message only after its claim is committed. The commit also sets
+    ``emails.read_pending``, and ``flush`` clears that flag once Gmail accepts the
+    batch. If the process dies in between, ``recover`` on the next start finds the
+    messages that are still flagged and marks them read. A failed flush keeps its
+    ids for the next attempt. A buffer that reaches ``max_ids`` flushes itself.
+    """
+    
+    def __init__(self, gmail, email_db=None, max_ids=None):
+        self.gmail = gmail
+        self.email_db = email_db
+        self.max_ids = min(max_ids or int(os.getenv('LABEL_BATCH_SIZE', str(BATCH_MODIFY_LIMIT))), BATCH_MODIFY_LIMIT)
+        # dict keeps insertion order and drops repeats
+        self._pending = {}
+    
+    def __len__(self):
+        return len(self._pending)
+    
+    def add(self, message_ids):
+        for message_id in message_ids:
+            self._pending[message_id] = None
+        if len(self._pending) >= self.max_ids:
+            self.flush()
+    
+    def recover(self):
+        """Queue the messages whose claims were committed but which were never marked read."""
+        if self.email_db is None:
+            return 0
+        message_ids = self.email_db.read_pending_ids()
+        self.add(message_ids)
+        return len(message_ids)
+    
+    def flush(self):
+        """Mark everything buffered as read; returns how many messages Gmail accepted."""
+        marked = 0
+        while self._pending:
+            batch = list(self._pending)[:self.max_ids]
+            try:
+                with metrics.span('claims_stage_duration_seconds', stage='mark_read'):
+                    self.gmail.mark_messages_read(batch)
+            except Exception as e:
+                print(f"Failed to mark {len(batch)} emails as read, will retry: {e}")
+                break
+            if self.email_db is not None:
+                self.email_db.clear_read_pending(batch)
+            for message_id in batch:
+                del self._pending[message_id]
+            metrics.inc('claims_label_updates_total', len(batch))
+            marked += len(batch)
+        return marked
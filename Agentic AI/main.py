@@ -1,164 +1,200 @@
 from dotenv import load_dotenv
-from gmail_reader import GmailReader
+from gmail_reader import GmailReader, chunks, parse_limit, BATCH_SIZE
 from db_manager import EmailDB
-from openai_agent import OpenAIEmailAgent
-from claims_db import ClaimsDB
-from members_db import MembersDB
-from policies_db import PoliciesDB
-import base64
+from claim_processor import ClaimProcessor
+from claims_store import ClaimsStore
+from batch_writer import BatchWriter
+from db_pool import get_pool, close_pool
+from metrics import metrics
+from dedupe import describe
+from label_updates import LabelUpdateBuffer
+import itertools
 import os
 
-def extract_email_body(gmail_service, msg_id):
-    msg = gmail_service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-    payload = msg['payload']
-    
-    if 'body' in payload and payload['body'].get('data'):
-        return base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
-    
-    if 'parts' in payload:
-        for part in payload['parts']:
-            if part['mimeType'] == 'text/plain' and part['body'].get('data'):
-                return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+SYNC_KEY = 'gmail:Agentic_AI'
+
+def pause():
+    # STEP_THROUGH=off lets the script run unattended; worker.py is the long-running mode
+    if os.getenv('STEP_THROUGH', 'on') != 'off':
+        input("Press Enter to continue...")
+
+def with_unfinished(gmail, email_db, emails):
+    """Emails an earlier run stored but never finished, fetched again, then ``emails`` without them.
     
-    return msg.get('snippet', '')
+    An incremental sync lists each message once, so an email whose extraction or adjudication
+    failed would otherwise never come back.
+    """
+    message_ids = sorted(email_db.unfinished_ids())
+    if message_ids:
+        print(f"Retrying {len(message_ids)} emails left unfinished by an earlier run")
+    retried = set(message_ids)
+    return itertools.chain(gmail.iter_messages(message_ids), (email for email in emails if email['message_id'] not in retried))
 
 """ this is the main workflow executing all requests """
-def main():
+def main(gmail=None, agent=None, pool=None):
+    """gmail, agent and pool default to the real services; benchmark.py passes fakes."""
     load_dotenv()
     
+    """creating an instance of functions to be used, all sharing one connection pool"""
+    pool = pool or get_pool()
+    email_db = EmailDB(pool)
+    
     print("Fetching unread emails from Gmail (Agentic_AI label)...")
-    gmail = GmailReader()
-    emails = gmail.fetch_emails(max_results=os.getenv('MAX_EMAILS'), label_name='Agentic_AI', unread_only=True)
-    print(f"Found {len(emails)} unread emails\n")
+    gmail = gmail or GmailReader()
+    max_emails = parse_limit(os.getenv('MAX_EMAILS'))
+    history_id = None
+    # Emails are streamed page by page, so processing starts with the first batch
+    if os.getenv('GMAIL_SYNC', 'full') == 'incremental':
+        # Only messages added since the last run; the stored position advances once they are handled
+        emails, history_id = gmail.sync_emails(
+            email_db.get_history_id(SYNC_KEY), max_results=max_emails,
+            label_name='Agentic_AI', unread_only=True
+        )
+    else:
+        emails = gmail.iter_emails(max_results=max_emails, label_name='Agentic_AI', unread_only=True)
+    emails = with_unfinished(gmail, email_db, emails)
     
-    """creating an instance of functions to be used"""
-    email_db = EmailDB()
-    claims_db = ClaimsDB()
-    members_db = MembersDB()
-    policies_db = PoliciesDB()
-    agent = OpenAIEmailAgent()
+    processor = ClaimProcessor(pool, agent=agent)
+    
+    # Messages whose claims were committed before a crash, but which were never marked read
+    labels = LabelUpdateBuffer(gmail, email_db)
+    if labels.recover():
+        print(f"Marked {labels.flush()} emails from an earlier run as read")
+    
+    # Claim totals recorded by earlier runs; daily_totals reads the rest straight from the deltas
+    ClaimsStore(pool).rollup_summary()
+    
+    run_mode = os.getenv('RUN_MODE', 'sequential')
+    if run_mode in ('pipeline', 'backlog'):
+        if run_mode == 'pipeline':
+            from pipeline import run_pipeline
+            run_pipeline(emails, gmail, email_db, processor)
+        else:
+            from batch_adjudication import run_backlog
+            run_backlog(emails, gmail, email_db, processor)
+        if history_id:
+            email_db.save_history_id(SYNC_KEY, history_id)
+        if processor.report():
+            print(processor.report())
+        print(metrics.report())
+        metrics.export()
+        processor.close()
+        close_pool()
+        return
     
     new_count = 0
     duplicate_count = 0
     
-    """iterate through emails and process each one"""""
-    for email in emails:
-        if email_db.insert_email(email):
-            new_count += 1
-            print(f"Added email: {email['subject'][:50]}")
-            
-            # Extract full body
-            full_body = extract_email_body(gmail.service, email['message_id'])
-            print(full_body)
-            input("Press Enter to continue...")
+    for window in chunks(emails, BATCH_SIZE):
+        print(f"Fetched {len(window)} unread emails\n")
         
-            # Extract claim data using LLM
-            claim_data = agent.extract_claim_data(email['subject'], full_body)
-            print(claim_data)
-            input("Press Enter to continue...")
-
-            if not claim_data:
-                print("  Could not extract claim data\n")
-                continue
-            
-            print(f"  Extracted: Member {claim_data.get('member_id')}, ${claim_data.get('claim_amount')}")
-            
-            # Check member existence and policy balance
-            member = members_db.get_member(claim_data['member_id'])
-            
-            """if member is not found status column will be labeled DENIED"""
-            if not member:
-                print(f"   Member {claim_data['member_id']} not found")
-                claims_db.insert_claim(
-                    claim_data['member_id'],
-                    claim_data['diagnosis'],
-                    claim_data['requested_service'],
-                    claim_data['claim_amount']
-                )
-                claims_db.update_claim_status(
-                    claims_db.conn.cursor().lastrowid,
-                    'DENIED',
-                    'Member not found in system'
-                )
-                continue
-            
-            print(f"   Member found: {member['full_name']} (Balance: Ksh.{member['policy_balance']})")
-            
-            # Check policy balance
-            if member['policy_balance'] <= claim_data['claim_amount']:
-                print(f"  Insufficient balance: ${member['policy_balance']} < ${claim_data['claim_amount']}")
-                claim_id = claims_db.insert_claim(
-                    claim_data['member_id'],
-                    claim_data['diagnosis'],
-                    claim_data['requested_service'],
-                    claim_data['claim_amount']
-                )
-                claims_db.update_claim_status(
-                    claim_id,
-                    'DENIED',
-                    f'Insufficient policy balance: ${member["policy_balance"]} available, ${claim_data["claim_amount"]} required'
-                )
-                print(f"    Claim ID {claim_id}: DENIED - Insufficient balance\n")
-                gmail.mark_as_read(email['message_id'])
-                continue
-            
-            # Store in claims table
-            claim_id = claims_db.insert_claim(
-                claim_data['member_id'],
-                claim_data['diagnosis'],
-                claim_data['requested_service'],
-                claim_data['claim_amount']
-            )
-            print(f"    Stored as Claim ID: {claim_id}")
-            
-            # Retrieve policy context for RAG
-            policy_context = policies_db.get_policy(member['policy_id'])
-            if policy_context:
-                print(f"    Retrieved policy context: {member['policy_id']}")
-            
-            # Clinical adjudication using LLM with RAG (only if balance is sufficient)
-            adjudication = agent.clinical_adjudication(
-                claim_data['diagnosis'],
-                claim_data['requested_service'],
-                policy_context
-            )
-            
-            # Final decision combines clinical and financial checks
-            final_decision = adjudication['decision']
-            final_reasoning = f"Policy balance: ${member['policy_balance']}. Clinical: {adjudication['reasoning']}"
-            
-            # Update claim status
-            claims_db.update_claim_status(
-                claim_id,
-                final_decision,
-                final_reasoning
-            )
-            
-            # Deduct from policy balance if approved
-            if final_decision == 'APPROVED':
-                members_db.deduct_from_balance(claim_data['member_id'], claim_data['claim_amount'])
-                new_balance = member['policy_balance'] - claim_data['claim_amount']
+        # Resubmissions are matched to their original claim before they are stored
+        resubmitted = processor.find_duplicates(window)
+        
+        # Emails and decided claims for this fetch window are written in bulk. Emails stored by an
+        # earlier run that failed before their claim was committed are processed again
+        new_message_ids = email_db.insert_emails(window)
+        new_message_ids |= email_db.unfinished_ids([
+            email['message_id'] for email in window if email['message_id'] not in new_message_ids
+        ])
+        writer = BatchWriter(pool, member_cache=processor.member_cache, email_db=email_db)
+        decided = []
+        
+        # Members named in the window are loaded with one query instead of one per claim
+        processor.prefetch_members_for([
+            email for email in window if email['message_id'] in new_message_ids and email['message_id'] not in resubmitted
+        ])
+        
+        """iterate through emails and process each one"""""
+        for email in window:
+            if email['message_id'] in new_message_ids and email['message_id'] in resubmitted:
+                duplicate_count += 1
+                print(f"Skipped ({describe(resubmitted[email['message_id']])}): {email['subject'][:50]}")
+                decided.append(email)
+            elif email['message_id'] in new_message_ids:
+                new_count += 1
+                print(f"Added email: {email['subject'][:50]}")
+                
+                # Full body was decoded during the batched fetch
+                print(email['body'])
+                pause()
+                
+                # Extract claim data using LLM; an API failure that outlasted the retries leaves the email
+                # unread and unprocessed, and the next run fetches it again through with_unfinished
+                try:
+                    claim_data = processor.extract(email)
+                except Exception as e:
+                    print(f"  Extraction failed: {e}\n")
+                    continue
+                print(claim_data)
+                pause()
+                
+                if not claim_data:
+                    # Unlike a failed request, asking again would give the same answer
+                    print("  Could not extract claim data\n")
+                    email_db.mark_unextractable([email['message_id']])
+                    labels.add([email['message_id']])
+                    continue
+                
+                print(f"  Extracted: Member {claim_data.get('member_id')}, ${claim_data.get('claim_amount')}")
+                
+                # Check member existence and policy balance, counting approvals not yet written
+                pending = writer.pending_deduction(claim_data['member_id'])
+                member, denial = processor.validate(claim_data, pending)
+                
+                """if member is not found or balance is insufficient status column will be labeled DENIED"""
+                if denial:
+                    print(f"   {denial}\n")
+                    writer.add_claim(claim_data, 'DENIED', denial)
+                    decided.append(email)
+                    continue
+                
+                print(f"   Member found: {member['full_name']} (Balance: Ksh.{member['policy_balance'] - pending})")
+                
+                # Clinical adjudication using LLM with the member's policy as RAG context (only if balance is sufficient)
+                try:
+                    final_decision, final_reasoning = processor.adjudicate(claim_data, member)
+                except Exception as e:
+                    print(f"  Adjudication failed: {e}\n")
+                    continue
+                writer.add_claim(claim_data, final_decision, final_reasoning)
+                decided.append(email)
                 print(f"    Adjudication: {final_decision}")
                 print(f"    Reasoning: {final_reasoning}")
-                print(f"    Deducted ${claim_data['claim_amount']} from policy balance")
-                print(f"    New balance: ${new_balance}\n")
+                
+                if final_decision == 'APPROVED':
+                    new_balance = member['policy_balance'] - pending - claim_data['claim_amount']
+                    print(f"    Deducting ${claim_data['claim_amount']} from policy balance")
+                    print(f"    New balance: ${new_balance}\n")
             else:
-                print(f"    Adjudication: {final_decision}")
-                print(f"    Reasoning: {final_reasoning}\n")
-            
-            # Mark email as read in Gmail
-            gmail.mark_as_read(email['message_id'])
-            print(f"    Marked as read in Gmail")
-        else:
-            duplicate_count += 1
-            print(f"Skipped (duplicate): {email['subject'][:50]}")
+                duplicate_count += 1
+                print(f"Skipped (duplicate): {email['subject'][:50]}")
+        
+        # Store every claim with its decision and deduct approved amounts in one transaction
+        for email in decided:
+            writer.mark_read(email['message_id'])
+        _, claim_ids = writer.flush()
+        print(f"Stored {len(claim_ids)} claims: {claim_ids}")
+        
+        # Mark emails as read in Gmail only once their claims are stored, with one batchModify per window
+        labels.add([email['message_id'] for email in decided])
+        print(f"Marked {labels.flush()} emails as read in Gmail")
+    
+    # Retries anything a failed flush left behind; the rest is picked up by the next run
+    labels.flush()
+    
+    if history_id:
+        email_db.save_history_id(SYNC_KEY, history_id)
     
     email_db.close()
-    claims_db.close()
-    members_db.close()
-    policies_db.close()
+    processor.close()
+    close_pool()
     
     print(f"\nSummary: {new_count} new emails processed, {duplicate_count} duplicates skipped")
+    if processor.report():
+        print(processor.report())
+    print(metrics.report())
+    metrics.export()
 
 if __name__ == "__main__":
     main()
@@ -1,43 +1,136 @@
-import psycopg2
-import os
+from psycopg2.extras import execute_values
+from db_pool import get_pool
+from metrics import metrics
+import threading
+import time
+
+MEMBER_COLUMNS = "member_id, full_name, date_of_birth, policy_id, status, policy_balance"
+
+def _row_to_member(row):
+    return {
+        'member_id': row[0],
+        'full_name': row[1],
+        'date_of_birth': row[2],
+        'policy_id': row[3],
+        'status': row[4],
+        'policy_balance': float(row[5])
+    }
 
 class MembersDB:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            port=os.getenv('DB_PORT'),
-            database=os.getenv('DB_NAME'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASSWORD')
-        )
+    def __init__(self, pool=None):
+        self.pool = pool or get_pool()
     
     def get_member(self, member_id):
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                SELECT member_id, full_name, date_of_birth, policy_id, status, policy_balance 
+        with self.pool.cursor() as cur:
+            cur.execute(f"""
+                SELECT {MEMBER_COLUMNS}
                 FROM members 
                 WHERE member_id = %s
             """, (member_id,))
             row = cur.fetchone()
             if row:
-                return {
-                    'member_id': row[0],
-                    'full_name': row[1],
-                    'date_of_birth': row[2],
-                    'policy_id': row[3],
-                    'status': row[4],
-                    'policy_balance': float(row[5])
-                }
+                return _row_to_member(row)
             return None
     
+    def get_members(self, member_ids):
+        """Look up many members in one query; returns {member_id: member} for those that exist."""
+        member_ids = list({str(member_id) for member_id in member_ids if member_id})
+        if not member_ids:
+            return {}
+        with self.pool.cursor() as cur:
+            cur.execute(f"""
+                SELECT {MEMBER_COLUMNS}
+                FROM members
+                WHERE member_id = ANY(%s)
+            """, (member_ids,))
+            return {row[0]: _row_to_member(row) for row in cur.fetchall()}
+    
     def deduct_from_balance(self, member_id, amount):
-        with self.conn.cursor() as cur:
+        with self.pool.cursor() as cur:
             cur.execute("""
                 UPDATE members 
                 SET policy_balance = policy_balance - %s 
                 WHERE member_id = %s
             """, (amount, member_id))
-            self.conn.commit()
+    
+    def deduct_many(self, deductions):
+        """Apply {member_id: amount} deductions with one conditional UPDATE.
+        
+        Members whose balance no longer covers the amount are skipped; returns the member_ids debited.
+        """
+        if not deductions:
+            return set()
+        with self.pool.cursor() as cur:
+            rows = execute_values(cur, """
+                UPDATE members AS m
+                SET policy_balance = m.policy_balance - d.amount
+                FROM (VALUES %s) AS d (member_id, amount)
+                WHERE m.member_id = d.member_id
+                  AND m.policy_balance >= d.amount
+                RETURNING m.member_id
+            """, list(deductions.items()), template="(%s, %s::numeric)", page_size=1000, fetch=True)
+            return {row[0] for row in rows}
     
     def close(self):
-        self.conn.close()
+        # Connections belong to the shared pool; see db_pool.close_pool()
+        pass
+
+class MemberCache:
+    """Short-lived in-process copy of member rows used for validation.
+
+    ``prefetch`` loads every member of a batch with one query, unknown ids included
+    so repeated lookups of a missing member stay local too. Entries expire after
+    ``ttl`` seconds. Deductions written by this process are applied to the cached
+    balance with ``deduct``; anything else changing a balance is picked up on expiry.
+    The database deduction is conditional, so a stale balance can at worst turn an
+    approval into a denial at commit time.
+    """
+    
+    def __init__(self, members_db=None, ttl=30):
+        self.members_db = members_db or MembersDB()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._members = {}  # member_id -> (member or None, loaded_at)
+    
+    def _fresh(self, member_id, now):
+        entry = self._members.get(member_id)
+        return entry is not None and now - entry[1] < self.ttl
+    
+    def prefetch(self, member_ids):
+        """Load the members not already cached with a single query."""
+        now = time.monotonic()
+        with self._lock:
+            missing = {str(member_id) for member_id in member_ids if member_id and not self._fresh(str(member_id), now)}
+        if not missing:
+            return
+        found = self.members_db.get_members(missing)
+        with self._lock:
+            for member_id in missing:
+                self._members[member_id] = (found.get(member_id), now)
+    
+    def get_member(self, member_id):
+        member_id = str(member_id)
+        with self._lock:
+            hit = self._fresh(member_id, time.monotonic())
+            member = self._members[member_id][0] if hit else None
+        metrics.inc('claims_member_cache_lookups_total', result='hit' if hit else 'miss')
+        if not hit:
+            member = self.members_db.get_member(member_id)
+            with self._lock:
+                self._members[member_id] = (member, time.monotonic())
+        return dict(member) if member is not None else None
+    
+    def deduct(self, member_id, amount):
+        """Mirror a deduction that has been committed to the database."""
+        with self._lock:
+            entry = self._members.get(str(member_id))
+            if entry and entry[0] is not None:
+                member, loaded_at = entry
+                self._members[str(member_id)] = (dict(member, policy_balance=member['policy_balance'] - amount), loaded_at)
+    
+    def invalidate(self, member_ids=None):
+        with self._lock:
+            if member_ids is None:
+                self._members.clear()
+            for member_id in member_ids or ():
+                self._members.pop(str(member_id), None)
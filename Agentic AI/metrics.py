@@ -0,0 +1,229 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Histogram buckets in seconds: sub-millisecond DB calls up to multi-second LLM calls
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Recent samples kept per timer for the percentiles in the run summary
+MAX_SAMPLES = 10000
+
+HELP = {
+    'claims_stage_duration_seconds': 'Time spent in each claim processing step',
+    'claims_gmail_request_duration_seconds': 'Gmail API call latency',
+    'claims_llm_request_duration_seconds': 'OpenAI request latency',
+    'claims_db_duration_seconds': 'Time spent holding a database cursor',
+    'claims_llm_tokens_total': 'OpenAI tokens used',
+    'claims_llm_cost_usd_total': 'Estimated OpenAI spend in US dollars, by model and tier',
+    'claims_llm_task_duration_seconds': 'Time to answer an LLM task including any escalation, by route',
+    'claims_llm_escalations_total': 'LLM tasks sent to the large model, by reason',
+    'claims_processed_total': 'Claims stored, by final status',
+    'claims_extractions_total': 'Claim extractions, by source',
+    'claims_adjudication_cache_lookups_total': 'Adjudication cache lookups, by result',
+    'claims_member_cache_lookups_total': 'Member cache lookups during validation, by result',
+    'claims_duplicates_total': 'Emails recognised as resubmissions of an earlier claim',
+    'claims_attachments_total': 'Email attachments, by extraction status',
+    'claims_attachment_extract_duration_seconds': 'Attachment text extraction time',
+    'claims_api_retries_total': 'Retried Gmail and OpenAI calls, by status',
+    'claims_label_updates_total': 'Emails marked read in Gmail through batchModify',
+}
+
+
+def _series(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+def _percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class Metrics:
+    """In-process timers and counters for the claim pipeline.
+
+    ``span`` times a block into a histogram, ``inc`` bumps a counter. Both take
+    Prometheus-style labels. ``prometheus()`` renders the text exposition format
+    and ``summary()`` a JSON-friendly per-run breakdown with percentiles.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self._counters = defaultdict(float)
+        self._timers = {}
+    
+    def inc(self, name, n=1, **labels):
+        with self._lock:
+            self._counters[_series(name, labels)] += n
+    
+    def observe(self, name, seconds, **labels):
+        key = _series(name, labels)
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                timer = self._timers[key] = {
+                    'count': 0, 'sum': 0.0, 'max': 0.0,
+                    'buckets': [0] * len(BUCKETS), 'samples': deque(maxlen=MAX_SAMPLES)
+                }
+            timer['count'] += 1
+            timer['sum'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            timer['samples'].append(seconds)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    timer['buckets'][i] += 1
+                    break
+    
+    @contextmanager
+    def span(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+    
+    def record_usage(self, usage, **labels):
+        """Add the prompt and completion token counts of an OpenAI response's ``usage``."""
+        if usage is None:
+            return
+        for kind in ('prompt_tokens', 'completion_tokens'):
+            count = usage.get(kind) if isinstance(usage, dict) else getattr(usage, kind, None)
+            if count:
+                self.inc('claims_llm_tokens_total', count, kind=kind.split('_')[0], **labels)
+    
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+            self.started_at = time.time()
+    
+    def prometheus(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timers = {key: dict(timer, buckets=list(timer['buckets'])) for key, timer in self._timers.items()}
+        
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for (series_name, labels), value in sorted(counters.items()):
+                if series_name == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        
+        for name in sorted({name for name, _ in timers}):
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for (series_name, labels), timer in sorted(timers.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS, timer['buckets']):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {timer['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {timer['sum']:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {timer['count']}")
+        return '\n'.join(lines) + '\n'
+    
+    def summary(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timers = {key: dict(timer, samples=list(timer['samples'])) for key, timer in self._timers.items()}
+            started_at = self.started_at
+        
+        wall_time = time.time() - started_at
+        claims = sum(value for (name, _), value in counters.items() if name == 'claims_processed_total')
+        spans = []
+        for (name, labels), timer in timers.items():
+            spans.append({
+                'name': name,
+                'labels': dict(labels),
+                'count': timer['count'],
+                'total_s': round(timer['sum'], 3),
+                'mean_ms': round(timer['sum'] / timer['count'] * 1000, 2),
+                'p50_ms': round(_percentile(timer['samples'], 0.5) * 1000, 2),
+                'p95_ms': round(_percentile(timer['samples'], 0.95) * 1000, 2),
+                'p99_ms': round(_percentile(timer['samples'], 0.99) * 1000, 2),
+                'max_ms': round(timer['max'] * 1000, 2)
+            })
+        spans.sort(key=lambda span: -span['total_s'])
+        
+        return {
+            'started_at': started_at,
+            'wall_time_s': round(wall_time, 3),
+            'claims': int(claims),
+            'claims_per_second': round(claims / wall_time, 3) if wall_time > 0 else 0.0,
+            'spans': spans,
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(counters.items())
+            ]
+        }
+    
+    def report(self, top=8):
+        """A few lines on where the run's time went, largest total first."""
+        summary = self.summary()
+        lines = [f"Metrics: {summary['claims']} claims in {summary['wall_time_s']}s ({summary['claims_per_second']}/s)"]
+        for span in summary['spans'][:top]:
+            labels = ','.join(f"{key}={value}" for key, value in span['labels'].items())
+            lines.append(
+                f"  {span['name']}{{{labels}}}: {span['count']} calls, {span['total_s']}s total, "
+                f"p50 {span['p50_ms']}ms, p95 {span['p95_ms']}ms"
+            )
+        tokens = defaultdict(float)
+        for counter in summary['counters']:
+            if counter['name'] == 'claims_llm_tokens_total':
+                tokens[counter['labels']['kind']] += counter['value']
+        if tokens:
+            lines.append(f"  LLM tokens: {int(tokens['prompt'])} prompt, {int(tokens['completion'])} completion")
+        return '\n'.join(lines)
+    
+    def export(self, summary_path=None, prometheus_path=None):
+        """Write the run summary as JSON and/or the Prometheus text format (node_exporter textfile style)."""
+        summary_path = summary_path or os.getenv('METRICS_SUMMARY_PATH')
+        prometheus_path = prometheus_path or os.getenv('METRICS_PROMETHEUS_PATH')
+        if summary_path:
+            with open(summary_path, 'w') as f:
+                json.dump(self.summary(), f, indent=2)
+        if prometheus_path:
+            # Write then rename so a scraper never reads a half-written file
+            with open(prometheus_path + '.tmp', 'w') as f:
+                f.write(self.prometheus())
+            os.replace(prometheus_path + '.tmp', prometheus_path)
+    
+    def serve(self, port):
+        """Expose /metrics over HTTP from a daemon thread, for long-running workers."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.prometheus().encode('utf-8')
+                self.send_response(200 if self.path.startswith('/metrics') else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, *args):
+                pass
+        
+        server = ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        return server
+
+
+metrics = Metrics()
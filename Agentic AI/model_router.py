@@ -0,0 +1,204 @@
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+from metrics import metrics
+from policy_context import PolicyContextBuilder, _words
+
+# Every task the agent sends to OpenAI; each can have its own model (OPENAI_MODEL_<TASK>)
+TASKS = ('email_response', 'extract', 'adjudicate', 'extract_and_adjudicate')
+
+# Tasks tried on the fast model first when routing is on; drafting replies always uses its own model
+ROUTED_TASKS = ('extract', 'adjudicate', 'extract_and_adjudicate')
+
+# USD per million (prompt, completion) tokens; OPENAI_PRICES overrides or adds models
+DEFAULT_PRICES = {
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4.1': (2.00, 8.00),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'gpt-4.1-nano': (0.10, 0.40),
+}
+
+DECISIONS = ('APPROVED', 'DENIED')
+
+
+def _usage_count(usage, kind):
+    count = usage.get(kind) if isinstance(usage, dict) else getattr(usage, kind, None)
+    return count or 0
+
+
+def _confidence(value):
+    try:
+        return min(1.0, max(0.0, float(value)))
+    except (TypeError, ValueError):
+        return None
+
+
+def validated_confidence(claim_data, text):
+    """Share of extracted fields that check out against the email: ids and amounts must appear in it."""
+    text = text.lower()
+    digits = re.sub(r'(?<=\d)[,\s](?=\d{3})', '', text)
+    scores = []
+    
+    member_id = str(claim_data.get('member_id') or '').strip().lower()
+    scores.append(1.0 if member_id and member_id in text else 0.5 if member_id else 0.0)
+    
+    try:
+        amount = float(claim_data.get('claim_amount'))
+    except (TypeError, ValueError):
+        amount = None
+    if amount is None or amount <= 0:
+        scores.append(0.0)
+    else:
+        written = {f"{amount:.2f}", f"{amount:f}".rstrip('0').rstrip('.')}
+        scores.append(1.0 if any(re.search(rf'(?<![\d.]){re.escape(value)}(?!\d)', digits) for value in written) else 0.5)
+    
+    for field in ('diagnosis', 'requested_service'):
+        scores.append(1.0 if str(claim_data.get(field) or '').strip() else 0.0)
+    return sum(scores) / len(scores)
+
+
+class ModelRouter:
+    """Chooses the model for each agent task and when a fast-model answer goes to the large model.
+
+    Every task uses its configured model (``OPENAI_MODEL_<TASK>``, else
+    ``OPENAI_MODEL``). With routing on, extraction and adjudication are first
+    sent to ``fast_model``, which also reports a confidence. The large model
+    redoes the task when the fast answer is unusable or under
+    ``min_confidence``, when the claim amount reaches ``escalate_amount``, or
+    when the claim touches one of the policy's exclusions. The last two are
+    sent straight to the large model when they are known before the request.
+    Latency and cost are recorded per tier.
+    """
+    
+    def __init__(self, default_model='gpt-4o', task_models=None, fast_model=None, min_confidence=0.8,
+                 escalate_amount=None, prices=None):
+        self.task_models = {task: (task_models or {}).get(task) or default_model for task in TASKS}
+        self.fast_model = fast_model
+        self.min_confidence = min_confidence
+        self.escalate_amount = escalate_amount
+        self.prices = dict(DEFAULT_PRICES, **(prices or {}))
+        self.policy_context_builder = PolicyContextBuilder()
+        self._lock = threading.Lock()
+        self._routes = defaultdict(int)
+        self._cost = defaultdict(float)
+    
+    @classmethod
+    def from_env(cls, default_model=None):
+        """Router configured by OPENAI_MODEL[_<TASK>], MODEL_ROUTING and the ROUTER_* variables."""
+        default_model = default_model or os.getenv('OPENAI_MODEL', 'gpt-4o')
+        task_models = {task: os.getenv(f'OPENAI_MODEL_{task.upper()}') for task in TASKS}
+        routing = os.getenv('MODEL_ROUTING', 'off').lower() == 'on'
+        escalate_amount = os.getenv('ROUTER_ESCALATE_AMOUNT', '50000')
+        prices = json.loads(os.getenv('OPENAI_PRICES', '{}'))
+        return cls(
+            default_model,
+            task_models,
+            fast_model=os.getenv('OPENAI_FAST_MODEL', 'gpt-4o-mini') if routing else None,
+            min_confidence=float(os.getenv('ROUTER_MIN_CONFIDENCE', '0.8')),
+            escalate_amount=float(escalate_amount) if escalate_amount else None,
+            prices={model: tuple(price) for model, price in prices.items()}
+        )
+    
+    def model_for(self, task):
+        return self.task_models[task]
+    
+    def routes(self, task):
+        return self.fast_model is not None and task in ROUTED_TASKS and self.fast_model != self.task_models[task]
+    
+    def high_amount(self, claim_amount):
+        try:
+            return self.escalate_amount is not None and float(claim_amount) >= self.escalate_amount
+        except (TypeError, ValueError):
+            return False
+    
+    def policy_edge(self, policy, diagnosis, requested_service):
+        """Whether the diagnosis or service shares words with one of the policy's exclusions."""
+        if not policy:
+            return False
+        claim_words = _words(f"{diagnosis or ''} {requested_service or ''}")
+        for group, value in self.policy_context_builder.project(policy, requested_service).values():
+            if group != 'exclusions':
+                continue
+            for item in value if isinstance(value, list) else [value]:
+                if claim_words & _words(item):
+                    return True
+        return False
+    
+    def adjudication_precheck(self, policy, diagnosis, requested_service, claim_amount=None):
+        """Why an adjudication should skip the fast model, or None."""
+        if self.high_amount(claim_amount):
+            return 'high_amount'
+        if self.policy_edge(policy, diagnosis, requested_service):
+            return 'policy_edge'
+        return None
+    
+    def extraction_escalation(self, claim_data, subject, body):
+        """Why a fast-model extraction needs the large model, or None."""
+        if not isinstance(claim_data, dict) or not claim_data.get('member_id'):
+            return 'unusable'
+        if self.high_amount(claim_data.get('claim_amount')):
+            return 'high_amount'
+        confidence = validated_confidence(claim_data, f"{subject}\n{body}")
+        reported = _confidence(claim_data.get('confidence'))
+        if reported is not None:
+            confidence = min(confidence, reported)
+        if confidence < self.min_confidence:
+            return 'low_confidence'
+        return None
+    
+    def adjudication_escalation(self, adjudication, policy=None, diagnosis=None, requested_service=None, claim_amount=None):
+        """Why a fast-model adjudication needs the large model, or None."""
+        if not isinstance(adjudication, dict) or adjudication.get('decision') not in DECISIONS:
+            return 'unusable'
+        # A fast model that does not say how sure it is gets no benefit of the doubt
+        confidence = _confidence(adjudication.get('confidence'))
+        if confidence is None or confidence < self.min_confidence:
+            return 'low_confidence'
+        return self.adjudication_precheck(policy, diagnosis, requested_service, claim_amount)
+    
+    def cost(self, model, usage):
+        """USD cost of one response's ``usage``; 0 for models without a price."""
+        if usage is None:
+            return 0.0
+        # Dated snapshots such as gpt-4o-2024-08-06 are priced like their base model
+        matches = [name for name in self.prices if model == name or model.startswith(name + '-')]
+        if not matches:
+            return 0.0
+        prompt_price, completion_price = self.prices[max(matches, key=len)]
+        return (_usage_count(usage, 'prompt_tokens') * prompt_price
+                + _usage_count(usage, 'completion_tokens') * completion_price) / 1e6
+    
+    def record_request(self, operation, model, tier, usage):
+        cost = self.cost(model, usage)
+        if cost:
+            metrics.inc('claims_llm_cost_usd_total', cost, operation=operation, model=model, tier=tier)
+            with self._lock:
+                self._cost[tier] += cost
+    
+    def record_task(self, task, route, seconds, reason=None):
+        """Time of a whole task including any escalation; ``route`` is fast, escalated or large."""
+        metrics.observe('claims_llm_task_duration_seconds', seconds, task=task, route=route)
+        if reason:
+            metrics.inc('claims_llm_escalations_total', task=task, reason=reason)
+        with self._lock:
+            self._routes[route] += 1
+    
+    def report(self):
+        """One-line summary of routing and spend for the end-of-run output."""
+        with self._lock:
+            routes = dict(self._routes)
+            cost = dict(self._cost)
+        if self.fast_model is None and not cost:
+            return None
+        line = f"LLM cost: ${sum(cost.values()):.4f}"
+        if cost:
+            line += ' (' + ', '.join(f"{tier} ${value:.4f}" for tier, value in sorted(cost.items())) + ')'
+        if self.fast_model is not None:
+            total = sum(routes.values())
+            answered = routes.get('fast', 0)
+            line = (f"Model routing: {answered} of {total} tasks answered by {self.fast_model}, "
+                    f"{routes.get('escalated', 0)} escalated, {routes.get('large', 0)} sent straight to the large model. ") + line
+        return line
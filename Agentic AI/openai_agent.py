@@ -1,11 +1,92 @@
-import openai
 import os
 import json
+import time
+from policy_context import PolicyContextBuilder
+from policy_index import PolicyIndex
+from metrics import metrics
+from rate_limiter import get_limiter
+from model_router import ModelRouter
+
+NULLABLE_STRING = {"type": ["string", "null"]}
+
+ADJUDICATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "decision": {"type": "string", "enum": ["APPROVED", "DENIED"]},
+        "reasoning": {"type": "string"}
+    },
+    "required": ["decision", "reasoning"],
+    "additionalProperties": False
+}
+
+EXTRACT_AND_ADJUDICATE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "claim": {
+            "type": "object",
+            "properties": {
+                "member_id": NULLABLE_STRING,
+                "diagnosis": NULLABLE_STRING,
+                "requested_service": NULLABLE_STRING,
+                "claim_amount": {"type": ["number", "null"]}
+            },
+            "required": ["member_id", "diagnosis", "requested_service", "claim_amount"],
+            "additionalProperties": False
+        },
+        "adjudication": ADJUDICATION_SCHEMA
+    },
+    "required": ["claim", "adjudication"],
+    "additionalProperties": False
+}
+
+# Appended to fast-model prompts so the router can tell which answers to escalate
+CONFIDENCE_FIELD = '- confidence (a number from 0 to 1: how sure you are that the answer is correct)\n'
+CONFIDENCE_JSON = ',\n  "confidence": a number from 0 to 1, how sure you are of the decision'
+
+
+def _with_confidence(schema):
+    """``schema`` with a required top-level confidence, for fast-model structured output."""
+    return dict(
+        schema,
+        properties=dict(schema['properties'], confidence={"type": "number"}),
+        required=schema['required'] + ['confidence']
+    )
+
+def _parse_json(content):
+    """Parse a JSON reply, tolerating markdown code fences. Returns None if it is not JSON."""
+    try:
+        content = content.strip()
+        if content.startswith('```json'):
+            content = content[7:-3].strip()
+        elif content.startswith('```'):
+            content = content[3:-3].strip()
+        return json.loads(content)
+    except (AttributeError, ValueError):
+        return None
 
 class OpenAIEmailAgent:
-    def __init__(self, model='gpt-4o'):
-        openai.api_key = os.getenv('OPENAI_API_KEY')
-        self.model = model
+    def __init__(self, model=None, client=None, router=None):
+        # Per-task models and fast-model routing; see ModelRouter
+        self.router = router or ModelRouter.from_env(model)
+        self.model = self.router.model_for('adjudicate')
+        # Anything exposing chat.completions.create works, which is how fakes are plugged in
+        self._client = client
+        self.timeout = float(os.getenv('OPENAI_TIMEOUT', '60'))
+        self.limiter = get_limiter('openai')
+        self.policy_context_builder = PolicyContextBuilder(model=self.model)
+        self.policy_index = PolicyIndex.from_env(model=self.model)
+    
+    @property
+    def client(self):
+        # The SDK takes most of a second to import, so it is loaded on the first request,
+        # which runs answered from templates or the caches never make
+        if self._client is None:
+            import openai
+            openai.api_key = os.getenv('OPENAI_API_KEY')
+            # Retries are handled by the shared limiter; letting the SDK retry as well would multiply them
+            openai.max_retries = 0
+            self._client = openai
+        return self._client
     
     def generate_email_response(self, subject, body, sender, attachments=None):
         prompt = f"""You are an AI email assistant. Analyze the following email and generate a professional response.
@@ -21,52 +102,105 @@ Body:
 
 Generate a professional, concise email response addressing the key points."""
 
-        response = openai.chat.completions.create(
-            model=self.model,
-            messages=[
+        response = self._create('email_response', {
+            "model": self.router.model_for('email_response'),
+            "messages": [
                 {"role": "system", "content": "You are a professional email assistant."},
                 {"role": "user", "content": prompt}
             ],
-            max_tokens=1000
-        )
+            "max_tokens": 1000
+        })
         
         return response.choices[0].message.content
     
-    def extract_claim_data(self, subject, body):
+    def _create(self, operation, request, tier='large'):
+        """Send one chat completion through the rate limiter, recording its latency, token usage and cost."""
+        def send():
+            with metrics.span('claims_llm_request_duration_seconds', operation=operation, model=request['model'], tier=tier):
+                return self.client.chat.completions.create(timeout=self.timeout, **request)
+        
+        # Roughly four characters per token, plus the completion budget
+        tokens = sum(len(message['content']) for message in request['messages']) // 4 + request.get('max_tokens', 0)
+        response = self.limiter.call(send, tokens=tokens)
+        usage = getattr(response, 'usage', None)
+        metrics.record_usage(usage, operation=operation, model=request['model'])
+        self.router.record_request(operation, request['model'], tier, usage)
+        return response
+    
+    def _route(self, task, build, parse, escalation, precheck=None):
+        """Answer ``task`` on the fast model, and on the task's own model when the router says so.
+        
+        ``build(model, fast)`` makes the request, ``parse(message, tier)`` reads the reply and
+        ``escalation(result)`` says why a fast answer is not good enough (None when it is).
+        A ``precheck`` reason sends the task straight to the task's model.
+        """
+        if not self.router.routes(task):
+            message = self._create(task, build(self.router.model_for(task), False)).choices[0].message
+            return parse(message, 'large')
+        
+        start = time.perf_counter()
+        reason, route = precheck, 'large'
+        if reason is None:
+            message = self._create(task, build(self.router.fast_model, True), 'fast').choices[0].message
+            result = parse(message, 'fast')
+            reason = escalation(result)
+            if reason is None:
+                self.router.record_task(task, 'fast', time.perf_counter() - start)
+                return result
+            route = 'escalated'
+        
+        message = self._create(task, build(self.router.model_for(task), False)).choices[0].message
+        result = parse(message, 'large')
+        self.router.record_task(task, route, time.perf_counter() - start, reason)
+        return result
+    
+    def extraction_request(self, subject, body, model=None, confidence=False):
         prompt = f"""Extract claim information from this email. Return ONLY a JSON object with these fields:
 - member_id
 - diagnosis
 - requested_service
 - claim_amount (numeric value only)
-
+{CONFIDENCE_FIELD if confidence else ''}
 Email Subject: {subject}
 Email Body: {body}
 
 Return JSON only, no explanation."""
 
-        response = openai.chat.completions.create(
-            model=self.model,
-            messages=[
+        return {
+            "model": model or self.router.model_for('extract'),
+            "messages": [
                 {"role": "system", "content": "You extract structured data from emails. Return only valid JSON."},
                 {"role": "user", "content": prompt}
             ],
-            max_tokens=500
+            "max_tokens": 500
+        }
+    
+    def parse_extraction(self, content):
+        return _parse_json(content)
+    
+    def extract_claim_data(self, subject, body):
+        return self._route(
+            'extract',
+            lambda model, fast: self.extraction_request(subject, body, model, fast),
+            lambda message, tier: self.parse_extraction(message.content),
+            lambda claim_data: self.router.extraction_escalation(claim_data, subject, body)
         )
+    
+    def policy_context(self, policy, query, requested_service=None):
+        """Compact policy JSON for a prompt.
         
-        try:
-            content = response.choices[0].message.content.strip()
-            if content.startswith('```json'):
-                content = content[7:-3].strip()
-            elif content.startswith('```'):
-                content = content[3:-3].strip()
-            return json.loads(content)
-        except:
-            return None
+        With POLICY_INDEX=on the index's clauses relevant to ``query`` win for every policy row that has a
+        policy_id; PolicyContextBuilder is used otherwise.
+        """
+        if self.policy_index and policy.get('policy_id') is not None:
+            return self.policy_index.context(policy, query)
+        return self.policy_context_builder.build(policy, requested_service)
     
-    def clinical_adjudication(self, diagnosis, requested_service, policy_context=None):
+    def adjudication_request(self, diagnosis, requested_service, policy_context=None, model=None, confidence=False):
         context_section = ""
         if policy_context:
-            context_section = f"\n\nPolicy Context:\n{json.dumps(policy_context, indent=2)}\n\nConsider the policy terms, coverage limits, and exclusions when making your decision."
+            compact_context = self.policy_context(policy_context, f"{diagnosis} {requested_service}", requested_service)
+            context_section = f"\n\nPolicy Context:\n{compact_context}\n\nConsider the policy terms, coverage limits, and exclusions when making your decision."
         
         prompt = f"""You are a clinical adjudicator. Evaluate if the requested service is medically necessary for the diagnosis.{context_section}
 
@@ -76,26 +210,109 @@ Requested Service: {requested_service}
 Return ONLY a JSON object:
 {{
   "decision": "APPROVED" or "DENIED",
-  "reasoning": "brief clinical justification considering policy terms"
+  "reasoning": "brief clinical justification considering policy terms"{CONFIDENCE_JSON if confidence else ''}
 }}
 
 Return JSON only."""
 
-        response = openai.chat.completions.create(
-            model=self.model,
-            messages=[
+        return {
+            "model": model or self.router.model_for('adjudicate'),
+            "messages": [
                 {"role": "system", "content": "You are a clinical adjudicator with access to policy information. Return only valid JSON."},
                 {"role": "user", "content": prompt}
             ],
-            max_tokens=300
+            "max_tokens": 300
+        }
+    
+    def parse_adjudication(self, content):
+        adjudication = _parse_json(content)
+        if not isinstance(adjudication, dict) or 'decision' not in adjudication:
+            return {"decision": "PENDING", "reasoning": "Unable to process"}
+        return adjudication
+    
+    def clinical_adjudication(self, diagnosis, requested_service, policy_context=None, claim_amount=None):
+        """APPROVED/DENIED with reasoning; ``claim_amount`` lets high-value claims go straight to the large model."""
+        def parse(message, tier):
+            adjudication = self.parse_adjudication(message.content)
+            if self.router.routes('adjudicate'):
+                # Lets the adjudication cache tell fast-model decisions apart
+                adjudication['tier'] = tier
+            return adjudication
+        
+        precheck = None
+        if self.router.routes('adjudicate'):
+            precheck = self.router.adjudication_precheck(policy_context, diagnosis, requested_service, claim_amount)
+        return self._route(
+            'adjudicate',
+            lambda model, fast: self.adjudication_request(diagnosis, requested_service, policy_context, model, fast),
+            parse,
+            self.router.adjudication_escalation,
+            precheck
         )
+    
+    def extract_and_adjudicate_request(self, subject, body, policy_context=None, model=None, confidence=False):
+        context_section = ""
+        if policy_context:
+            # The requested service is not known before extraction, so the email itself is the query
+            compact_context = self.policy_context(policy_context, f"{subject} {body}")
+            context_section = f"\n\nPolicy Context:\n{compact_context}\n\nConsider the policy terms, coverage limits, and exclusions when making your decision."
         
-        try:
-            content = response.choices[0].message.content.strip()
-            if content.startswith('```json'):
-                content = content[7:-3].strip()
-            elif content.startswith('```'):
-                content = content[3:-3].strip()
-            return json.loads(content)
-        except:
-            return {"decision": "PENDING", "reasoning": "Unable to process"}
+        prompt = f"""Extract the claim information from this email, then evaluate as a clinical adjudicator whether the requested service is medically necessary for the diagnosis.{context_section}
+
+Claim fields:
+- member_id
+- diagnosis
+- requested_service
+- claim_amount (numeric value only)
+{CONFIDENCE_FIELD if confidence else ''}
+Use null for any field the email does not contain.
+
+Email Subject: {subject}
+Email Body: {body}"""
+
+        return {
+            "model": model or self.router.model_for('extract_and_adjudicate'),
+            "messages": [
+                {"role": "system", "content": "You extract structured claim data from emails and adjudicate it as a clinical adjudicator with access to policy information."},
+                {"role": "user", "content": prompt}
+            ],
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "claim_adjudication",
+                    "strict": True,
+                    "schema": _with_confidence(EXTRACT_AND_ADJUDICATE_SCHEMA) if confidence else EXTRACT_AND_ADJUDICATE_SCHEMA
+                }
+            },
+            "max_tokens": 700
+        }
+    
+    def parse_extract_and_adjudicate(self, content, refusal=None):
+        if refusal:
+            return None
+        result = _parse_json(content)
+        if not result:
+            return None
+        if 'confidence' in result:
+            result['adjudication']['confidence'] = result['confidence']
+        return result['claim'], result['adjudication']
+    
+    def extract_and_adjudicate(self, subject, body, policy_context=None):
+        """Extract the claim and adjudicate it in one request with schema-enforced JSON output.
+        
+        Returns (claim_data, adjudication), or None if the model refused or the reply was unusable.
+        """
+        def escalation(result):
+            if not result:
+                return 'unusable'
+            claim_data, adjudication = result
+            return (self.router.extraction_escalation(claim_data, subject, body)
+                    or self.router.adjudication_escalation(adjudication, policy_context, claim_data.get('diagnosis'),
+                                                           claim_data.get('requested_service'), claim_data.get('claim_amount')))
+        
+        return self._route(
+            'extract_and_adjudicate',
+            lambda model, fast: self.extract_and_adjudicate_request(subject, body, policy_context, model, fast),
+            lambda message, tier: self.parse_extract_and_adjudicate(message.content, getattr(message, 'refusal', None)),
+            escalation
+        )
@@ -0,0 +1,205 @@
+import asyncio
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dedupe import describe
+from gmail_reader import BATCH_SIZE
+from label_updates import LabelUpdateBuffer
+
+STAGES = ('ingest', 'extract', 'validate', 'adjudicate', 'commit')
+
+DEFAULT_CONCURRENCY = {
+    'ingest': 4,
+    'extract': 16,
+    'validate': 8,
+    'adjudicate': 16,
+    'commit': 4
+}
+
+
+def concurrency_from_env():
+    """Per-stage worker counts, overridable with PIPELINE_<STAGE>_CONCURRENCY."""
+    return {
+        stage: int(os.getenv(f'PIPELINE_{stage.upper()}_CONCURRENCY', DEFAULT_CONCURRENCY[stage]))
+        for stage in STAGES
+    }
+
+
+class ClaimPipeline:
+    """Staged asyncio claim pipeline: ingest -> extract -> validate -> adjudicate -> commit.
+
+    Stages are linked by bounded queues and each runs its own number of workers, so
+    many claims are in flight while every claim still passes through the stages in
+    order. Blocking Gmail and OpenAI calls run in a thread pool; calls that only touch
+    the database run in a second one no larger than the connection pool, so stage
+    concurrency above DB_POOL_MAX queues for a thread instead of timing out on getconn.
+
+    Balance checks stay correct under concurrency because validate reserves the
+    claim amount against the member, and the reservation is only released once
+    commit has deducted it in the database. Both steps hold a per-member lock so a
+    balance read can never straddle another claim's commit.
+    """
+    
+    def __init__(self, processor, email_db, gmail=None, concurrency=None, queue_size=None):
+        self.processor = processor
+        self.email_db = email_db
+        self.gmail = gmail
+        # Committed messages are marked read in batchModify calls of BATCH_SIZE, the pipeline's window
+        self.labels = LabelUpdateBuffer(gmail, email_db, max_ids=BATCH_SIZE) if gmail is not None else None
+        self.concurrency = dict(DEFAULT_CONCURRENCY, **(concurrency or {}))
+        self.queue_size = queue_size or int(os.getenv('PIPELINE_QUEUE_SIZE', '100'))
+        
+        self.results = []
+        self.counts = defaultdict(int)
+        self._reserved = defaultdict(float)
+        self._member_locks = defaultdict(asyncio.Lock)
+        self._content_hashes = {}  # content_hash -> message_id of emails taken in by this run
+        self._gmail_lock = None
+        self._db_executor = None
+    
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+    
+    async def _db(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, fn, *args)
+    
+    async def ingest(self, item):
+        email = item['email']
+        original = (await self._db(self.processor.find_duplicates, [email])).get(email['message_id'])
+        # Copies of an email that is still in flight have no claim in the database yet
+        if original is None and email.get('content_hash') in self._content_hashes:
+            original = {'message_id': self._content_hashes[email['content_hash']], 'claim_id': None, 'status': None}
+            email['status'] = 'duplicate'
+        if original is None and email.get('content_hash'):
+            self._content_hashes[email['content_hash']] = email['message_id']
+        
+        # An email stored by an earlier run whose claim never committed is processed again
+        stored = await self._db(self.email_db.insert_email, email)
+        if not stored and not await self._db(self.email_db.unfinished_ids, [email['message_id']]):
+            self.counts['duplicate'] += 1
+            print(f"Skipped (duplicate): {email['subject'][:50]}")
+            return None
+        if original is not None:
+            self.counts['resubmitted'] += 1
+            print(f"Skipped ({describe(original)}): {email['subject'][:50]}")
+            if self.labels is not None:
+                async with self._gmail_lock:
+                    await self._call(self.labels.add, [email['message_id']])
+            return None
+        self.counts['new'] += 1
+        return item
+    
+    async def extract(self, item):
+        claim_data = await self._call(self.processor.extract, item['email'])
+        if not claim_data:
+            self.counts['unextracted'] += 1
+            print(f"  Could not extract claim data: {item['email']['subject'][:50]}")
+            await self._db(self.email_db.mark_unextractable, [item['email']['message_id']])
+            if self.labels is not None:
+                async with self._gmail_lock:
+                    await self._call(self.labels.add, [item['email']['message_id']])
+            return None
+        item['claim_data'] = claim_data
+        return item
+    
+    async def validate(self, item):
+        claim_data = item['claim_data']
+        member_id = claim_data['member_id']
+        async with self._member_locks[member_id]:
+            member, denial = await self._db(self.processor.validate, claim_data, self._reserved[member_id])
+            if not denial:
+                self._reserved[member_id] += claim_data['claim_amount']
+                item['reserved'] = True
+        item['member'] = member
+        if denial:
+            item['decision'], item['reasoning'] = 'DENIED', denial
+        return item
+    
+    async def adjudicate(self, item):
+        if 'decision' not in item:
+            item['decision'], item['reasoning'] = await self._call(
+                self.processor.adjudicate, item['claim_data'], item['member']
+            )
+        return item
+    
+    async def commit(self, item):
+        claim_data = item['claim_data']
+        member_id = claim_data['member_id']
+        async with self._member_locks[member_id]:
+            try:
+                item['claim_id'], item['decision'] = await self._db(
+                    self.processor.commit, claim_data, item['decision'], item['reasoning'], item['email']['message_id']
+                )
+            finally:
+                if item.pop('reserved', False):
+                    self._reserved[member_id] -= claim_data['claim_amount']
+        
+        if self.labels is not None:
+            # The Gmail client's HTTP transport is not thread-safe
+            async with self._gmail_lock:
+                await self._call(self.labels.add, [item['email']['message_id']])
+        
+        self.counts[item['decision']] += 1
+        print(f"    Claim ID {item['claim_id']}: {item['decision']} ({item['email']['subject'][:50]})")
+        self.results.append(item)
+        return None
+    
+    async def _worker(self, stage, inbox, outbox):
+        handler = getattr(self, stage)
+        while True:
+            item = await inbox.get()
+            try:
+                item = await handler(item)
+                if item is not None and outbox is not None:
+                    await outbox.put(item)
+            except Exception as e:
+                self.counts['failed'] += 1
+                print(f"  {stage} failed for {item['email']['message_id']}: {e}")
+                if item.pop('reserved', False):
+                    self._reserved[item['claim_data']['member_id']] -= item['claim_data']['claim_amount']
+            finally:
+                inbox.task_done()
+    
+    async def run(self, emails):
+        self._gmail_lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        # LLM calls hold a thread for seconds and only borrow a connection for short lookups; one more thread serves Gmail
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency['extract'] + self.concurrency['adjudicate'] + 1))
+        self._db_executor = ThreadPoolExecutor(max_workers=self.email_db.pool.max_size, thread_name_prefix='pipeline-db')
+        
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in STAGES]
+        workers = []
+        for i, stage in enumerate(STAGES):
+            outbox = queues[i + 1] if i + 1 < len(STAGES) else None
+            for _ in range(self.concurrency[stage]):
+                workers.append(asyncio.create_task(self._worker(stage, queues[i], outbox)))
+        
+        # emails may be a lazy Gmail stream; pulling from it shares the Gmail client with the label updates
+        emails = iter(emails)
+        while True:
+            async with self._gmail_lock:
+                email = await self._call(next, emails, None)
+            if email is None:
+                break
+            await queues[0].put({'email': email})
+        
+        # Each stage hands items on before marking them done, so joining in order drains everything
+        for queue in queues:
+            await queue.join()
+        
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._db_executor.shutdown()
+        if self.labels is not None:
+            await self._call(self.labels.flush)
+        return self.results
+
+
+def run_pipeline(emails, gmail, email_db, processor, concurrency=None):
+    pipeline = ClaimPipeline(processor, email_db, gmail, concurrency or concurrency_from_env())
+    asyncio.run(pipeline.run(emails))
+    
+    summary = ', '.join(f"{count} {name}" for name, count in sorted(pipeline.counts.items()))
+    print(f"\nSummary: {summary}")
+    return pipeline.results
@@ -1,30 +1,163 @@
-import psycopg2
-import os
+from db_pool import get_pool
 from decimal import Decimal
+import psycopg2
+import select
+import threading
+import time
+
+POLICY_CHANNEL = 'policies_changed'
+
+def _row_to_policy(columns, row):
+    policy_dict = dict(zip(columns, row))
+    # Convert Decimal to float for JSON serialization
+    for key, value in policy_dict.items():
+        if isinstance(value, Decimal):
+            policy_dict[key] = float(value)
+    return policy_dict
 
 class PoliciesDB:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            port=os.getenv('DB_PORT'),
-            database=os.getenv('DB_NAME'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASSWORD')
-        )
+    def __init__(self, pool=None):
+        self.pool = pool or get_pool()
     
     def get_policy(self, policy_id):
-        with self.conn.cursor() as cur:
+        with self.pool.cursor() as cur:
             cur.execute("SELECT * FROM policies WHERE policy_id = %s", (policy_id,))
             columns = [desc[0] for desc in cur.description]
             row = cur.fetchone()
             if row:
-                policy_dict = dict(zip(columns, row))
-                # Convert Decimal to float for JSON serialization
-                for key, value in policy_dict.items():
-                    if isinstance(value, Decimal):
-                        policy_dict[key] = float(value)
-                return policy_dict
+                return _row_to_policy(columns, row)
+            return None
+    
+    def get_all_policies(self):
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT * FROM policies")
+            columns = [desc[0] for desc in cur.description]
+            return {str(policy['policy_id']): policy for policy in (_row_to_policy(columns, row) for row in cur.fetchall())}
+    
+    def create_change_trigger(self):
+        """NOTIFY policies_changed with the policy_id whenever a policy row changes.
+
+        Installs the trigger only when it is missing: DDL on policies locks out every
+        reader, so processes starting up must not replace it each time.
+        """
+        trigger_exists = "SELECT 1 FROM pg_trigger WHERE tgrelid = to_regclass('policies') AND tgname = 'policies_changed'"
+        with self.pool.cursor() as cur:
+            cur.execute(trigger_exists)
+            if cur.fetchone():
+                return
+        with self.pool.transaction():
+            with self.pool.cursor() as cur:
+                # Processes starting together install it once; the others find it after waiting
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext('policies_changed'))")
+                cur.execute(trigger_exists)
+                if cur.fetchone():
+                    return
+                cur.execute(f"""
+                    CREATE OR REPLACE FUNCTION notify_policies_changed() RETURNS trigger AS $$
+                    BEGIN
+                        IF TG_OP = 'DELETE' THEN
+                            PERFORM pg_notify('{POLICY_CHANNEL}', OLD.policy_id::text);
+                        ELSE
+                            PERFORM pg_notify('{POLICY_CHANNEL}', NEW.policy_id::text);
+                        END IF;
+                        RETURN NULL;
+                    END;
+                    $$ LANGUAGE plpgsql
+                """)
+                cur.execute("""
+                    CREATE TRIGGER policies_changed
+                    AFTER INSERT OR UPDATE OR DELETE ON policies
+                    FOR EACH ROW EXECUTE PROCEDURE notify_policies_changed()
+                """)
+    
+    def close(self):
+        # Connections belong to the shared pool; see db_pool.close_pool()
+        pass
+
+class PolicyCache:
+    """Read-mostly in-process copy of the policies table.
+
+    Warm-loaded with one bulk query, then kept current by LISTEN policies_changed:
+    pending notifications are drained from the socket on each lookup, so a lookup
+    is a dictionary read unless a policy actually changed. If LISTEN is unavailable
+    the whole table is reloaded every ``max_age`` seconds instead.
+    """
+    
+    def __init__(self, policies_db=None, listen=True, max_age=300):
+        self.policies_db = policies_db or PoliciesDB()
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._listen_lock = threading.Lock()
+        self._policies = {}  # keyed by str(policy_id), matching NOTIFY payloads
+        self._loaded_at = 0
+        self._listen_conn = None
+        
+        if listen:
+            self._start_listening()
+        self.load()
+    
+    def _start_listening(self):
+        # A reconnect replaces the connection whose notifications were lost
+        self.close()
+        try:
+            self.policies_db.create_change_trigger()
+            conn = self.policies_db.pool.dedicated_connection()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {POLICY_CHANNEL}")
+            self._listen_conn = conn
+        except psycopg2.Error as e:
+            print(f"Policy change notifications unavailable, reloading every {self.max_age}s: {e}")
+            self._listen_conn = None
+    
+    def load(self):
+        policies = self.policies_db.get_all_policies()
+        with self._lock:
+            self._policies = policies
+            self._loaded_at = time.monotonic()
+    
+    def _changed_policy_ids(self):
+        """Drain pending notifications without a round trip; None means reload everything."""
+        if self._listen_conn is None:
+            return None if time.monotonic() - self._loaded_at > self.max_age else set()
+        try:
+            if select.select([self._listen_conn], [], [], 0)[0]:
+                self._listen_conn.poll()
+            changed = {notify.payload for notify in self._listen_conn.notifies}
+            self._listen_conn.notifies.clear()
+            return changed
+        except psycopg2.Error:
+            # Notifications may have been lost with the connection; start over
+            self._start_listening()
             return None
     
+    def refresh(self):
+        with self._listen_lock:
+            changed = self._changed_policy_ids()
+        if changed is None:
+            self.load()
+            return
+        for policy_id in changed:
+            policy = self.policies_db.get_policy(policy_id)
+            with self._lock:
+                if policy is None:
+                    self._policies.pop(policy_id, None)
+                else:
+                    self._policies[policy_id] = policy
+    
+    def get_policy(self, policy_id):
+        self.refresh()
+        with self._lock:
+            policy = self._policies.get(str(policy_id))
+        if policy is None:
+            # Possibly created after the warm load; fetch it once and keep it
+            policy = self.policies_db.get_policy(policy_id)
+            if policy is not None:
+                with self._lock:
+                    self._policies[str(policy_id)] = policy
+        return dict(policy) if policy is not None else None
+    
     def close(self):
-        self.conn.close()
+        if self._listen_conn is not None:
+            self._listen_conn.close()
+            self._listen_conn = None
@@ -0,0 +1,145 @@
+import json
+import os
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Columns that never help a clinical decision: keys, bookkeeping and timestamps
+DROPPED_FIELDS = re.compile(r'(^id$|_id$|^created|^updated|_at$|timestamp|^version$)', re.I)
+
+# Field groups in the order they are kept when the budget is tight; exclusions go last
+FIELD_GROUPS = (
+    ('exclusions', re.compile(r'exclu|not_covered|limitation', re.I)),
+    ('limits', re.compile(r'limit|max|cap|deductible|co_?pay|coinsurance|out_of_pocket|waiting|frequency|pre_?auth|authori[sz]ation', re.I)),
+    ('coverage', re.compile(r'cover|benefit|service|plan|name|type|tier|network', re.I)),
+)
+
+LIST_SEPARATORS = re.compile(r'\s*(?:[;\n]|,(?!\d{3}))\s*')
+
+
+def _words(text):
+    return {word for word in re.findall(r'[a-z0-9]+', str(text).lower()) if len(word) > 2}
+
+
+def count_tokens(text, model='gpt-4o'):
+    if tiktoken is None:
+        # Roughly four characters per token for English and JSON
+        return max(1, len(text) // 4)
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding('o200k_base')
+    return len(encoding.encode(text))
+
+
+class PolicyContextBuilder:
+    """Turns a policies row into the compact JSON put in adjudication prompts.
+
+    Only coverage, limit and exclusion fields are kept and list-like values are
+    ordered by relevance to the requested service. To fit ``token_budget`` tokens
+    lists lose their least relevant items before whole fields are left out, and
+    any budget left afterwards is filled again, exclusions first.
+    """
+    
+    def __init__(self, token_budget=None, model='gpt-4o'):
+        self.token_budget = token_budget or int(os.getenv('POLICY_CONTEXT_TOKEN_BUDGET', '400'))
+        self.model = model
+    
+    def _group(self, field):
+        for group, pattern in FIELD_GROUPS:
+            if pattern.search(field):
+                return group
+        return None
+    
+    def _items(self, value):
+        if isinstance(value, (list, tuple)):
+            return [item for item in value if item not in (None, '')]
+        if isinstance(value, str) and len(value) > 60 and LIST_SEPARATORS.search(value):
+            return [item for item in LIST_SEPARATORS.split(value) if item]
+        return None
+    
+    def project(self, policy, requested_service=None):
+        """Return {field: (group, value or [items])} with items ordered most relevant first."""
+        service_words = _words(requested_service or '')
+        projected = {}
+        for field, value in policy.items():
+            if value in (None, '', [], {}) or DROPPED_FIELDS.search(field):
+                continue
+            group = self._group(field)
+            if group is None:
+                continue
+            items = self._items(value)
+            if items is not None:
+                items = sorted(items, key=lambda item: -len(service_words & _words(item)))
+                projected[field] = (group, items)
+            else:
+                projected[field] = (group, value)
+        return projected
+    
+    def render(self, projected, kept=None, omitted=()):
+        kept = kept or {}
+        context = {}
+        for group, _ in FIELD_GROUPS:
+            for field, (field_group, value) in projected.items():
+                if field_group != group or field in omitted:
+                    continue
+                if isinstance(value, list):
+                    items = value[:kept.get(field, len(value))]
+                    dropped = len(value) - len(items)
+                    context[field] = items + ([f"...{dropped} more"] if dropped else [])
+                else:
+                    context[field] = value
+        return json.dumps(context, separators=(',', ':'), default=str)
+    
+    def _by_priority(self, projected):
+        """Field names most important group first, in column order within a group."""
+        order = [group for group, _ in FIELD_GROUPS]
+        return sorted(projected, key=lambda field: order.index(projected[field][0]))
+    
+    def build(self, policy, requested_service=None):
+        if not policy:
+            return None
+        projected = self.project(policy, requested_service)
+        full = {field: len(value) for field, (_, value) in projected.items() if isinstance(value, list)}
+        kept = dict(full)
+        omitted = set()
+        
+        def fits():
+            return count_tokens(self.render(projected, kept, omitted), self.model) <= self.token_budget
+        
+        def size(field):
+            value = projected[field][1]
+            return len(json.dumps(value[:kept[field]] if isinstance(value, list) else value, default=str))
+        
+        # Shorten every list, least important group first, before any field is left out
+        for field in reversed(self._by_priority(projected)):
+            while kept.get(field, 0) > 1 and not fits():
+                kept[field] -= 1
+        # Then leave out coverage and limit scalars, and as a last resort (e.g. one huge exclusion clause)
+        # whole fields largest first, so the prompt always gets valid JSON
+        for field in reversed(self._by_priority(projected)):
+            if fits():
+                break
+            if field not in kept and projected[field][0] != 'exclusions':
+                omitted.add(field)
+        for field in sorted(projected, key=size, reverse=True):
+            if fits():
+                break
+            omitted.add(field)
+        
+        # Fill the budget that is left in priority order: fields left out first, then the list items trimmed
+        for field in self._by_priority(projected):
+            if field in omitted:
+                omitted.discard(field)
+                if not fits():
+                    omitted.add(field)
+        for field in self._by_priority(projected):
+            while field in kept and field not in omitted and kept[field] < full[field]:
+                kept[field] += 1
+                if not fits():
+                    kept[field] -= 1
+                    break
+        return self.render(projected, kept, omitted)
@@ -0,0 +1,283 @@
+"""Offline BM25 index of policy clauses, stored in a local SQLite file.
+
+Each policy row is split into clauses (one per covered service, exclusion, limit
+or sentence of free text), and the clauses' terms go into an inverted index. A
+policy is re-indexed only when its row changes, which the index notices from the
+row fingerprint on lookup.
+
+    python policy_index.py            # index every policy in the database
+    python policy_index.py --rebuild  # drop the index and build it again
+"""
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter, defaultdict
+from adjudication_cache import policy_version
+from policy_context import DROPPED_FIELDS, FIELD_GROUPS, LIST_SEPARATORS, count_tokens
+
+# BM25 parameters; the usual defaults for short documents
+K1 = 1.2
+B = 0.75
+
+# Short scalar fields (limits, deductibles, pre-authorization) always go into the context
+CORE_MAX_CHARS = 60
+
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or that the this to was were will with
+any all per each may not no only other than under up upon which who
+""".split())
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+(?=[A-Z])')
+
+
+def terms(text):
+    """Lower-cased word stems with stopwords removed."""
+    words = re.findall(r'[a-z0-9]+', str(text).lower())
+    stems = []
+    for word in words:
+        if word in STOPWORDS or len(word) < 2:
+            continue
+        if len(word) > 4 and word.endswith('ies'):
+            word = word[:-3] + 'y'
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        stems.append(word)
+    return stems
+
+
+def _group(field):
+    for group, pattern in FIELD_GROUPS:
+        if pattern.search(field):
+            return group
+    return None
+
+
+def chunk_policy(policy):
+    """Split a policies row into clauses: dicts with field, group, position, text and core."""
+    clauses = []
+    for field, value in policy.items():
+        if value in (None, '', [], {}) or DROPPED_FIELDS.search(field):
+            continue
+        group = _group(field)
+        if group is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            items = [str(item) for item in value if item not in (None, '')]
+        elif isinstance(value, str) and len(value) > CORE_MAX_CHARS:
+            items = [part for sentence in SENTENCE_END.split(value) for part in LIST_SEPARATORS.split(sentence)]
+        else:
+            clauses.append({'field': field, 'group': group, 'position': 0, 'text': str(value), 'core': True})
+            continue
+        for position, item in enumerate(item.strip() for item in items):
+            if item:
+                clauses.append({'field': field, 'group': group, 'position': position, 'text': item, 'core': False})
+    return clauses
+
+
+class PolicyIndex:
+    """Inverted BM25 index of policy clauses with per-policy incremental rebuilds.
+
+    ``context`` returns the compact JSON used in adjudication prompts: the policy's
+    short core fields, then its ``top_k`` clauses most relevant to the query, with at
+    least ``exclusion_k`` of the best-matching exclusions so they are never crowded
+    out, trimmed to ``token_budget`` tokens.
+    """
+    
+    def __init__(self, path='policy_index.sqlite3', top_k=8, exclusion_k=3, token_budget=400, model='gpt-4o'):
+        self.top_k = top_k
+        self.exclusion_k = exclusion_k
+        self.token_budget = token_budget
+        self.model = model
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS indexed_policies (
+                    policy_id TEXT PRIMARY KEY,
+                    version TEXT,
+                    clause_count INTEGER,
+                    average_length REAL
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS clauses (
+                    clause_id INTEGER PRIMARY KEY,
+                    policy_id TEXT,
+                    field TEXT,
+                    grp TEXT,
+                    position INTEGER,
+                    text TEXT,
+                    length INTEGER,
+                    core INTEGER
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS postings (
+                    policy_id TEXT,
+                    term TEXT,
+                    clause_id INTEGER,
+                    tf INTEGER
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS clauses_policy_idx ON clauses (policy_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS postings_term_idx ON postings (policy_id, term)")
+    
+    @classmethod
+    def from_env(cls, model='gpt-4o'):
+        """The configured index, or None unless POLICY_INDEX=on."""
+        if os.getenv('POLICY_INDEX', 'off').lower() != 'on':
+            return None
+        return cls(
+            path=os.getenv('POLICY_INDEX_PATH', 'policy_index.sqlite3'),
+            top_k=int(os.getenv('POLICY_INDEX_TOP_K', '8')),
+            exclusion_k=int(os.getenv('POLICY_INDEX_EXCLUSIONS', '3')),
+            token_budget=int(os.getenv('POLICY_CONTEXT_TOKEN_BUDGET', '400')),
+            model=model
+        )
+    
+    def _version(self, policy_id):
+        row = self.conn.execute("SELECT version FROM indexed_policies WHERE policy_id = ?", (policy_id,)).fetchone()
+        return row[0] if row else None
+    
+    def _remove(self, policy_id):
+        self.conn.execute("DELETE FROM postings WHERE policy_id = ?", (policy_id,))
+        self.conn.execute("DELETE FROM clauses WHERE policy_id = ?", (policy_id,))
+        self.conn.execute("DELETE FROM indexed_policies WHERE policy_id = ?", (policy_id,))
+    
+    def index_policy(self, policy):
+        """(Re-)index one policies row unless that exact version is already indexed. Returns True if it was."""
+        policy_id = str(policy['policy_id'])
+        version = policy_version(policy)
+        with self.lock:
+            if self._version(policy_id) == version:
+                return False
+            clauses = chunk_policy(policy)
+            with self.conn:
+                self._remove(policy_id)
+                lengths = []
+                for clause in clauses:
+                    clause_terms = terms(clause['text'])
+                    lengths.append(len(clause_terms))
+                    cursor = self.conn.execute("""
+                        INSERT INTO clauses (policy_id, field, grp, position, text, length, core)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, (policy_id, clause['field'], clause['group'], clause['position'], clause['text'],
+                          len(clause_terms), int(clause['core'])))
+                    self.conn.executemany(
+                        "INSERT INTO postings (policy_id, term, clause_id, tf) VALUES (?, ?, ?, ?)",
+                        [(policy_id, term, cursor.lastrowid, tf) for term, tf in Counter(clause_terms).items()]
+                    )
+                self.conn.execute(
+                    "INSERT INTO indexed_policies (policy_id, version, clause_count, average_length) VALUES (?, ?, ?, ?)",
+                    (policy_id, version, len(clauses), sum(lengths) / len(lengths) if lengths else 0.0)
+                )
+        return True
+    
+    def sync(self, policies):
+        """Bring the index in line with {policy_id: row}; returns (re-indexed ids, removed ids)."""
+        updated = [policy_id for policy_id, policy in policies.items() if self.index_policy(policy)]
+        with self.lock, self.conn:
+            indexed = {row[0] for row in self.conn.execute("SELECT policy_id FROM indexed_policies")}
+            removed = indexed - {str(policy_id) for policy_id in policies}
+            for policy_id in removed:
+                self._remove(policy_id)
+        return updated, sorted(removed)
+    
+    def clear(self):
+        with self.lock, self.conn:
+            for table in ('postings', 'clauses', 'indexed_policies'):
+                self.conn.execute(f"DELETE FROM {table}")
+    
+    def search(self, policy_id, query, limit=None):
+        """[(score, clause)] for the policy's clauses matching ``query``, best first."""
+        query_terms = set(terms(query))
+        if not query_terms:
+            return []
+        policy_id = str(policy_id)
+        placeholders = ','.join('?' * len(query_terms))
+        with self.lock:
+            stats = self.conn.execute(
+                "SELECT clause_count, average_length FROM indexed_policies WHERE policy_id = ?", (policy_id,)
+            ).fetchone()
+            if not stats:
+                return []
+            rows = self.conn.execute(f"""
+                SELECT p.term, p.tf, c.clause_id, c.field, c.grp, c.position, c.text, c.length, c.core
+                FROM postings p JOIN clauses c ON c.clause_id = p.clause_id
+                WHERE p.policy_id = ? AND p.term IN ({placeholders})
+            """, (policy_id, *query_terms)).fetchall()
+        
+        clause_count, average_length = stats
+        document_frequency = Counter(row[0] for row in rows)
+        scores = defaultdict(float)
+        clauses = {}
+        for term, tf, clause_id, field, group, position, text, length, core in rows:
+            idf = math.log(1 + (clause_count - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            norm = 1 - B + B * length / (average_length or 1)
+            scores[clause_id] += idf * tf * (K1 + 1) / (tf + K1 * norm)
+            clauses[clause_id] = {'field': field, 'group': group, 'position': position, 'text': text, 'core': bool(core)}
+        ranked = sorted(scores, key=lambda clause_id: (-scores[clause_id], clause_id))
+        return [(scores[clause_id], clauses[clause_id]) for clause_id in ranked[:limit]]
+    
+    def _core(self, policy_id):
+        with self.lock:
+            return [
+                {'field': field, 'group': group, 'position': position, 'text': text, 'core': True}
+                for field, group, position, text in self.conn.execute(
+                    "SELECT field, grp, position, text FROM clauses WHERE policy_id = ? AND core = 1 ORDER BY clause_id",
+                    (policy_id,)
+                )
+            ]
+    
+    def _render(self, clauses):
+        context = {}
+        for group, _ in FIELD_GROUPS:
+            for clause in sorted((c for c in clauses if c['group'] == group), key=lambda c: (c['field'], c['position'])):
+                if clause['core']:
+                    context[clause['field']] = clause['text']
+                else:
+                    context.setdefault(clause['field'], []).append(clause['text'])
+        return json.dumps(context, separators=(',', ':'), default=str)
+    
+    def context(self, policy, query):
+        """Compact JSON of the clauses of ``policy`` most relevant to ``query``, indexing the policy first if needed."""
+        if not policy:
+            return None
+        self.index_policy(policy)
+        policy_id = str(policy['policy_id'])
+        ranked = [clause for _, clause in self.search(policy_id, query) if not clause['core']]
+        
+        # The best exclusions go first so a long coverage list can never push them out
+        exclusions = [clause for clause in ranked if clause['group'] == 'exclusions'][:self.exclusion_k]
+        others = [clause for clause in ranked if clause not in exclusions]
+        chosen = self._core(policy_id)
+        for clause in (exclusions + others)[:max(self.top_k, len(exclusions))]:
+            candidate = chosen + [clause]
+            if count_tokens(self._render(candidate), self.model) > self.token_budget:
+                break
+            chosen = candidate
+        return self._render(chosen)
+    
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    from dotenv import load_dotenv
+    from policies_db import PoliciesDB
+    
+    parser = argparse.ArgumentParser(description='Build or update the policy clause index.')
+    parser.add_argument('--rebuild', action='store_true', help='drop everything and index all policies again')
+    args = parser.parse_args()
+    
+    load_dotenv()
+    index = PolicyIndex.from_env() or PolicyIndex(os.getenv('POLICY_INDEX_PATH', 'policy_index.sqlite3'))
+    if args.rebuild:
+        index.clear()
+    updated, removed = index.sync(PoliciesDB().get_all_policies())
+    print(f"Indexed {len(updated)} changed policies, removed {len(removed)}")
+    index.close()
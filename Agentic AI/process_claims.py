@@ -2,21 +2,6 @@ from dotenv import load_dotenv
 from gmail_reader import GmailReader
 from openai_agent import OpenAIEmailAgent
 from claims_db import ClaimsDB
-import base64
-
-def extract_email_body(gmail_service, msg_id):
-    msg = gmail_service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-    payload = msg['payload']
-    
-    if 'body' in payload and payload['body'].get('data'):
-        return base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
-    
-    if 'parts' in payload:
-        for part in payload['parts']:
-            if part['mimeType'] == 'text/plain' and part['body'].get('data'):
-                return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-    
-    return msg.get('snippet', '')
 
 def process_claims():
     load_dotenv()
@@ -32,8 +17,8 @@ def process_claims():
     for email in emails:
         print(f"Processing: {email['subject']}")
         
-        # Extract full body
-        full_body = extract_email_body(gmail.service, email['message_id'])
+        # Full body was decoded during the batched fetch
+        full_body = email['body']
         
         # Extract claim data using LLM
         claim_data = agent.extract_claim_data(email['subject'], full_body)
@@ -0,0 +1,208 @@
+import email.utils
+import os
+import random
+import socket
+import threading
+import time
+from metrics import metrics
+
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# Gmail reports per-user quota errors as 403s with one of these reasons
+QUOTA_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+
+# Transport failures from the OpenAI SDK, matched by name so the module stays optional
+RETRYABLE_ERROR_NAMES = ('APITimeoutError', 'APIConnectionError', 'RateLimitError', 'InternalServerError')
+
+DEFAULTS = {
+    # Gmail allows 250 quota units per user per second; a messages.get costs 5
+    'gmail': {'rate': 250, 'max_in_flight': 8},
+    # Requests per second and tokens per minute; raise these to match the account's tier
+    'openai': {'rate': 8, 'max_in_flight': 16, 'tokens_per_minute': 30000},
+}
+
+
+def status_of(exc):
+    status = getattr(exc, 'status_code', None)
+    if status is None and getattr(exc, 'resp', None) is not None:
+        status = getattr(exc.resp, 'status', None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after(exc):
+    """Seconds the server asked us to wait, from a Retry-After header, or None."""
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or getattr(exc, 'resp', None)
+    if not headers:
+        return None
+    try:
+        value = headers.get('retry-after') or headers.get('Retry-After')
+    except AttributeError:
+        return None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value)
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+
+def is_retryable(exc):
+    if isinstance(exc, (TimeoutError, socket.timeout, ConnectionError)):
+        return True
+    if type(exc).__name__ in RETRYABLE_ERROR_NAMES:
+        return True
+    status = status_of(exc)
+    if status in RETRYABLE_STATUSES:
+        return True
+    if status != 403:
+        return False
+    # The reason is only in the JSON error body, not the status line
+    content = getattr(exc, 'content', b'') or b''
+    details = str(exc) + (content.decode('utf-8', 'replace') if isinstance(content, bytes) else str(content))
+    return any(reason in details for reason in QUOTA_REASONS)
+
+
+class TokenBucket:
+    """Refills ``rate`` tokens per second up to ``capacity``; acquire() blocks until enough are available."""
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+    
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def acquire(self, tokens=1):
+        # A single request larger than the bucket would wait forever; let it through on a full bucket
+        tokens = min(float(tokens), self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self._tokens >= tokens:
+                        self._tokens -= tokens
+                        return
+                    wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+    
+    def pause(self, seconds):
+        """Stop handing out tokens for ``seconds``, e.g. after the server returned Retry-After."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+class AIMDLimiter:
+    """Concurrency limit that grows by one per window of successes and halves on throttling."""
+    
+    def __init__(self, initial=4, minimum=1, maximum=64, increase=1.0, decrease=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self._in_flight = 0
+        self._condition = threading.Condition()
+    
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+    
+    def release(self, throttled=False):
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self._condition.notify_all()
+
+
+class ApiLimiter:
+    """Budget, concurrency limit and retry policy shared by every caller of one API.
+
+    Each call takes ``cost`` units from a token bucket (and ``tokens`` from an
+    optional tokens-per-minute bucket), runs inside the AIMD in-flight limit and is
+    retried on throttling or transient errors with jittered exponential backoff. A
+    Retry-After from the server pauses the whole bucket, so other threads back off too
+    instead of piling on.
+    """
+    
+    def __init__(self, name, rate, burst=None, max_in_flight=8, min_in_flight=1,
+                 max_retries=5, base_delay=0.5, max_delay=60.0, tokens_per_minute=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.token_bucket = TokenBucket(tokens_per_minute / 60.0, tokens_per_minute) if tokens_per_minute else None
+        self.in_flight = AIMDLimiter(initial=max(min_in_flight, max_in_flight // 2), minimum=min_in_flight, maximum=max_in_flight)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    @classmethod
+    def from_env(cls, name):
+        prefix = name.upper()
+        defaults = DEFAULTS.get(name, {})
+        tokens_per_minute = os.getenv(f'{prefix}_TOKENS_PER_MINUTE', defaults.get('tokens_per_minute'))
+        return cls(
+            name,
+            rate=float(os.getenv(f'{prefix}_RATE', defaults.get('rate', 10))),
+            burst=float(os.getenv(f'{prefix}_BURST', 0)) or None,
+            max_in_flight=int(os.getenv(f'{prefix}_MAX_IN_FLIGHT', defaults.get('max_in_flight', 8))),
+            max_retries=int(os.getenv(f'{prefix}_MAX_RETRIES', '5')),
+            tokens_per_minute=float(tokens_per_minute) if tokens_per_minute else None
+        )
+    
+    def backoff(self, attempt, exc=None):
+        """Sleep before retry number ``attempt`` (0-based), honouring Retry-After when the error carries one."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        server_delay = retry_after(exc) if exc is not None else None
+        if server_delay is not None:
+            delay = min(self.max_delay, server_delay) + random.uniform(0, self.base_delay)
+            self.bucket.pause(delay)
+        metrics.inc('claims_api_retries_total', api=self.name, status=status_of(exc) or type(exc).__name__)
+        time.sleep(delay)
+    
+    def call(self, fn, cost=1, tokens=0):
+        attempt = 0
+        while True:
+            self.bucket.acquire(cost)
+            if tokens and self.token_bucket:
+                self.token_bucket.acquire(tokens)
+            self.in_flight.acquire()
+            throttled = False
+            try:
+                return fn()
+            except Exception as e:
+                throttled = status_of(e) in (429, 403) or retry_after(e) is not None
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                error = e
+            finally:
+                self.in_flight.release(throttled)
+            self.backoff(attempt, error)
+            attempt += 1
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """Process-wide limiter for an API, so all clients of it share one budget."""
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = ApiLimiter.from_env(name)
+        return _limiters[name]
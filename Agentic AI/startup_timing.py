@@ -0,0 +1,156 @@
+"""Cold-start timings: imports, Gmail client construction and the first Gmail and OpenAI requests.
+
+Every measurement runs in a fresh interpreter, since a warm one has everything
+imported already. Without --live the first requests go to the fakes in fakes.py,
+which isolates this code's own startup cost. With --live they go to Gmail
+(users.getProfile, using token.json) and OpenAI (models.list).
+
+    python startup_timing.py --runs 5
+    python startup_timing.py --live
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Each snippet prints a JSON object of timings in seconds
+IMPORT_MAIN = """
+import json, time
+start = time.perf_counter()
+import main
+print(json.dumps({'import main': time.perf_counter() - start}))
+"""
+
+IMPORT_SDKS = """
+import json, time
+timings = {}
+for module in ('googleapiclient.discovery', 'google_auth_oauthlib.flow', 'openai', 'pypdf'):
+    start = time.perf_counter()
+    try:
+        __import__(module)
+    except ImportError:
+        continue
+    timings[f'import {module}'] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+BUILD_GMAIL = """
+import json, time
+start = time.perf_counter()
+from google.oauth2.credentials import Credentials
+from gmail_auth import build_service
+imported = time.perf_counter()
+service = build_service(Credentials(token='startup-timing'))
+service.users().messages().list(userId='me')
+print(json.dumps({'gmail imports': imported - start, 'gmail client build': time.perf_counter() - imported}))
+"""
+
+FIRST_REQUEST_FAKE = """
+import json, time
+start = time.perf_counter()
+from gmail_reader import GmailReader
+from openai_agent import OpenAIEmailAgent
+from fakes import FakeGmailService, FakeOpenAIClient
+service = FakeGmailService()
+service.add_message('msg-1', 'First claim', 'Member MEM-1 was diagnosed with migraine and needs a General consultation for 1500.')
+ready = time.perf_counter()
+email = next(GmailReader(service).iter_emails(max_results=1, label_name='Agentic_AI', unread_only=True))
+fetched = time.perf_counter()
+OpenAIEmailAgent(client=FakeOpenAIClient()).extract_claim_data(email['subject'], email['body'])
+print(json.dumps({
+    'fake setup': ready - start,
+    'first Gmail fetch': fetched - ready,
+    'first OpenAI request': time.perf_counter() - fetched,
+}))
+"""
+
+FIRST_REQUEST_LIVE = """
+import json, time
+from dotenv import load_dotenv
+load_dotenv()
+start = time.perf_counter()
+from gmail_auth import get_credentials, build_service
+creds = get_credentials()
+authorised = time.perf_counter()
+service = build_service(creds)
+built = time.perf_counter()
+service.users().getProfile(userId='me').execute()
+profiled = time.perf_counter()
+from openai_agent import OpenAIEmailAgent
+OpenAIEmailAgent().client.models.list()
+print(json.dumps({
+    'credentials': authorised - start,
+    'gmail client build': built - authorised,
+    'first Gmail request': profiled - built,
+    'first OpenAI request': time.perf_counter() - profiled,
+}))
+"""
+
+
+def measure(code, runs, env=None):
+    """Run ``code`` in ``runs`` fresh interpreters; returns {name: [seconds, ...]}."""
+    samples = {}
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', code], cwd=HERE, env=dict(os.environ, **(env or {})),
+            capture_output=True, text=True, check=True
+        ).stdout
+        for name, seconds in json.loads(output.strip().splitlines()[-1]).items():
+            samples.setdefault(name, []).append(seconds)
+    return samples
+
+
+def slowest_imports(top):
+    """The top-level imports of main.py with the largest cumulative time, from -X importtime."""
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=HERE, capture_output=True, text=True, check=True
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Two spaces of indent per nesting level; level 1 are the modules main imports directly
+        if len(name) - len(name.lstrip()) <= 3:
+            rows.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per measurement')
+    parser.add_argument('--live', action='store_true', help='time the first requests against Gmail and OpenAI')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    
+    samples = {}
+    samples.update(measure(IMPORT_MAIN, args.runs))
+    samples.update(measure(IMPORT_SDKS, args.runs))
+    samples.update(measure(BUILD_GMAIL, args.runs))
+    with tempfile.TemporaryDirectory() as workdir:
+        document = os.path.join(workdir, 'gmail.v1.json')
+        subprocess.run([sys.executable, 'gmail_auth.py', '--save-discovery', document], cwd=HERE, check=True, capture_output=True)
+        cached = measure(BUILD_GMAIL, args.runs, {'GMAIL_DISCOVERY_DOCUMENT': document})
+        samples['gmail client build (GMAIL_DISCOVERY_DOCUMENT)'] = cached['gmail client build']
+    samples.update(measure(FIRST_REQUEST_LIVE if args.live else FIRST_REQUEST_FAKE, 1 if args.live else args.runs))
+    
+    results = {name: round(statistics.median(values) * 1000, 1) for name, values in samples.items()}
+    print(f"Median of {args.runs} cold starts (ms):")
+    for name, ms in results.items():
+        print(f"  {name}: {ms}")
+    print("Slowest imports of main.py (ms, cumulative):")
+    for seconds, name in slowest_imports(8):
+        print(f"  {name}: {round(seconds * 1000, 1)}")
+    
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+from psycopg2.extras import execute_values, Json
+from db_pool import get_pool
+from claims_db import job_queue_created
+from contextlib import contextmanager
+import json
+import os
+import threading
+import uuid
+
+# Job lifecycle, the same one claims_workflow.py uses for claims, plus a terminal DEAD_LETTER
+NEW = 'NEW'
+IN_PROGRESS = 'IN_PROGRESS'
+PROCESSED = 'PROCESSED'
+FAILED = 'FAILED'
+DEAD_LETTER = 'DEAD_LETTER'
+
+
+class LeaseLost(Exception):
+    """The job's lease expired and another worker has taken it over."""
+    pass
+
+
+def _dumps(value):
+    return json.dumps(value, default=str)
+
+
+class WorkQueue:
+    """Postgres-backed queue of claim jobs, one per ingested email.
+
+    Workers take jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any number of
+    worker processes can share the table without handing out the same job twice.
+    A taken job carries a lease; if its worker dies the lease runs out and the
+    job becomes available again. Failed jobs are retried with exponential backoff
+    until ``max_attempts``, then parked as DEAD_LETTER for a person to look at.
+    """
+    
+    def __init__(self, pool=None, lease_seconds=None, max_attempts=None, retry_delay=None):
+        self.pool = pool or get_pool()
+        self.lease_seconds = lease_seconds or int(os.getenv('WORKER_LEASE_SECONDS', '300'))
+        self.max_attempts = max_attempts or int(os.getenv('WORKER_MAX_ATTEMPTS', '5'))
+        self.retry_delay = retry_delay or float(os.getenv('WORKER_RETRY_DELAY', '30'))
+        self.create_table()
+    
+    def create_table(self):
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT to_regclass('claim_jobs') IS NULL")
+            created = cur.fetchone()[0]
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS claim_jobs (
+                    job_id BIGSERIAL PRIMARY KEY,
+                    message_id VARCHAR(255) UNIQUE NOT NULL,
+                    payload JSONB NOT NULL,
+                    status VARCHAR(20) NOT NULL DEFAULT 'NEW',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    lease_token VARCHAR(64),
+                    lease_expires_at TIMESTAMP,
+                    claim_id INTEGER,
+                    last_error TEXT,
+                    marked_read BOOLEAN NOT NULL DEFAULT FALSE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # Partial indexes keep the claim query cheap however many finished jobs pile up
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS claim_jobs_ready_idx ON claim_jobs (available_at, job_id)
+                WHERE status IN ('NEW', 'FAILED')
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS claim_jobs_lease_idx ON claim_jobs (lease_expires_at)
+                WHERE status = 'IN_PROGRESS'
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS claim_jobs_unread_idx ON claim_jobs (job_id)
+                WHERE status = 'PROCESSED' AND NOT marked_read
+            """)
+        if created:
+            job_queue_created(self.pool)
+    
+    def enqueue(self, emails):
+        """Add one NEW job per email; emails already queued are ignored. Returns the message_ids queued."""
+        if not emails:
+            return set()
+        with self.pool.cursor() as cur:
+            rows = execute_values(cur, """
+                INSERT INTO claim_jobs (message_id, payload)
+                VALUES %s
+                ON CONFLICT (message_id) DO NOTHING
+                RETURNING message_id
+            """, [(email['message_id'], Json(email, dumps=_dumps)) for email in emails], page_size=1000, fetch=True)
+            return {row[0] for row in rows}
+    
+    def claim(self):
+        """Take the oldest ready job, or one whose lease has expired. Returns the job dict or None."""
+        lease_token = uuid.uuid4().hex
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                UPDATE claim_jobs
+                SET status = 'IN_PROGRESS',
+                    attempts = attempts + 1,
+                    lease_token = %s,
+                    lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = (
+                    SELECT job_id FROM claim_jobs
+                    WHERE (status IN ('NEW', 'FAILED') AND available_at <= CURRENT_TIMESTAMP)
+                       OR (status = 'IN_PROGRESS' AND lease_expires_at < CURRENT_TIMESTAMP)
+                    ORDER BY available_at, job_id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING job_id, message_id, payload, attempts, lease_token
+            """, (lease_token, self.lease_seconds))
+            row = cur.fetchone()
+            if row:
+                return {'job_id': row[0], 'message_id': row[1], 'email': row[2], 'attempts': row[3], 'lease_token': row[4]}
+            return None
+    
+    def _finish(self, cur, job, status, claim_id=None, error=None, delay=0):
+        cur.execute("""
+            UPDATE claim_jobs
+            SET status = %s,
+                claim_id = COALESCE(%s, claim_id),
+                last_error = %s,
+                available_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                lease_token = NULL,
+                lease_expires_at = NULL,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = %s AND lease_token = %s
+        """, (status, claim_id, error, delay, job['job_id'], job['lease_token']))
+        if cur.rowcount != 1:
+            raise LeaseLost(f"lease on job {job['job_id']} was lost")
+    
+    def complete(self, job, claim_id=None):
+        """Mark the job PROCESSED. Call inside the transaction that stored its claim, so both commit together."""
+        with self.pool.cursor() as cur:
+            self._finish(cur, job, PROCESSED, claim_id=claim_id)
+    
+    def dead_letter(self, job, error):
+        with self.pool.cursor() as cur:
+            self._finish(cur, job, DEAD_LETTER, error=error)
+    
+    def fail(self, job, error):
+        """Schedule a retry with exponential backoff, or dead-letter the job once attempts run out."""
+        if job['attempts'] >= self.max_attempts:
+            self.dead_letter(job, error)
+            return DEAD_LETTER
+        delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+        with self.pool.cursor() as cur:
+            self._finish(cur, job, FAILED, error=error, delay=delay)
+        return FAILED
+    
+    def extend_lease(self, job):
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                UPDATE claim_jobs
+                SET lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE job_id = %s AND lease_token = %s
+            """, (self.lease_seconds, job['job_id'], job['lease_token']))
+            if cur.rowcount != 1:
+                raise LeaseLost(f"lease on job {job['job_id']} was lost")
+    
+    @contextmanager
+    def heartbeat(self, job, interval=None):
+        """Extend the job's lease every ``interval`` seconds (a third of the lease by default) while the block runs.
+        
+        Keeps a job slowed by LLM retries or rate-limit backoff from being claimed by a second worker.
+        """
+        interval = interval or self.lease_seconds / 3
+        stop = threading.Event()
+        
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    self.extend_lease(job)
+                except LeaseLost:
+                    # complete() will fail as well, rolling back the claim
+                    return
+                except Exception as e:
+                    print(f"  Could not extend the lease on job {job['job_id']}: {e}")
+        
+        thread = threading.Thread(target=beat, name=f"lease-{job['job_id']}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+    
+    def unread_processed(self, limit=1000):
+        """message_ids of processed jobs whose emails have not been marked read in Gmail yet."""
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                SELECT message_id FROM claim_jobs
+                WHERE status = 'PROCESSED' AND NOT marked_read
+                ORDER BY job_id
+                LIMIT %s
+            """, (limit,))
+            return [row[0] for row in cur.fetchall()]
+    
+    def set_marked_read(self, message_ids):
+        if not message_ids:
+            return
+        with self.pool.cursor() as cur:
+            cur.execute("UPDATE claim_jobs SET marked_read = TRUE WHERE message_id = ANY(%s)", (list(message_ids),))
+    
+    def retry_dead_letters(self):
+        """Put every DEAD_LETTER job back in the queue with a fresh set of attempts."""
+        with self.pool.cursor() as cur:
+            cur.execute("""
+                UPDATE claim_jobs
+                SET status = 'NEW', attempts = 0, available_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                WHERE status = 'DEAD_LETTER'
+            """)
+            return cur.rowcount
+    
+    def stats(self):
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT status, COUNT(*) FROM claim_jobs GROUP BY status")
+            return dict(cur.fetchall())
@@ -0,0 +1,219 @@
+from dotenv import load_dotenv
+from db_pool import get_pool, close_pool
+from claims_store import ClaimsStore
+from db_manager import EmailDB
+from work_queue import WorkQueue, LeaseLost, PROCESSED, DEAD_LETTER
+from gmail_reader import chunks, parse_limit, BATCH_SIZE
+from metrics import metrics
+from dedupe import Deduplicator, describe
+from label_updates import LabelUpdateBuffer
+import os
+import signal
+import sys
+import threading
+import traceback
+
+SYNC_KEY = 'gmail:Agentic_AI'
+
+
+class ClaimWorker:
+    """Takes claim jobs from the work queue and runs them through ClaimProcessor.
+
+    The claim, its balance deduction and the PROCESSED status are committed in one
+    transaction, so a job whose lease was taken over by another worker rolls back
+    instead of storing the claim twice. A heartbeat renews the lease while the job
+    runs, so slow LLM calls do not hand it to another worker in the first place.
+    """
+    
+    def __init__(self, processor, queue, poll_interval=None, email_db=None):
+        self.processor = processor
+        self.queue = queue
+        self.pool = processor.pool
+        self.email_db = email_db or EmailDB(self.pool)
+        self.poll_interval = poll_interval or float(os.getenv('WORKER_POLL_INTERVAL', '5'))
+    
+    def process_job(self, job):
+        with self.queue.heartbeat(job):
+            return self._process(job)
+    
+    def _process(self, job):
+        email = job['email']
+        claim_data = self.processor.extract(email)
+        if not claim_data:
+            # Retrying will not help; the email is marked read like in the other run modes
+            with self.pool.transaction():
+                self.queue.dead_letter(job, 'Could not extract claim data')
+                self.email_db.mark_unextractable([job['message_id']])
+            return DEAD_LETTER, None
+        
+        member, denial = self.processor.validate(claim_data)
+        if denial:
+            decision, reasoning = 'DENIED', denial
+        else:
+            decision, reasoning = self.processor.adjudicate(claim_data, member)
+        
+        with self.pool.transaction():
+            # The message_id marks the source email processed in the same statement
+            claim_id, decision = self.processor.commit(claim_data, decision, reasoning, job['message_id'])
+            self.queue.complete(job, claim_id)
+        return PROCESSED, (claim_id, decision)
+    
+    def handle(self, job):
+        subject = job['email'].get('subject', '')[:50]
+        try:
+            status, result = self.process_job(job)
+        except LeaseLost as e:
+            print(f"  Job {job['job_id']} skipped: {e}")
+            return
+        except Exception as e:
+            status = self.queue.fail(job, f"{type(e).__name__}: {e}")
+            print(f"  Job {job['job_id']} {status} after attempt {job['attempts']}: {e}")
+            traceback.print_exc()
+            return
+        
+        if status == PROCESSED:
+            print(f"  Job {job['job_id']}: Claim ID {result[0]} {result[1]} ({subject})")
+        else:
+            print(f"  Job {job['job_id']}: {status}, could not extract claim data ({subject})")
+    
+    def run(self, stop):
+        while not stop.is_set():
+            try:
+                job = self.queue.claim()
+                if job is not None:
+                    self.handle(job)
+            except Exception as e:
+                # Usually the database is unreachable; an unfinished job comes back when its lease runs out
+                print(f"Worker error: {e}")
+                job = None
+            if job is None:
+                stop.wait(self.poll_interval)
+
+
+class Ingestor:
+    """Polls Gmail, stores new emails and queues one claim job per email.
+
+    It also marks emails read once their jobs are PROCESSED, so workers never need
+    Gmail credentials and scale independently of the mailbox, and rolls up the
+    claim summary deltas the workers write.
+    """
+    
+    def __init__(self, gmail, email_db, queue, label_name='Agentic_AI', interval=None):
+        self.gmail = gmail
+        self.email_db = email_db
+        self.queue = queue
+        self.label_name = label_name
+        # Resubmissions are flagged read_pending when stored, so a restart finds any left unread
+        self.labels = LabelUpdateBuffer(gmail, email_db)
+        self.claims_store = ClaimsStore(email_db.pool)
+        self.interval = interval or float(os.getenv('INGEST_INTERVAL', '60'))
+        self.incremental = os.getenv('GMAIL_SYNC', 'full') == 'incremental'
+        if os.getenv('DEDUPE', 'on').lower() == 'off':
+            self.deduplicator = None
+        else:
+            from claims_db import ClaimsDB
+            self.deduplicator = Deduplicator(ClaimsDB(email_db.pool))
+    
+    def ingest_once(self):
+        history_id = self.email_db.get_history_id(SYNC_KEY) if self.incremental else None
+        emails, history_id = self.gmail.sync_emails(
+            history_id, max_results=parse_limit(os.getenv('MAX_EMAILS')), label_name=self.label_name, unread_only=True
+        )
+        queued = set()
+        for window in chunks(emails, BATCH_SIZE):
+            # Resubmissions never become jobs; matching the emails table also catches originals still queued
+            resubmitted = self.deduplicator.check(window) if self.deduplicator else {}
+            with self.email_db.pool.transaction():
+                new_message_ids = self.email_db.insert_emails(window)
+                queued |= self.queue.enqueue([
+                    email for email in window
+                    if email['message_id'] in new_message_ids and email['message_id'] not in resubmitted
+                ])
+            for email in window:
+                if email['message_id'] in new_message_ids and email['message_id'] in resubmitted:
+                    print(f"Skipped ({describe(resubmitted[email['message_id']])}): {email['subject'][:50]}")
+                    self.labels.add([email['message_id']])
+            self.labels.flush()
+        if self.incremental and history_id:
+            self.email_db.save_history_id(SYNC_KEY, history_id)
+        return queued
+    
+    def mark_processed_read(self):
+        message_ids = self.queue.unread_processed()
+        if message_ids:
+            self.gmail.mark_messages_read(message_ids)
+            with self.email_db.pool.transaction():
+                self.queue.set_marked_read(message_ids)
+                self.email_db.clear_read_pending(message_ids)
+        # Emails that never become PROCESSED jobs but still need marking read, such as unextractable ones
+        if self.labels.recover():
+            self.labels.flush()
+        return message_ids
+    
+    def run(self, stop):
+        # Messages a previous ingestor stored as resubmissions but never marked read
+        self.labels.recover()
+        while not stop.is_set():
+            try:
+                queued = self.ingest_once()
+                marked = self.mark_processed_read()
+                # Claim workers only append summary deltas; fold them into claim_daily_totals once per cycle
+                self.claims_store.rollup_summary()
+                print(f"Queued {len(queued)} new emails, marked {len(marked)} processed emails read; queue: {self.queue.stats()}")
+            except Exception as e:
+                print(f"Ingest cycle failed: {e}")
+                traceback.print_exc()
+            stop.wait(self.interval)
+
+
+def _stop_on_signals():
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    return stop
+
+
+def main(command):
+    load_dotenv()
+    pool = get_pool()
+    queue = WorkQueue(pool)
+    if os.getenv('METRICS_PORT') and command in ('ingest', 'work'):
+        metrics.serve(int(os.getenv('METRICS_PORT')))
+    
+    if command == 'stats':
+        print(queue.stats())
+    elif command == 'retry-dead':
+        print(f"Requeued {queue.retry_dead_letters()} dead-lettered jobs")
+    elif command == 'ingest':
+        from gmail_reader import GmailReader
+        Ingestor(GmailReader(), EmailDB(pool), queue).run(_stop_on_signals())
+    elif command == 'work':
+        from claim_processor import ClaimProcessor
+        processor = ClaimProcessor(pool)
+        email_db = EmailDB(pool)
+        stop = _stop_on_signals()
+        # Each thread holds at most one pooled connection at a time; keep DB_POOL_MAX >= WORKER_CONCURRENCY
+        threads = [
+            threading.Thread(target=ClaimWorker(processor, queue, email_db=email_db).run, args=(stop,), name=f'claim-worker-{i}')
+            for i in range(int(os.getenv('WORKER_CONCURRENCY', '1')))
+        ]
+        for thread in threads:
+            thread.start()
+        print(f"Started {len(threads)} claim workers")
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+        processor.close()
+        if processor.report():
+            print(processor.report())
+        print(metrics.report())
+        metrics.export()
+    else:
+        print("Usage: python worker.py ingest|work|stats|retry-dead")
+        sys.exit(2)
+    
+    close_pool()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else 'work')